@@ -336,7 +336,10 @@ class Blok:
             model=model, file_to_import=file_to_import, **kwargs)
         res = importer.run()
         logger.info("Create %d entries, Update %d entries",
-                    len(res['created_entries']), len(res['updated_entries']))
+                    res.get('nb_created_entries',
+                            len(res['created_entries'])),
+                    res.get('nb_updated_entries',
+                            len(res['updated_entries'])))
         if res['error_found']:
             for error in res['error_found']:
                 logger.error(error)
@@ -22,6 +22,10 @@ class AnyBlokCore(Blok):
     autoinstall = True
     priority = 0
 
+    def update(self, latest_version):
+        if latest_version is not None:
+            self.registry.System.Cache.compact()
+
     def pre_migration(self, latest_version):
         if latest_version is not None and latest_version < '0.4.1':
             self.pre_migration_0_4_1_fields_become_polymorphic(latest_version)
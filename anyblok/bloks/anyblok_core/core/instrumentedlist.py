@@ -6,6 +6,16 @@
 # v. 2.0. If a copy of the MPL was not distributed with this file,You can
 # obtain one at http://mozilla.org/MPL/2.0/.
 from anyblok import Declarations
+from anyblok.common import anyblok_column_prefix
+from sqlalchemy import inspect, orm
+from sqlalchemy.ext.hybrid import hybrid_method
+from functools import partial
+from inspect import getattr_static
+from types import FunctionType
+from weakref import WeakKeyDictionary
+
+
+method_types = (FunctionType, classmethod, staticmethod, hybrid_method)
 
 
 @Declarations.register(Declarations.Core)
@@ -13,14 +23,111 @@ class InstrumentedList:
     """ class of the return of the query.all() or the relationship list
     """
 
-    def __getattr__(self, name):
+    method_attributes = WeakKeyDictionary()
+
+    def to_dict(self, *fields):
+        """ Transform the records to the list of dict of value, the
+        relationships of all the records are loaded together, see
+        ``SqlMixin.to_dict`` for the fields
+
+        :rtype: list of dict
+        """
+        if not self:
+            return []
+
+        cls = self[0].__class__
+        if not hasattr(cls, 'records_to_dict'):
+            return [x.to_dict(*fields) for x in self]
+        elif any(x.__class__ is not cls for x in self):
+            return [x.to_dict(*fields) for x in self]
+
+        return cls.records_to_dict(self, *fields)
+
+    def is_method(self, name):
+        """ Return True if the attribute is a method, the kind of the
+        attribute is found on the class of the elements and kept by class
+
+        :param name: name of the attribute
+        :rtype: bool
+        """
+        cls = self[0].__class__
+        methods = self.method_attributes.setdefault(cls, {})
+        if name not in methods:
+            attribute = getattr_static(cls, name, None)
+            if attribute is None:
+                # only defined on the instance
+                return hasattr(getattr(self[0], name), '__call__')
+
+            methods[name] = isinstance(attribute, method_types)
+
+        return methods[name]
+
+    def pluck(self, name):
+        """ Return the values of the attribute for all the elements, the
+        column or the relationship is loaded by one query for all the
+        elements which have not loaded it yet::
 
-        def wrapper(*args, **kwargs):
-            return [getattr(x, name)(*args, **kwargs) for x in self]
+            query.all().pluck('name')
 
+        :param name: name of the attribute
+        :rtype: list of the values
+        """
+        self.load_attribute(name)
+        return [getattr(x, name) for x in self]
+
+    def call(self, name, *args, **kwargs):
+        """ Call the method on all the elements::
+
+            query.all().call('foo', bar)
+
+        :param name: name of the method
+        :rtype: list of the results
+        """
+        return [getattr(x, name)(*args, **kwargs) for x in self]
+
+    def load_attribute(self, name):
+        """ Load the column or the relationship by one query for all the
+        elements which have not loaded it yet, the relationships are
+        loaded with the loader given by ``get_relationship_loader``
+
+        :param name: name of the attribute
+        """
+        if not self:
+            return
+
+        cls = self[0].__class__
+        if not hasattr(cls, 'get_metadata'):
+            return
+
+        options = []
+        metadata = cls.get_metadata()
+        if name in metadata.relationships:
+            uselist = getattr(cls, name).property.uselist
+            loader = cls.get_relationship_loader(name, uselist)
+            options.append(getattr(orm, loader)(getattr(cls, name)))
+        elif name not in metadata.columns:
+            return
+
+        key = name
+        if name in cls.hybrid_property_columns:
+            key = anyblok_column_prefix + name
+
+        identities = []
+        for element in self:
+            if element.__class__ is not cls:
+                continue
+
+            state = inspect(element)
+            if state.identity is not None and key in state.unloaded:
+                identities.append(state.identity)
+
+        if len(identities) > 1:
+            list(cls._query_from_identities(identities, *options))
+
+    def __getattr__(self, name):
         if not self:
             return []
-        elif hasattr(getattr(self[0], name), '__call__'):
-            return wrapper
+        elif self.is_method(name):
+            return partial(self.call, name)
         else:
-            return [getattr(x, name) for x in self]
+            return self.pluck(name)
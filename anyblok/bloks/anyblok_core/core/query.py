@@ -7,7 +7,13 @@
 # obtain one at http://mozilla.org/MPL/2.0/.
 from anyblok import Declarations
 from anyblok.common import anyblok_column_prefix
+from anyblok.column import Column
 from sqlalchemy.orm import query
+from sqlalchemy import inspect, types, tuple_
+from collections import OrderedDict
+from array import array
+from ..exceptions import QueryException
+from .sqlbase import freeze_to_dict_fields
 
 
 @Declarations.register(Declarations.Core)
@@ -60,13 +66,333 @@ class Query(query.Query):
         else:
             return val.to_dict()
 
-    def dictall(self):
-        vals = self.all()
+    def dictall(self, *fields):
+        """ Return the result of the query as a list of dict
+
+        If the query selects a model, the fields are the fields of
+        ``to_dict``, the relationships of the fields are eager loaded by
+        the query, one query by level of relationship::
+
+            MyModel.query().dictall('name', ('relation1', ('name', (
+                'relation', ('a', 'b')))))
+
+        :param fields: see ``SqlMixin.to_dict``
+        :rtype: list of dict
+        """
+        field2get = self.get_field_nams_in_column_description()
+        query = self
+        if not field2get:
+            Model = self.column_descriptions[0]['entity']
+            plan = Model.compile_to_dict(*freeze_to_dict_fields(fields))
+            options = Model.get_to_dict_load_options(plan)
+            if options:
+                query = query.options(*options)
+
+        vals = query.all()
         if not vals:
             return []
 
-        field2get = self.get_field_nams_in_column_description()
         if field2get:
             return [{x: getattr(y, z) for x, z in field2get} for y in vals]
         else:
-            return vals.to_dict()
+            return vals.to_dict(*fields)
+
+    def iter_batches(self, size=1000):
+        """ Iterate on the result of the query by batch, with a server side
+        cursor::
+
+            for instances in MyModel.query().iter_batches(500):
+                ...
+
+        When the next batch is asked, the not modified instances of the
+        previous batch are removed from the session, so the memory is
+        bounded by the size of the batch
+
+        :param size: number of entries by batch
+        :rtype: iterator of instrumented list
+        """
+        query = self.yield_per(size).execution_options(stream_results=True)
+        batch = []
+        for entry in query:
+            batch.append(entry)
+            if len(batch) == size:
+                yield self.registry.InstrumentedList(batch)
+                self.release_batch(batch)
+                batch = []
+
+        if batch:
+            yield self.registry.InstrumentedList(batch)
+            self.release_batch(batch)
+
+    def release_batch(self, batch):
+        """ Remove from the session the instances of the batch which are not
+        modified
+
+        :param batch: list of entries returned by the query
+        """
+        session = self.session
+        for entry in batch:
+            if not hasattr(entry, '_sa_instance_state'):
+                continue
+
+            if entry in session and entry not in session.dirty:
+                session.expunge(entry)
+
+    def dictiter(self, *fields, size=1000):
+        """ Iterate on the result of the query as dict, like ``dictall``
+        but with a bounded memory, see ``iter_batches``::
+
+            for entry in MyModel.query().dictiter('name', ('relation1', (
+                    'name',)), size=500):
+                ...
+
+        The relationships of the fields are loaded by batch, one query by
+        level of relationship, see ``records_to_dict``
+
+        :param fields: see ``SqlMixin.to_dict``
+        :param size: number of entries read by batch
+        :rtype: iterator of dict
+        """
+        field2get = self.get_field_nams_in_column_description()
+        if not field2get:
+            Model = self.column_descriptions[0]['entity']
+
+        for batch in self.iter_batches(size):
+            if field2get:
+                for entry in batch:
+                    yield {x: getattr(entry, y) for x, y in field2get}
+            else:
+                for values in Model.records_to_dict(batch, *fields):
+                    yield values
+
+    def get_column_typecode(self, sqlalchemy_type):
+        """ Return the typecode of ``array.array`` for the type of the
+        column, None if the values can not be stored in an array. The
+        Decimal values are not stored in an array, to keep their precision
+
+        :param sqlalchemy_type: instance of the SQLAlchemy type
+        :rtype: str or None
+        """
+        if isinstance(sqlalchemy_type, types.TypeDecorator):
+            sqlalchemy_type = sqlalchemy_type.impl
+
+        if isinstance(sqlalchemy_type, types.Boolean):
+            return 'b'
+        elif isinstance(sqlalchemy_type, types.Integer):
+            return 'q'
+        elif isinstance(sqlalchemy_type, types.Numeric):
+            return None if sqlalchemy_type.asdecimal else 'd'
+
+        return None
+
+    def columns(self, *fields, size=10000, as_numpy=False):
+        """ Return the values of the fields by column, without instanciate
+        the models::
+
+            res = MyModel.query().filter(...).columns('id', 'amount')
+            sum(res['amount'])
+
+        The rows are read from the cursor by chunk of ``size`` rows. The
+        integer, float and boolean columns are returned as ``array.array``,
+        the other columns (Decimal, ...) and the columns with NULL values are
+        returned as list. With ``as_numpy=True`` all the columns are returned
+        as NumPy arrays, NumPy must be installed
+
+        :param fields: names of the fields, or SQLAlchemy columns
+        :param size: number of rows read by chunk
+        :param as_numpy: if True return NumPy arrays
+        :rtype: OrderedDict {field name: values}
+        :exception: QueryException
+        """
+        if not fields:
+            raise QueryException("No field to fetch")
+
+        Model = self.column_descriptions[0]['entity']
+        query = self.with_entities(*[
+            getattr(Model, x).label(x) if isinstance(x, str) else x
+            for x in fields])
+
+        names = []
+        res = []
+        for description in query.column_descriptions:
+            names.append(description['name'])
+            typecode = self.get_column_typecode(description['type'])
+            res.append(array(typecode) if typecode else [])
+
+        result = self.session.execute(query.statement)
+        rows = result.fetchmany(size)
+        while rows:
+            for index, values in enumerate(zip(*rows)):
+                if isinstance(res[index], array) and None in values:
+                    res[index] = res[index].tolist()
+
+                res[index].extend(values)
+
+            rows = result.fetchmany(size)
+
+        if as_numpy:
+            try:
+                import numpy
+            except ImportError:
+                raise QueryException("NumPy is not installed")
+
+            res = [numpy.frombuffer(x, dtype=x.typecode)
+                   if isinstance(x, array) else numpy.array(x)
+                   for x in res]
+
+        return OrderedDict(zip(names, res))
+
+    def get_model_to_write(self):
+        """ Return the model of the query, used by ``update_all`` and
+        ``delete_all``
+
+        :rtype: the AnyBlok model
+        :exception: QueryException
+        """
+        entities = [x['expr'] for x in self.column_descriptions]
+        if len(entities) != 1 or not hasattr(entities[0], 'find_relationship'):
+            raise QueryException(
+                "The query must only select one SQL model (not a view), not "
+                "%r" % entities)
+
+        return entities[0]
+
+    def get_affected_instances(self, Model):
+        """ Return the instances of the session selected by the query
+
+        The primary keys are only selected if the session has got instances
+        of the model
+
+        :param Model: the AnyBlok model of the query
+        :rtype: list of the instances
+        """
+        instances = {}
+        for instance in self.session.identity_map.values():
+            if isinstance(instance, Model):
+                instances[inspect(instance).identity] = instance
+
+        if not instances:
+            return []
+
+        mapper = inspect(Model)
+        # the ORDER BY on a column not selected is forbidden with DISTINCT
+        query = self.with_entities(*mapper.primary_key).order_by(None)
+        query = query.distinct()
+        return [instances[tuple(x)] for x in query
+                if tuple(x) in instances]
+
+    def expire_related_attributes(self, Model, instances, fields):
+        """ Expire the related attributes of the instances, in function of
+        ``registry.expire_attributes``
+
+        :param Model: the AnyBlok model of the query
+        :param instances: instances to expire
+        :param fields: names of the modified fields
+        """
+        model = self.registry.loaded_namespaces_first_step[
+            Model.__registry_name__]
+        expire_attributes = self.registry.expire_attributes.get(
+            Model.__registry_name__, {})
+        for field in fields:
+            action_todos = expire_attributes.get(field)
+            if action_todos:
+                for instance in instances:
+                    model[field].expire_related_attribute(
+                        instance, action_todos)
+
+    def update_all(self, **values):
+        """ Update all the entries selected by the query with one SQL
+        statement::
+
+            MyModel.query().filter(...).update_all(name='foo')
+
+        The values are formated by the columns, only the instances of the
+        session selected by the query and their related attributes are
+        expired
+
+        :param values: dict {column name: value}
+        :rtype: number of updated entries
+        :exception: QueryException
+        """
+        if not values:
+            return 0
+
+        Model = self.get_model_to_write()
+        model = self.registry.loaded_namespaces_first_step[
+            Model.__registry_name__]
+        metadata = Model.get_metadata()
+        sql_values = {}
+        for name, value in values.items():
+            if name not in metadata.columns:
+                raise QueryException(
+                    "%r is not a column of %r, update_all only accept "
+                    "columns" % (name, Model.__registry_name__))
+
+            if isinstance(model[name], Column):
+                value = model[name].setter_format_value(value)
+
+            sql_values[getattr(Model, name)] = value
+
+        fields = list(values.keys())
+        instances = self.get_affected_instances(Model)
+        res = self.update(sql_values, synchronize_session=False)
+        for instance in instances:
+            self.registry.expire(instance, Model.find_relationship(*fields))
+
+        self.expire_related_attributes(Model, instances, fields)
+        self.registry.cache_manager.invalidate_models(
+            *[x.class_.__registry_name__
+              for x in inspect(Model).self_and_descendants])
+        return res
+
+    def delete_many2many_links(self, Model):
+        """ Delete the rows of the Many2Many join tables linked with the
+        entries selected by the query, ``Query.delete`` does not do it
+
+        :param Model: the AnyBlok model of the query
+        """
+        for relationship in inspect(Model).relationships:
+            if relationship.secondary is None:
+                continue
+
+            local_columns = [x for x, _ in relationship.synchronize_pairs]
+            m2m_columns = [y for _, y in relationship.synchronize_pairs]
+            query = self.with_entities(*local_columns).order_by(None)
+            if len(m2m_columns) == 1:
+                where = m2m_columns[0].in_(query.statement)
+            else:
+                where = tuple_(*m2m_columns).in_(query.statement)
+
+            self.session.execute(relationship.secondary.delete().where(where))
+
+    def delete_all(self):
+        """ Delete all the entries selected by the query with one SQL
+        statement::
+
+            MyModel.query().filter(...).delete_all()
+
+        Only the instances of the session selected by the query and their
+        related attributes are expired, then the instances are removed from
+        the session. The rows of the Many2Many join tables are deleted before
+
+        :rtype: number of deleted entries
+        :exception: QueryException
+        """
+        Model = self.get_model_to_write()
+        self.delete_many2many_links(Model)
+        instances = self.get_affected_instances(Model)
+        if instances:
+            model = self.registry.loaded_namespaces_first_step[
+                Model.__registry_name__]
+            mappers = Model.find_remote_attribute_to_expire(*model.keys())
+            for instance in instances:
+                instance.expire_relationship_mapped(mappers)
+
+        res = self.delete(synchronize_session=False)
+        for instance in instances:
+            self.session.expunge(instance)
+
+        self.registry.cache_manager.invalidate_models(
+            *[x.class_.__registry_name__
+              for x in inspect(Model).self_and_descendants])
+        return res
@@ -6,14 +6,17 @@
 # v. 2.0. If a copy of the MPL was not distributed with this file,You can
 # obtain one at http://mozilla.org/MPL/2.0/.
 from anyblok.declarations import Declarations, classmethod_cache
+from anyblok.config import Configuration
 from anyblok.field import FieldException
 from anyblok.column import Column
 from anyblok.mapper import FakeColumn, FakeRelationShip
-from anyblok.relationship import RelationShip, Many2Many
+from anyblok.model import ModelMetadata
+from anyblok.relationship import RelationShip, Many2Many, Many2One, One2Many
 from ..exceptions import SqlBaseException
 from sqlalchemy.orm import aliased, ColumnProperty
-from sqlalchemy.sql.expression import true
-from sqlalchemy import or_, and_
+from sqlalchemy import orm
+from sqlalchemy import or_, and_, tuple_, inspect, text
+from collections import OrderedDict
 
 
 class uniquedict(dict):
@@ -100,20 +103,27 @@ class SqlMixin:
     def from_primary_keys(cls, **pks):
         """ return the instance of the model from the primary keys
 
+        The instance is taken in the identity map of the session if it is
+        already loaded, else it is loaded by one query
+
         :param \*\*pks: dict {primary_key: value, ...}
         :rtype: instance of the model
         """
         where_clause = cls.get_where_clause_from_primary_keys(**pks)
-        query = cls.query().filter(*where_clause)
-        if query.count():
-            return query.first()
+        primary_keys = cls.get_metadata().primary_keys
+        if len(pks) != len(primary_keys):
+            return cls.query().filter(*where_clause).first()
 
-        return None
+        return cls.query().get(tuple(pks[pk] for pk in primary_keys))
 
     @classmethod
     def from_multi_primary_keys(cls, *pks):
         """ return the instances of the model from the primary keys
 
+        The instances already loaded are taken in the identity map of the
+        session, the others are loaded by one query by chunk of
+        ``db_in_chunk_size`` primary keys
+
         :param \*pks: list of dict [{primary_key: value, ...}]
         :rtype: instances of the model
         """
@@ -124,13 +134,61 @@ class SqlMixin:
         if not where_clause:
             return []
 
-        where_clause = or_(*[and_(*x) for x in where_clause])
+        primary_keys = cls.get_metadata().primary_keys
+        if any(len(_pks) != len(primary_keys) for _pks in pks):
+            where_clause = or_(*[and_(*x) for x in where_clause])
+            return cls.query().filter(where_clause).all()
+
+        mapper = inspect(cls)
+        identity_map = cls.registry.session.identity_map
+        found = OrderedDict()
+        for _pks in pks:
+            identity = tuple(_pks[pk] for pk in primary_keys)
+            if identity in found:
+                continue
+
+            key = mapper.identity_key_from_primary_key(identity)
+            instance = identity_map.get(key)
+            if instance is not None and not isinstance(instance, cls):
+                instance = None
+            elif instance is not None and inspect(instance).expired:
+                instance = None
+
+            found[identity] = instance
 
-        query = cls.query().filter(where_clause)
-        if query.count():
-            return query.all()
+        missing = [x for x, y in found.items() if y is None]
+        for instance in cls._query_from_identities(missing):
+            found[inspect(instance).identity] = instance
 
-        return []
+        return cls.registry.InstrumentedList(
+            x for x in found.values() if x is not None)
+
+    @classmethod
+    def _query_from_identities(cls, identities, *options):
+        """ Load the instances by chunk of ``db_in_chunk_size`` identities,
+        with an IN clause on the primary key or on the tuple of the primary
+        keys
+
+        :param identities: list of tuple of the primary keys values
+        :param options: loader options of the query
+        :rtype: iterator of the instances
+        """
+        primary_keys = cls.get_metadata().primary_keys
+        if len(primary_keys) == 1:
+            column = getattr(cls, primary_keys[0])
+            identities = [x[0] for x in identities]
+        else:
+            column = tuple_(*[getattr(cls, pk) for pk in primary_keys])
+
+        chunk_size = Configuration.get('db_in_chunk_size') or 1000
+        for i in range(0, len(identities), chunk_size):
+            query = cls.query().filter(
+                column.in_(identities[i:i + chunk_size]))
+            if options:
+                query = query.options(*options)
+
+            for instance in query:
+                yield instance
 
     def to_primary_keys(self):
         """ return the primary keys and values for this instance
@@ -140,18 +198,28 @@ class SqlMixin:
         pks = self.get_primary_keys()
         return {x: getattr(self, x) for x in pks}
 
+    @classmethod
+    def get_metadata(cls):
+        """ return the metadata of the model, computed once by assembly
+        of the registry
+
+        :rtype: ``anyblok.model.ModelMetadata`` instance
+        """
+        models_metadata = cls.registry.models_metadata
+        metadata = models_metadata.get(cls.__registry_name__)
+        if metadata is None:
+            metadata = ModelMetadata(cls.registry, cls)
+            models_metadata[cls.__registry_name__] = metadata
+
+        return metadata
+
     @classmethod
     def get_primary_keys(cls):
         """ return the name of the primary keys of the model
 
         :type: list of the primary keys name
         """
-        C = cls.registry.System.Column
-        model = cls.__registry_name__
-        query = C.query()
-        query = query.filter(C.model == model)
-        query = query.filter(C.primary_key == true())
-        return query.all().name
+        return list(cls.get_metadata().primary_keys)
 
     @classmethod_cache()
     def _fields_description(cls):
@@ -168,7 +236,8 @@ class SqlMixin:
 
         return res
 
-    def _format_field(self, field):
+    @classmethod
+    def _format_field(cls, field):
         related_fields = None
         if isinstance(field, (tuple, list)):
             if len(field) == 1:
@@ -258,45 +327,218 @@ class SqlMixin:
                  ]}
              }
         """
-        result = {}
-        cls = self.__class__
-        fields = fields if fields else cls.fields_description().keys()
+        plan = self.compile_to_dict(*freeze_to_dict_fields(fields))
+        return self._to_dict_from_plan(plan)
 
+    @classmethod_cache()
+    def compile_to_dict(cls, *fields):
+        """ Compile the fields wanted by ``to_dict`` to a plan, the plan is
+        cached by model and fields
+
+        :param fields: hashable fields, see ``to_dict``
+        :rtype: tuple of (field name, remote registry name, related plan,
+            uselist, related fields), all but the field name are None if
+            the field is not a relationship
+        :exception: SqlBaseException
+        """
+        plan = []
+        fields = fields if fields else cls.fields_description().keys()
         for field in fields:
             # if field is ("relation_name", ("list", "of", "relation",
             # "fields")), deal with it.
-            field, related_fields = self._format_field(field)
-            # Get the actual data
-            field_value, field_property = getattr(self, field), None
+            field, related_fields = cls._format_field(field)
+            field_property = None
             try:
                 field_property = getattr(getattr(cls, field), 'property', None)
             except FieldException:
                 pass
 
-            # Deal with this data
-            if field_property is None:
-                # it is the case of field function (hyprid property)
-                result[field] = field_value
-            elif field_value is None or type(field_property) == ColumnProperty:
-                # If value is None, then do not go any further whatever
-                # the column property tells you.
-                result[field] = field_value
+            if field_property is None or type(field_property) == ColumnProperty:
+                # it is the case of field function (hyprid property) or
+                # of column
+                plan.append((field, None, None, None, None))
             else:
                 # it is should be RelationshipProperty
+                Remote = field_property.mapper.entity
                 if related_fields is None:
                     # If there is no field list to the relation,
                     # use only primary keys
-                    related_fields = field_property.mapper.entity
-                    related_fields = related_fields.get_primary_keys()
-                # One2One, One2Many, Many2One or Many2Many ?
-                if field_property.uselist:
-                    result[field] = [r.to_dict(*related_fields)
-                                     for r in field_value]
-                else:
-                    result[field] = field_value.to_dict(*related_fields)
+                    related_fields = Remote.get_primary_keys()
+
+                related_fields = freeze_to_dict_fields(related_fields)
+                related_plan = Remote.compile_to_dict(*related_fields)
+                plan.append((field, Remote.__registry_name__, related_plan,
+                             field_property.uselist, related_fields))
+
+        return tuple(plan)
+
+    def _to_dict_from_plan(self, plan):
+        result = {}
+        for field, remote, related_plan, uselist, related_fields in plan:
+            field_value = getattr(self, field)
+            if related_plan is None or field_value is None:
+                result[field] = field_value
+            elif uselist:
+                result[field] = [r._related_to_dict(related_plan,
+                                                    related_fields)
+                                 for r in field_value]
+            else:
+                result[field] = field_value._related_to_dict(related_plan,
+                                                             related_fields)
 
         return result
 
+    def _related_to_dict(self, plan, fields):
+        if has_own_to_dict(self.__class__):
+            return self.to_dict(*fields)
+
+        return self._to_dict_from_plan(plan)
+
+    @classmethod
+    def load_to_dict_relationships(cls, records, plan):
+        """ Load the relationships of the plan not loaded yet, for all the
+        records, by one query by chunk of records and one query by
+        relationship, then do the same for the related records
+
+        :param records: instances of the model
+        :param plan: plan returned by ``compile_to_dict``
+        """
+        relationships = [(field, remote, related_plan)
+                         for field, remote, related_plan, _, _ in plan
+                         if related_plan is not None]
+        if not relationships or not records:
+            return
+
+        to_load = set()
+        identities = []
+        for record in records:
+            state = inspect(record)
+            unloaded = [x for x, _, _ in relationships
+                        if x in state.unloaded]
+            if unloaded and state.identity is not None:
+                to_load.update(unloaded)
+                identities.append(state.identity)
+
+        if to_load:
+            options = [getattr(orm, select_in_loader)(getattr(cls, x))
+                       for x in to_load]
+            list(cls._query_from_identities(identities, *options))
+
+        for field, remote, related_plan in relationships:
+            Remote = cls.registry.get(remote)
+            Remote.load_to_dict_relationships(
+                get_related_records(records, field), related_plan)
+
+    @classmethod
+    def get_relationship_loader(cls, field, uselist):
+        """ Return the name of the SQLAlchemy loader to eager load the
+        relationship: ``joinedload`` for Many2One and One2One, a select IN
+        (``selectinload`` or ``subqueryload`` for the old SQLAlchemy) for
+        One2Many and Many2Many
+
+        :param field: name of the relationship
+        :param uselist: True if the relationship is a list
+        :rtype: str
+        """
+        model = get_model_information(cls.registry, cls.__registry_name__)
+        field = model.get(field)
+        if isinstance(field, Many2One):
+            return 'joinedload'
+        elif isinstance(field, (One2Many, Many2Many)):
+            return select_in_loader
+        elif uselist:
+            return select_in_loader
+
+        return 'joinedload'
+
+    @classmethod
+    def get_to_dict_load_options(cls, plan, parent=None):
+        """ Return the loader options of the query to load all the
+        relationships of the plan, one query by level
+
+        :param plan: plan returned by ``compile_to_dict``
+        :param parent: loader option of the relationship of the parent model
+        :rtype: list of loader options
+        """
+        options = []
+        for field, remote, related_plan, uselist, related_fields in plan:
+            if related_plan is None:
+                continue
+
+            loader = cls.get_relationship_loader(field, uselist)
+            loader = getattr(orm if parent is None else parent, loader)
+            option = loader(getattr(cls, field))
+            options.append(option)
+            Remote = cls.registry.get(remote)
+            options.extend(
+                Remote.get_to_dict_load_options(related_plan, parent=option))
+
+        return options
+
+    @classmethod
+    def records_to_dict(cls, records, *fields):
+        """ Transform the records to the list of dict of value, like
+        ``to_dict``, but the relationships of all the records are loaded
+        together by ``load_to_dict_relationships``
+
+        :param records: instances of the model
+        :param fields: see ``to_dict``
+        :rtype: list of dict
+        """
+        plan = cls.compile_to_dict(*freeze_to_dict_fields(fields))
+        cls.load_to_dict_relationships(records, plan)
+        if has_own_to_dict(cls):
+            return [x.to_dict(*fields) for x in records]
+
+        return [x._to_dict_from_plan(plan) for x in records]
+
+
+select_in_loader = ('selectinload' if hasattr(orm, 'selectinload')
+                    else 'subqueryload')
+
+
+def get_related_records(records, field):
+    """ Return the distinct related records of the records
+
+    :param records: instances of the model
+    :param field: name of the relationship
+    :rtype: list of the related instances
+    """
+    related = OrderedDict()
+    for record in records:
+        values = getattr(record, field)
+        if not isinstance(values, list):
+            values = [values]
+
+        for value in values:
+            if value is not None:
+                related[id(value)] = value
+
+    return list(related.values())
+
+
+def freeze_to_dict_fields(fields):
+    """ Return the fields of ``to_dict`` with tuple instead of list, to
+    be hashable
+
+    :param fields: fields of ``to_dict``
+    :rtype: tuple
+    """
+    if not isinstance(fields, (tuple, list)):
+        return fields
+
+    return tuple(freeze_to_dict_fields(x) for x in fields)
+
+
+def has_own_to_dict(cls):
+    """ Return True if the model overloads ``to_dict``, then the plan of
+    ``compile_to_dict`` must not be used instead of its ``to_dict``
+
+    :param cls: model
+    :rtype: bool
+    """
+    return getattr(cls, 'to_dict', None) is not SqlMixin.to_dict
+
 
 def get_model_information(registry, registry_name):
     model = registry.loaded_namespaces_first_step[registry_name]
@@ -329,6 +571,9 @@ class SqlBase(SqlMixin):
         for x, v in values.items():
             setattr(self, x, v)
 
+        if values:
+            self.registry.cache_manager.invalidate_record(self)
+
         return 1 if values else 0
 
     @classmethod_cache()
@@ -456,6 +701,7 @@ class SqlBase(SqlMixin):
         fields = model.keys()
         mappers = self.__class__.find_remote_attribute_to_expire(*fields)
         self.expire_relationship_mapped(mappers)
+        self.registry.cache_manager.invalidate_record(self)
         self.registry.session.delete(self)
         if flush:
             self.registry.flush()
@@ -479,20 +725,41 @@ class SqlBase(SqlMixin):
         return instance
 
     @classmethod
-    def multi_insert(cls, *args):
+    def multi_insert(cls, *args, bulk=False, return_instances=True):
         """ Insert in the table one or more entry of the model::
 
             MyModel.multi_insert([{...}, ...])
 
         the flush will be done only one time at the end of the insert
 
+        With ``bulk=True`` the entries are inserted by the SQLAlchemy Core,
+        by chunk of ``db_bulk_chunk_size`` entries, without instanciate
+        them. The values are formated by the columns (Selection validation,
+        ...) and the default values of the columns are applied, but the
+        values must be columns, and the ORM events are not fired::
+
+            pks = MyModel.multi_insert(*values, bulk=True,
+                                       return_instances=False)
+
+        :param bulk: if True insert by the SQLAlchemy Core
+        :param return_instances: if False and bulk is True, only the primary
+            keys are returned
+        :rtype: instances or list of dict {primary_key: value, ...}
         :exception: SqlBaseException
         """
-        instances = cls.registry.InstrumentedList()
         for kwargs in args:
             if not isinstance(kwargs, dict):
                 raise SqlBaseException("multi_insert method wait list of dict")
 
+        if bulk:
+            pks = cls.bulk_insert(*args)
+            if return_instances:
+                return cls.from_multi_primary_keys(*pks)
+
+            return pks
+
+        instances = cls.registry.InstrumentedList()
+        for kwargs in args:
             instance = cls(**kwargs)
             cls.registry.add(instance)
             instances.append(instance)
@@ -502,6 +769,106 @@ class SqlBase(SqlMixin):
 
         return instances
 
+    @classmethod
+    def bulk_format_values(cls, values):
+        """ Return the values to insert by the SQLAlchemy Core, formated
+        by the columns and indexed by the key of the columns
+
+        :param values: dict {column name: value}
+        :rtype: dict {column key: value}
+        :exception: SqlBaseException
+        """
+        metadata = cls.get_metadata()
+        fsp = cls.registry.loaded_namespaces_first_step[cls.__registry_name__]
+        res = {}
+        for name, value in values.items():
+            if name not in metadata.columns:
+                raise SqlBaseException(
+                    "%r is not a column of %r, the bulk insert only accept "
+                    "columns" % (name, cls.__registry_name__))
+
+            field = fsp[name]
+            if isinstance(field, Column):
+                value = field.setter_format_value(value)
+
+            res[metadata.columns[name].key] = value
+
+        return res
+
+    @classmethod
+    def bulk_insert(cls, *args):
+        """ Insert the entries by the SQLAlchemy Core, without the ORM
+
+        The entries with the same columns are inserted by one INSERT with
+        multiple VALUES, by chunk of ``db_bulk_chunk_size``. The primary keys
+        not given are taken before the INSERT from the sequence of the
+        primary key, so the primary keys are returned in the order of the
+        entries. Without sequence, the entries are inserted one by one
+
+        :param args: list of dict {column name: value}
+        :rtype: list of dict {primary_key: value, ...}
+        :exception: SqlBaseException
+        """
+        mapper = inspect(cls)
+        if len(mapper.tables) > 1:
+            raise SqlBaseException(
+                "The bulk insert is only available for the model with one "
+                "table, %r" % cls.__registry_name__)
+
+        primary_keys = cls.get_metadata().primary_keys
+        columns = mapper.primary_key
+        table = mapper.local_table
+        rows = [cls.bulk_format_values(values) for values in args]
+        cls.bulk_set_primary_keys(
+            [x for x in rows if any(c.key not in x for c in columns)])
+
+        pks = []
+        groups = OrderedDict()
+        for values in rows:
+            if any(c.key not in values for c in columns):
+                pk = cls.registry.execute(
+                    table.insert(), values).inserted_primary_key
+                pks.append(dict(zip(primary_keys, pk)))
+            else:
+                groups.setdefault(tuple(sorted(values)), []).append(values)
+                pks.append(dict(zip(primary_keys,
+                                    [values[c.key] for c in columns])))
+
+        chunk_size = Configuration.get('db_bulk_chunk_size') or 1000
+        for group in groups.values():
+            for i in range(0, len(group), chunk_size):
+                cls.registry.execute(
+                    table.insert().values(group[i:i + chunk_size]))
+
+        return pks
+
+    @classmethod
+    def bulk_set_primary_keys(cls, rows):
+        """ Set the primary key taken from its sequence in the rows, only
+        for PostgreSQL and the primary keys with one column
+
+        :param rows: list of dict {column key: value} without primary key
+        """
+        columns = inspect(cls).primary_key
+        if not rows or len(columns) != 1:
+            return
+        elif cls.registry.engine.dialect.name != 'postgresql':
+            return
+
+        column = columns[0]
+        sequence = cls.registry.execute(
+            text("SELECT pg_get_serial_sequence(:table, :column)"),
+            dict(table=column.table.name, column=column.name)).scalar()
+        if sequence is None:
+            return
+
+        query = text("SELECT nextval(:sequence) "
+                     "FROM generate_series(1, :nb)")
+        res = cls.registry.execute(query, dict(sequence=sequence,
+                                               nb=len(rows)))
+        for values, (pk,) in zip(rows, res.fetchall()):
+            values[column.key] = pk
+
     @classmethod
     def precommit_hook(cls, method, *args, **kwargs):
         """ Same in the registry a hook to call just before the commit
@@ -27,7 +27,9 @@ class Attribute:
                     'precommit_hook', 'multi_insert', 'initialize_model',
                     'has_perm', 'has_model_perm',
                     'get_where_clause_from_primary_keys', 'get_primary_keys',
-                    'get_model', 'from_primary_keys',
+                    'get_metadata', 'get_model', 'compile_to_dict',
+                    'records_to_dict', 'load_to_dict_relationships',
+                    'from_primary_keys',
                     'from_multi_primary_keys', 'fire', 'fields_description',
                     '_fields_description', 'delete', 'aliased', '__init__',
                     'loaded_columns', 'loaded_fields', 'registry',
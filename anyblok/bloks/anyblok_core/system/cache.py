@@ -7,6 +7,7 @@
 # obtain one at http://mozilla.org/MPL/2.0/.
 from anyblok.declarations import Declarations
 from anyblok.column import String, Integer
+from sqlalchemy import func
 from ..exceptions import CacheException
 
 
@@ -16,6 +17,13 @@ System = Declarations.Model.System
 
 @register(System)
 class Cache:
+    """ Invalidations of the cached methods
+
+    Only the latest invalidation by ``(registry_name, method)`` is kept, its
+    ``id`` is the generation of the cached method. A registry which has not
+    seen an older invalidation will see the latest one, so the number of rows
+    is bounded by the number of cached methods.
+    """
 
     last_cache_id = None
     lrus = {}
@@ -50,6 +58,10 @@ class Cache:
 
         if res:
             cls.multi_insert(*res)
+            cls.compact()
+            transport = cls.registry.cache_invalidation_transport
+            for vals in res:
+                transport.publish(vals['registry_name'], vals['method'])
 
         cls.clear_invalidate_cache()
 
@@ -63,10 +75,15 @@ class Cache:
         """
         caches = cls.registry.caches
 
+        transport = cls.registry.cache_invalidation_transport
+
         def insert(registry_name=None, method=None):
             if registry_name in caches:
                 if method in caches[registry_name]:
-                    cls.insert(registry_name=registry_name, method=method)
+                    cache = cls.insert(registry_name=registry_name,
+                                       method=method)
+                    cls.remove_older_invalidations(cache)
+                    transport.publish(registry_name, method)
                 else:
                     raise CacheException(
                         "Unknown cached method %r" % method)
@@ -82,6 +99,46 @@ class Cache:
 
         cls.clear_invalidate_cache()
 
+    @classmethod
+    def invalidate_records(cls, registry_name):
+        """ Invalidate the methods cached by record of the model, called
+        at the commit of the transaction which updated or deleted records
+        of the model. The other registries do not know the records, they
+        forget all the values of these methods
+
+        :param registry_name: namespace of the model
+        """
+        methods = set(
+            x.attr for x in cls.registry.cache_manager.record_method_caches
+            if x.namespace == registry_name)
+        for method in sorted(methods):
+            cls.invalidate(registry_name, method)
+
+    @classmethod
+    def remove_older_invalidations(cls, cache):
+        """ Remove the invalidations of the same cached method, done
+        before this one
+
+        :param cache: instance of the invalidation to keep
+        """
+        query = cls.query().filter(cls.registry_name == cache.registry_name)
+        query = query.filter(cls.method == cache.method)
+        query = query.filter(cls.id < cache.id)
+        query.delete(synchronize_session=False)
+
+    @classmethod
+    def compact(cls):
+        """ Keep only the latest invalidation by ``(registry_name, method)``
+
+        The compaction is done at each invalidation, this method is called
+        by the update of the ``anyblok-core`` blok to compact the rows
+        inserted before. It can also be called by a ``Model.System.Cron.Job``
+        """
+        latest = cls.query(func.max(cls.id))
+        latest = latest.group_by(cls.registry_name, cls.method)
+        query = cls.query().filter(cls.id.notin_(latest))
+        query.delete(synchronize_session=False)
+
     @classmethod
     def detect_invalidation(cls):
         """ Return True if a new invalidation is found in the table
@@ -90,17 +147,38 @@ class Cache:
         """
         return cls.last_cache_id < cls.get_last_id()
 
+    @classmethod
+    def get_pushed_invalidation(cls):
+        """ Return the pointer of the method to invalidate, from the
+        events pushed by the cache invalidation transport, without query
+        """
+        res = []
+        caches = cls.registry.caches
+        for registry_name, method in set(
+            cls.registry.cache_invalidation_transport.receive()
+        ):
+            res.extend(caches.get(registry_name, {}).get(method, []))
+
+        return res
+
     @classmethod
     def get_invalidation(cls):
         """ Return the pointer of the method to invalidate
+
+        If the cache invalidation transport listens the invalidations, then
+        the ``system_cache`` table is not polled
         """
+        if cls.registry.cache_invalidation_transport.is_listening():
+            return cls.get_pushed_invalidation()
+
         res = []
         if cls.detect_invalidation():
             caches = cls.registry.caches
-            for i in cls.query().filter(cls.id > cls.last_cache_id).all():
-                res.extend(caches[i.registry_name][i.method])
-
-            cls.last_cache_id = cls.get_last_id()
+            query = cls.query('id', 'registry_name', 'method')
+            query = query.filter(cls.id > cls.last_cache_id)
+            for id_, registry_name, method in query.all():
+                res.extend(caches.get(registry_name, {}).get(method, []))
+                cls.last_cache_id = max(cls.last_cache_id, id_)
 
         return res
 
@@ -43,14 +43,15 @@ class Column(System.Field):
         return cname
 
     @classmethod
-    def add_field(cls, cname, column, model, table, ftype):
-        """ Insert a column definition
+    def get_field_values(cls, cname, column, model, table, ftype):
+        """ Return the values of the rows which define the column
 
         :param cname: name of the column
         :param column: instance of the column
         :param model: namespace of the model
         :param table: name of the table of the model
         :param ftype: type of the AnyBlok Field
+        :rtype: list of dict
         """
         c = column.property.columns[0]
         vals = dict(autoincrement=c.autoincrement,
@@ -63,7 +64,20 @@ class Column(System.Field):
                     ftype=ftype,
                     remote_model=c.info.get('remote_model'),
                     unique=c.unique)
-        cls.insert(**vals)
+        return [vals]
+
+    @classmethod
+    def add_field(cls, cname, column, model, table, ftype):
+        """ Insert a column definition
+
+        :param cname: name of the column
+        :param column: instance of the column
+        :param model: namespace of the model
+        :param table: name of the table of the model
+        :param ftype: type of the AnyBlok Field
+        """
+        cls.multi_insert(*cls.get_field_values(cname, column, model, table,
+                                               ftype))
 
     @classmethod
     def alter_field(cls, column, meta_column, ftype):
@@ -67,6 +67,20 @@ class Field:
         c.update_description(self.registry, self.model, res)
         return res
 
+    @classmethod
+    def get_field_values(cls, rname, label, model, table, ftype):
+        """ Return the values of the rows which define the field
+
+        :param rname: name of the field
+        :param label: label of the field
+        :param model: namespace of the model
+        :param table: name of the table of the model
+        :param ftype: type of the AnyBlok Field
+        :rtype: list of dict
+        """
+        return [dict(code=table + '.' + rname, model=model, name=rname,
+                     label=label, ftype=ftype)]
+
     @classmethod
     def add_field(cls, rname, label, model, table, ftype):
         """ Insert a field definition
@@ -77,8 +91,8 @@ class Field:
         :param table: name of the table of the model
         :param ftype: type of the AnyBlok Field
         """
-        cls.insert(code=table + '.' + rname, model=model, name=rname,
-                   label=label, ftype=ftype)
+        cls.multi_insert(*cls.get_field_values(rname, label, model, table,
+                                               ftype))
 
     @classmethod
     def alter_field(cls, field, label, ftype):
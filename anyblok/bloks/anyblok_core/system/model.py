@@ -8,6 +8,9 @@
 from anyblok.declarations import Declarations, listen
 from anyblok.field import Function
 from anyblok.column import String, Boolean
+from anyblok.blok import BlokManager
+from sqlalchemy import and_, bindparam, inspect, tuple_
+from hashlib import sha1
 from logging import getLogger
 
 logger = getLogger(__name__)
@@ -26,6 +29,8 @@ class Model:
 
         return self.name
 
+    schema_fingerprint_key = 'anyblok.system.model.schema'
+
     name = String(size=256, primary_key=True)
     table = String(size=256)
     is_sql_model = Boolean(label="Is a SQL model")
@@ -45,6 +50,7 @@ class Model:
         cls.registry.System.Cache.invalidate(model, '_fields_description')
         cls.registry.System.Cache.invalidate(
             model, 'find_remote_attribute_to_expire')
+        cls.registry.System.Cache.invalidate(model, 'compile_to_dict')
 
     @classmethod
     def get_field_model(cls, field):
@@ -68,57 +74,277 @@ class Model:
         return field, Field
 
     @classmethod
-    def update_fields(cls, model, table):
+    def get_model_schema(cls, model):
+        """ Return the values of the rows which define an assembled model
+        and its fields
+
+        :param model: namespace of the model
+        :rtype: tuple of the values of the model and the dict
+            {(model, field name): (Field model, values)}
+        """
         fsp = cls.registry.loaded_namespaces_first_step
         m = cls.registry.get(model)
+        table = ''
+        if hasattr(m, '__tablename__'):
+            table = m.__tablename__
+
+        values = dict(name=model, table=table,
+                      is_sql_model=len(m.loaded_columns) > 0)
+        fields = {}
         for cname in m.loaded_columns:
             ftype = fsp[model][cname].__class__.__name__
             field, Field = cls.get_field(m, cname)
             cname = Field.get_cname(field, cname)
-            query = Field.query()
-            query = query.filter(Field.model == model)
-            query = query.filter(Field.name == cname)
-            if query.count():
-                Field.alter_field(query.first(), field, ftype)
-            else:
-                Field.add_field(cname, field, model, table, ftype)
+            for field_values in Field.get_field_values(cname, field, model,
+                                                       table, ftype):
+                fields[(field_values['model'], field_values['name'])] = (
+                    Field, field_values)
 
-    @classmethod
-    def add_fields(cls, model, table):
-        fsp = cls.registry.loaded_namespaces_first_step
-        m = cls.registry.get(model)
-        is_sql_model = len(m.loaded_columns) > 0
-        cls.insert(name=model, table=table,
-                   is_sql_model=is_sql_model)
-        for cname in m.loaded_columns:
-            field, Field = cls.get_field(m, cname)
-            cname = Field.get_cname(field, cname)
-            ftype = fsp[model][cname].__class__.__name__
-            Field.add_field(cname, field, model, table, ftype)
+        return values, fields
 
     @classmethod
-    def update_list(cls):
-        """ Insert and update the table of models
+    def get_schema(cls):
+        """ Return the values of the rows which define the assembled models
+        and their fields, a model in error is logged and ignored
 
-        :exception: Exception
+        :rtype: tuple of the dict {model: values} and the dict
+            {(model, field name): (Field model, values)}
         """
+        models = {}
+        fields = {}
         for model in cls.registry.loaded_namespaces.keys():
             try:
                 # TODO need refactor, then try except pass whenever refactor
                 # not apply
-                m = cls.registry.get(model)
-                table = ''
-                if hasattr(m, '__tablename__'):
-                    table = m.__tablename__
-
-                _m = cls.query('name').filter(cls.name == model)
-                if _m.count():
-                    cls.update_fields(model, table)
-                else:
-                    cls.add_fields(model, table)
-
-                if m.loaded_columns:
-                    cls.fire('Update Model', model)
+                models[model], model_fields = cls.get_model_schema(model)
+            except Exception as e:
+                logger.exception(str(e))
+                continue
+
+            for key, (Field, values) in model_fields.items():
+                if values.get('remote') and key in fields:
+                    continue
+
+                fields[key] = (Field, values)
+
+        return models, fields
+
+    @classmethod
+    def get_existing_fields(cls):
+        """ Return the rows of the fields, one query by fields model
+
+        :rtype: dict {(model, field name): instance}
+        """
+        System = cls.registry.System
+        fields = {}
+        for Field in (System.Column, System.RelationShip, System.Field):
+            query = Field.query()
+            if Field is System.Field:
+                query = query.filter(
+                    Field.entity_type == Field.__registry_name__)
+
+            for field in query.all():
+                fields[(field.model, field.name)] = field
+
+        return fields
+
+    @classmethod
+    def get_modified_values(cls, row, values):
+        """ Return the values which are not the values of the row
+
+        :param row: instance to compare
+        :param values: dict of the values
+        :rtype: dict of the modified values
+        """
+        return {name: value for name, value in values.items()
+                if getattr(row, name) != value}
+
+    @classmethod
+    def bulk_update_rows(cls, Model, rows):
+        """ Update the rows of a model, by one executemany by table and by
+        modified columns, then the updated attributes are expired
+
+        :param Model: model of the rows
+        :param rows: list of tuple (instance, dict of the modified values)
+        """
+        params_by_statement = {}
+        for row, values in rows:
+            for table in inspect(Model).tables:
+                names = tuple(sorted(x for x in values if x in table.c))
+                if not names:
+                    continue
+
+                params = {'v_' + x: values[x] for x in names}
+                params.update({'pk_' + x.name: getattr(row, x.name)
+                               for x in table.primary_key.columns})
+                params_by_statement.setdefault((table, names), []).append(
+                    params)
+
+        for (table, names), params in params_by_statement.items():
+            query = table.update().where(and_(*[
+                x == bindparam('pk_' + x.name)
+                for x in table.primary_key.columns]))
+            query = query.values({x: bindparam('v_' + x) for x in names})
+            cls.registry.execute(query, params)
+
+        for row, values in rows:
+            cls.registry.expire(row, list(values.keys()))
+
+    @classmethod
+    def bulk_delete_rows(cls, Model, rows):
+        """ Delete the rows of a model, by one DELETE by table, the table of
+        the inherited model is the last one, then the instances are removed
+        from the session
+
+        :param Model: model of the rows
+        :param rows: list of instances
+        """
+        for table in reversed(inspect(Model).tables):
+            columns = list(table.primary_key.columns)
+            keys = [tuple(getattr(row, x.name) for x in columns)
+                    for row in rows]
+            cls.registry.execute(
+                table.delete().where(tuple_(*columns).in_(keys)))
+
+        for row in rows:
+            cls.registry.expunge(row)
+
+    @classmethod
+    def update_models(cls, models):
+        """ Insert and update the rows of the models
+
+        :param models: dict {model: values} given by ``get_schema``
+        :rtype: set of the modified models
+        """
+        modified_models = set()
+        existing_models = {x.name: x for x in cls.query().all()}
+        models_to_insert = []
+        models_to_update = []
+        for model, values in models.items():
+            if model not in existing_models:
+                models_to_insert.append(values)
+                modified_models.add(model)
+                continue
+
+            values = cls.get_modified_values(existing_models[model], values)
+            if values:
+                models_to_update.append((existing_models[model], values))
+                modified_models.add(model)
+
+        cls.multi_insert(*models_to_insert)
+        cls.bulk_update_rows(cls, models_to_update)
+        return modified_models
+
+    @classmethod
+    def update_fields(cls, models, fields):
+        """ Insert, update and delete the rows of the fields of the models
+
+        :param models: dict {model: values} given by ``get_schema``
+        :param fields: dict {(model, field name): (Field model, values)}
+            given by ``get_schema``
+        :rtype: set of the modified models
+        """
+        modified_models = set()
+        existing_fields = cls.get_existing_fields()
+        fields_to_delete = {}
+        for key, row in existing_fields.items():
+            if key[0] not in models:
+                # the model is not assembled by this registry
+                continue
+
+            if key not in fields or (
+                fields[key][0].__registry_name__ != row.__registry_name__
+            ):
+                fields_to_delete.setdefault(row.__registry_name__, []).append(
+                    row)
+                modified_models.add(key[0])
+
+        for Field, rows in fields_to_delete.items():
+            cls.bulk_delete_rows(cls.registry.get(Field), rows)
+
+        deleted_fields = set((x.model, x.name)
+                             for rows in fields_to_delete.values()
+                             for x in rows)
+        fields_to_insert = {}
+        fields_to_update = {}
+        for key, (Field, values) in fields.items():
+            if key not in existing_fields or key in deleted_fields:
+                fields_to_insert.setdefault(Field, []).append(values)
+                modified_models.add(key[0])
+                continue
+
+            values = cls.get_modified_values(existing_fields[key], values)
+            if values:
+                fields_to_update.setdefault(Field, []).append(
+                    (existing_fields[key], values))
+                modified_models.add(key[0])
+
+        for Field, values in fields_to_insert.items():
+            Field.multi_insert(*values)
 
+        for Field, rows in fields_to_update.items():
+            cls.bulk_update_rows(Field, rows)
+
+        return modified_models
+
+    @classmethod
+    def update_list(cls):
+        """ Insert, update and delete the rows of the models and of their
+        fields
+
+        The existing rows are loaded by one query by model, the differences
+        with ``get_schema`` are computed in memory, then the deletions, the
+        insertions and the updates are done in bulk
+        """
+        models, fields = cls.get_schema()
+        modified_models = cls.update_models(models)
+        modified_models |= cls.update_fields(models, fields)
+        cls.registry.flush()
+        for model in modified_models:
+            try:
+                if models[model]['is_sql_model']:
+                    cls.fire('Update Model', model)
             except Exception as e:
                 logger.exception(str(e))
+
+    @classmethod
+    def get_schema_fingerprint(cls):
+        """ Return the fingerprint of the assembled models, their fields and
+        the bloks, it changes when the System tables must be updated
+
+        :rtype: str
+        """
+        models, fields = cls.get_schema()
+        fingerprint = sha1()
+        for blok in BlokManager.ordered_bloks:
+            fingerprint.update(('%s:%s;' % (
+                blok, BlokManager.bloks[blok].version)).encode('utf-8'))
+
+        for model in sorted(models):
+            fingerprint.update(repr(sorted(
+                models[model].items())).encode('utf-8'))
+
+        for key in sorted(fields):
+            Field, values = fields[key]
+            fingerprint.update(Field.__registry_name__.encode('utf-8'))
+            fingerprint.update(repr(sorted(values.items())).encode('utf-8'))
+
+        return fingerprint.hexdigest()
+
+    @classmethod
+    def sync_schema(cls):
+        """ Update the models, the fields and the bloks, only if the
+        fingerprint of the schema is not the same as the fingerprint saved
+        by the last update
+        """
+        Parameter = cls.registry.System.Parameter
+        fingerprint = cls.get_schema_fingerprint()
+        key = cls.schema_fingerprint_key
+        if Parameter.is_exist(key) and Parameter.get(key) == fingerprint:
+            logger.info('The schema is unchanged, the models and the bloks '
+                        'are not updated')
+            return
+
+        cls.update_list()
+        cls.registry.update_blok_list()
+        Parameter.set(key, fingerprint)
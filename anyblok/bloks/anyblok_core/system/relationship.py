@@ -32,14 +32,16 @@ class RelationShip(System.Field):
         return res
 
     @classmethod
-    def add_field(cls, rname, relation, model, table, ftype):
-        """ Insert a relationship definition
+    def get_field_values(cls, rname, relation, model, table, ftype):
+        """ Return the values of the rows which define the relationship, and
+        the remote relationship if it has a remote name
 
         :param rname: name of the relationship
         :param relation: instance of the relationship
         :param model: namespace of the model
         :param table: name of the table of the model
         :param ftype: type of the AnyBlok Field
+        :rtype: list of dict
         """
         local_column = relation.info.get('local_column')
         remote_column = relation.info.get('remote_column')
@@ -53,7 +55,7 @@ class RelationShip(System.Field):
                     remote_model=remote_model, remote_name=remote_name,
                     remote_column=remote_column, label=label,
                     nullable=nullable, ftype=ftype)
-        cls.insert(**vals)
+        res = [vals]
 
         if remote_name:
             remote_type = "Many2One"
@@ -72,7 +74,22 @@ class RelationShip(System.Field):
                         remote_column=local_column,
                         label=remote_name.capitalize().replace('_', ' '),
                         nullable=True, ftype=remote_type, remote=True)
-            cls.insert(**vals)
+            res.append(vals)
+
+        return res
+
+    @classmethod
+    def add_field(cls, rname, relation, model, table, ftype):
+        """ Insert a relationship definition
+
+        :param rname: name of the relationship
+        :param relation: instance of the relationship
+        :param model: namespace of the model
+        :param table: name of the table of the model
+        :param ftype: type of the AnyBlok Field
+        """
+        cls.multi_insert(*cls.get_field_values(rname, relation, model, table,
+                                               ftype))
 
     @classmethod
     def alter_field(cls, field, label, ftype):
@@ -68,10 +68,10 @@ class Sequence:
         return super(Sequence, cls).insert(**cls.create_sequence(kwargs))
 
     @classmethod
-    def multi_insert(cls, *args):
+    def multi_insert(cls, *args, **kwargs):
         """ Overwrite multi_insert """
         res = [cls.create_sequence(x) for x in args]
-        return super(Sequence, cls).multi_insert(*res)
+        return super(Sequence, cls).multi_insert(*res, **kwargs)
 
     def nextval(self):
         """ return the next value of the sequence """
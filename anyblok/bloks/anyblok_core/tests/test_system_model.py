@@ -9,4 +9,88 @@ from anyblok.tests.testcase import BlokTestCase
 
 
 class TestSystemModel(BlokTestCase):
-    pass
+
+    def get_column(self, model, name):
+        Column = self.registry.System.Column
+        query = Column.query()
+        query = query.filter(Column.model == model, Column.name == name)
+        return query.one()
+
+    def test_get_schema(self):
+        models, fields = self.registry.System.Model.get_schema()
+        self.assertEqual(models['Model.System.Model']['table'],
+                         'system_model')
+        Field, values = fields[('Model.System.Model', 'name')]
+        self.assertIs(Field, self.registry.System.Column)
+        self.assertTrue(values['primary_key'])
+
+    def test_get_schema_fingerprint(self):
+        Model = self.registry.System.Model
+        self.assertEqual(Model.get_schema_fingerprint(),
+                         Model.get_schema_fingerprint())
+
+    def test_sync_schema_save_the_fingerprint(self):
+        Model = self.registry.System.Model
+        Model.sync_schema()
+        self.assertEqual(
+            self.registry.System.Parameter.get(Model.schema_fingerprint_key),
+            Model.get_schema_fingerprint())
+
+    def test_sync_schema_when_the_fingerprint_is_unchanged(self):
+        Model = self.registry.System.Model
+        Model.sync_schema()
+        column = self.get_column('Model.System.Model', 'table')
+        column.label = 'Changed'
+        Model.sync_schema()
+        self.assertEqual(column.label, 'Changed')
+        self.registry.System.Parameter.pop(Model.schema_fingerprint_key)
+        Model.sync_schema()
+        self.assertNotEqual(column.label, 'Changed')
+
+    def test_update_list_insert_the_missing_fields(self):
+        Model = self.registry.System.Model
+        self.get_column('Model.System.Model', 'table').delete()
+        Model.update_list()
+        self.assertEqual(self.get_column('Model.System.Model', 'table').code,
+                         'system_model.table')
+
+    def test_update_list_delete_the_unknown_fields(self):
+        Model = self.registry.System.Model
+        Field = self.registry.System.Field
+        Field.insert(model='Model.System.Model', name='unknown',
+                     code='system_model.unknown', label='Unknown')
+        Model.update_list()
+        query = Field.query().filter(Field.model == 'Model.System.Model',
+                                     Field.name == 'unknown')
+        self.assertEqual(query.count(), 0)
+
+    def test_update_list_keep_the_fields_of_unknown_models(self):
+        Model = self.registry.System.Model
+        Field = self.registry.System.Field
+        Field.insert(model='Model.Unknown', name='unknown',
+                     code='unknown.unknown', label='Unknown')
+        Model.update_list()
+        query = Field.query().filter(Field.model == 'Model.Unknown')
+        self.assertEqual(query.count(), 1)
+
+    def test_update_list_update_the_modified_fields(self):
+        Model = self.registry.System.Model
+        column = self.get_column('Model.System.Model', 'table')
+        label, nullable = column.label, column.nullable
+        column.label = 'Changed'
+        column.nullable = not nullable
+        self.registry.flush()
+        Model.update_list()
+        self.assertEqual(column.label, label)
+        self.assertEqual(column.nullable, nullable)
+
+    def test_update_list_replace_the_field_of_another_type(self):
+        Model = self.registry.System.Model
+        Field = self.registry.System.Field
+        column = self.get_column('Model.System.Model', 'table')
+        column.delete()
+        Field.insert(model='Model.System.Model', name='table',
+                     code='system_model.table', label='Table')
+        Model.update_list()
+        self.assertEqual(self.get_column('Model.System.Model', 'table').code,
+                         'system_model.table')
@@ -7,6 +7,7 @@
 # obtain one at http://mozilla.org/MPL/2.0/.
 from anyblok import Declarations
 from .exceptions import ExporterException
+from functools import partial
 
 
 @Declarations.register(Declarations.Model.IO)
@@ -43,9 +44,22 @@ class Exporter(Declarations.Mixin.IOMixin):
         Mapping.set(key, entry)
         return key
 
-    def value2str(self, value, ctype, external_id=False, model=None):
-        formater = self.get_formater(ctype)
+    @classmethod
+    def get_value2str(cls, ctype, external_id=False, model=None):
+        """ Return the function which formats the values of a field, it
+        is got once by field, then called for each value
+
+        :param ctype: type of the field
+        :param external_id: if True the values are exported as external ids
+        :param model: model linked to the field
+        :rtype: function(value)
+        """
+        formater = cls.get_formater(ctype)
         if external_id:
-            return formater.externalIdValue2str(value, model)
+            return partial(formater.externalIdValue2str, model=model)
 
-        return formater.value2str(value, model)
+        return partial(formater.value2str, model=model)
+
+    def value2str(self, value, ctype, external_id=False, model=None):
+        return self.get_value2str(ctype, external_id=external_id,
+                                  model=model)(value)
@@ -21,7 +21,18 @@ class Formater:
     def str2value(self, value, model):
         return value
 
-    def _externalIdStr2value(self, value, model):
+    def externalIdKeys(self, value):
+        """ Return the external ids of the string
+
+        :param value: string of the external ids
+        :rtype: list of the external ids
+        """
+        return [value] if value else []
+
+    def _externalIdStr2value(self, value, model, mappings=None):
+        if mappings and (model, value) in mappings:
+            return mappings[(model, value)]
+
         mapping = self.registry.IO.Mapping.get(model, value)
         if mapping is None:
             raise FormaterException(
@@ -29,8 +40,8 @@ class Formater:
 
         return mapping
 
-    def externalIdStr2value(self, value, model):
-        entry = self._externalIdStr2value(value, model)
+    def externalIdStr2value(self, value, model, mappings=None):
+        entry = self._externalIdStr2value(value, model, mappings=mappings)
         pks = entry.to_primary_keys()
         if len(pks.keys()) > 1:
             raise FormaterException(
@@ -174,8 +185,8 @@ class Many2One(IO.Formater):
 
         return Model.from_primary_keys(**pks)
 
-    def externalIdStr2value(self, value, model):
-        return self._externalIdStr2value(value, model)
+    def externalIdStr2value(self, value, model, mappings=None):
+        return self._externalIdStr2value(value, model, mappings=mappings)
 
     def value2str(self, value, model):
         if value is None:
@@ -213,11 +224,15 @@ class Many2Many(IO.Formater):
 
         return [Model.from_primary_keys(**x) for x in pks if x]
 
-    def externalIdStr2value(self, values, model):
+    def externalIdKeys(self, values):
+        return loads(values) if values else []
+
+    def externalIdStr2value(self, values, model, mappings=None):
         if not values:
             return None
         values = loads(values)
-        return [self._externalIdStr2value(value, model) for value in values]
+        return [self._externalIdStr2value(value, model, mappings=mappings)
+                for value in values]
 
     def value2str(self, values, model):
         if not values:
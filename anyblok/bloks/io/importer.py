@@ -6,25 +6,55 @@
 # v. 2.0. If a copy of the MPL was not distributed with this file,You can
 # obtain one at http://mozilla.org/MPL/2.0/.
 from anyblok import Declarations
-from anyblok.column import LargeBinary, Boolean, Integer
+from anyblok.column import (LargeBinary, Boolean, Integer, BigInteger,
+                            String)
+from io import BytesIO
+from functools import partial
 
 
 @Declarations.register(Declarations.Model.IO)
 class Importer(Declarations.Mixin.IOMixin):
 
-    file_to_import = LargeBinary(nullable=False)
+    file_to_import = LargeBinary()
+    file_path = String()
     offset = Integer(default=0)
+    file_offset = BigInteger(default=0)
     nb_grouped_lines = Integer(nullable=False, default=50)
     commit_at_each_grouped = Boolean(default=True)
     check_import = Boolean(default=False)
 
-    def run(self):
-        return self.get_model(self.mode)(self).run()
+    def run(self, **kwargs):
+        """ Run the import with the mode of the importer
+
+        :param kwargs: named arguments given to the mode, ex: ``stream``
+        """
+        return self.get_model(self.mode)(self, **kwargs).run()
+
+    def open_file_to_import(self):
+        """ Return a binary stream on the file to import: the file of
+        ``file_path`` if it is filled, else ``file_to_import``
+
+        :rtype: binary file object
+        """
+        if self.file_path:
+            return open(self.file_path, 'rb')
+
+        return BytesIO(self.file_to_import or b'')
 
     def get_key_mapping(self, key):
         Mapping = self.registry.IO.Mapping
         return Mapping.get(self.model, key)
 
+    def get_key_mappings(self, *keys):
+        """ Return the entries of the model of the importer for the
+        external keys, see ``Model.IO.Mapping.multi_get``
+
+        :param keys: list of the external keys
+        :rtype: dict {key: entry}
+        """
+        Mapping = self.registry.IO.Mapping
+        return Mapping.multi_get(self.model, *keys)
+
     def commit(self):
         if self.check_import:
             return False
@@ -34,9 +64,26 @@ class Importer(Declarations.Mixin.IOMixin):
         self.registry.commit()
         return True
 
-    def str2value(self, value, ctype, external_id=False, model=None):
-        formater = self.get_formater(ctype)
+    @classmethod
+    def get_str2value(cls, ctype, external_id=False, model=None,
+                      mappings=None):
+        """ Return the function which formats the strings of a field, it
+        is got once by field, then called for each value
+
+        :param ctype: type of the field
+        :param external_id: if True the strings are external ids
+        :param model: model linked to the field
+        :param mappings: dict {(model, external id): entry} of the entries
+            already found, the others are searched in ``Model.IO.Mapping``
+        :rtype: function(value)
+        """
+        formater = cls.get_formater(ctype)
         if external_id:
-            return formater.externalIdStr2value(value, model)
+            return partial(formater.externalIdStr2value, model=model,
+                           mappings=mappings)
 
-        return formater.str2value(value, model)
+        return partial(formater.str2value, model=model)
+
+    def str2value(self, value, ctype, external_id=False, model=None):
+        return self.get_str2value(ctype, external_id=external_id,
+                                  model=model)(value)
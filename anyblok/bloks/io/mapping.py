@@ -176,6 +176,50 @@ class Mapping:
 
         return cls.get_model(model).from_primary_keys(**pks)
 
+    @classmethod
+    def multi_get_primary_keys(cls, model, *keys):
+        """ return primary keys for a model and external keys, all the
+        mappings are loaded by one query
+
+        :param model: model of the mapping
+        :param keys: list of the keys
+        :rtype: dict {key: {primary key: value}}
+        """
+        if not keys:
+            return {}
+
+        query = cls.query()
+        query = query.filter(cls.filter_by_model_and_keys(model, *keys))
+        res = {}
+        for mapping in query.all():
+            cls.check_primary_keys(model, *mapping.primary_key.keys())
+            res[mapping.key] = mapping.primary_key
+
+        return res
+
+    @classmethod
+    def multi_get(cls, model, *keys):
+        """ return instances of the model with these external keys, by one
+        query on the mappings and one query on the model
+
+        :param model: model of the mapping
+        :param keys: list of the keys
+        :rtype: dict {key: instance of the model}
+        """
+        mappings = cls.multi_get_primary_keys(model, *keys)
+        Model = cls.get_model(model)
+        primary_keys = Model.get_primary_keys()
+        entries = {
+            tuple(getattr(entry, pk) for pk in primary_keys): entry
+            for entry in Model.from_multi_primary_keys(*mappings.values())}
+        res = {}
+        for key, pks in mappings.items():
+            entry = entries.get(tuple(pks[pk] for pk in primary_keys))
+            if entry is not None:
+                res[key] = entry
+
+        return res
+
     @classmethod
     def get_from_model_and_primary_keys(cls, model, pks):
         query = cls.query().filter(cls.model == model)
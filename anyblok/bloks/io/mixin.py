@@ -6,6 +6,7 @@
 # v. 2.0. If a copy of the MPL was not distributed with this file,You can
 # obtain one at http://mozilla.org/MPL/2.0/.
 from anyblok import Declarations
+from anyblok.declarations import classmethod_cache
 from anyblok.column import Integer, Selection, String
 
 
@@ -21,9 +22,10 @@ class IOMixin:
     def get_mode_choices(cls):
         return {}
 
-    def get_formater(self, ctype):
+    @classmethod_cache()
+    def get_formater(cls, ctype):
         formater_name = 'Model.IO.Formater.' + ctype
-        if self.registry.has(formater_name):
-            return self.registry.get(formater_name)()
+        if cls.registry.has(formater_name):
+            return cls.registry.get(formater_name)()
         else:
-            return self.registry.IO.Formater()
+            return cls.registry.IO.Formater()
@@ -204,3 +204,7 @@ class TestExporterFormater(BlokTestCase):
         value = self.get_value(model.name, "String", external_id=True,
                                model="Model.System.Model")
         self.assertEqual(value, key)
+
+    def test_get_value2str(self):
+        value2str = self.registry.IO.Exporter.get_value2str("Boolean")
+        self.assertEqual([value2str(x) for x in (True, False)], ['1', '0'])
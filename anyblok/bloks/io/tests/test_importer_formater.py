@@ -225,3 +225,9 @@ class TestImporterFormater(BlokTestCase):
         value = self.get_value(key, "One2One", external_id=True,
                                model="Model.System.Model")
         self.assertEqual(value, model)
+
+    def test_get_str2value(self):
+        str2value = self.registry.IO.Importer.get_str2value("Integer")
+        self.assertEqual([str2value(x) for x in ("1", "2")], [1, 2])
+        self.assertIs(self.registry.IO.Importer.get_formater("Integer"),
+                      self.registry.IO.Importer.get_formater("Integer"))
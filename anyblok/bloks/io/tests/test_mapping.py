@@ -78,6 +78,16 @@ class TestIOMapping(BlokTestCase):
         mapping = self.Mapping.get(column.__registry_name__, 'test_get')
         self.assertEqual(mapping, column)
 
+    def test_multi_get(self):
+        columns = {'test_%s' % m.code: m
+                   for m in self.Column.query().limit(5).all()}
+        for key, instance in columns.items():
+            self.Mapping.set(key, instance)
+
+        mappings = self.Mapping.multi_get(
+            self.Column.__registry_name__, 'test_unexisting', *columns.keys())
+        self.assertEqual(mappings, columns)
+
     def test_delete(self):
         column = self.Column.query().first()
         self.Mapping.set('test_delete', column)
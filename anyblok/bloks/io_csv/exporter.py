@@ -53,15 +53,32 @@ class Field(Mixin.IOCSVFieldMixin):
 
         return fields_description[name]
 
-    def _value2str(self, exporter, name, entry, external_id):
+    def get_value2str(self, exporter, name, entry, external_id):
+        """ Return the function which formats the field for the entries
+        of the model of the entry
+
+        :rtype: function(entry)
+        """
         fields_description = self._get_fields_description(name, entry)
         if fields_description['primary_key'] and external_id:
-            return self.registry.IO.Exporter.get_key_mapping(entry)
+            return self.registry.IO.Exporter.get_key_mapping
+
+        value2str = exporter.get_value2str(
+            fields_description['type'], external_id=external_id,
+            model=fields_description['model'])
+        return lambda entry: value2str(getattr(entry, name))
+
+    def _value2str(self, exporter, name, entry, external_id,
+                   converters=None):
+        if converters is None:
+            converters = {}
 
-        ctype = fields_description['type']
-        model = fields_description['model']
-        return exporter.value2str(getattr(entry, name), ctype,
-                                  external_id=external_id, model=model)
+        key = (self.name, self.mode, entry.__registry_name__)
+        if key not in converters:
+            converters[key] = self.get_value2str(exporter, name, entry,
+                                                 external_id)
+
+        return converters[key](entry)
 
     def _rc_get_sub_entry(self, name, entry):
         fields_description = self._get_fields_description(name, entry)
@@ -85,14 +102,23 @@ class Field(Mixin.IOCSVFieldMixin):
                 "the field %r of %r is not in (Many2One, One2One) "
                 "or has not a foreign key")
 
-    def value2str(self, exporter, entry):
+    def value2str(self, exporter, entry, converters=None):
+        """ Return the string of the field for the entry
+
+        :param exporter: the exporter
+        :param entry: the entry to export
+        :param converters: dict where the functions which format the
+            fields are kept, to get them once by export
+        :rtype: str
+        """
 
         def _rc_get_value(names, entry):
             if not names:
                 return ''
             elif len(names) == 1:
                 external_id = False if self.mode == 'any' else True
-                return self._value2str(exporter, names[0], entry, external_id)
+                return self._value2str(exporter, names[0], entry, external_id,
+                                       converters=converters)
             else:
                 return _rc_get_value(
                     names[1:], self._rc_get_sub_entry(names[0], entry))
@@ -144,10 +170,14 @@ class CSV:
                             delimiter=self.exporter.csv_delimiter,
                             quotechar=self.exporter.csv_quotechar)
         writer.writeheader()
+        fields = [(field.format_header(), field)
+                  for field in self.exporter.fields_to_export]
+        converters = {}
         for entry in entries:
             writer.writerow(
-                {field.format_header(): field.value2str(self.exporter, entry)
-                 for field in self.exporter.fields_to_export})
+                {header: field.value2str(self.exporter, entry,
+                                         converters=converters)
+                 for header, field in fields})
 
         csvfile.seek(0)
         return csvfile
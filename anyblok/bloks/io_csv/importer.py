@@ -6,10 +6,18 @@
 # v. 2.0. If a copy of the MPL was not distributed with this file,You can
 # obtain one at http://mozilla.org/MPL/2.0/.
 from anyblok import Declarations
+from anyblok.registry import RegistryManager
 from anyblok.column import Selection
 from csv import DictReader
-from io import StringIO
+from io import TextIOBase
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_all_start_methods, get_context
+from sqlalchemy import event
+from ..io.exceptions import FormaterException
 from .exceptions import CSVImporterException
+from logging import getLogger
+logger = getLogger(__name__)
 
 
 register = Declarations.register
@@ -42,41 +50,211 @@ class Importer(Mixin.IOCSVMixin):
         return res
 
 
+def forbid_statement_in_process(*args, **kwargs):
+    raise CSVImporterException(
+        "The processes of the pool of the CSV importer must not use the "
+        "database")
+
+
+def init_process(db_name):
+    """ Initializer of the processes of the pool of ``IO.Importer.CSV``
+
+    The connections inherited from the importer are still used by it, they
+    are forgotten by the process without being closed, then any statement
+    executed by the process raises an exception
+
+    :param db_name: name of the database of the registry
+    """
+    engine = RegistryManager.registries[db_name].engine
+    engine.dispose(close=False)
+    event.listen(engine, 'before_cursor_execute', forbid_statement_in_process)
+
+
+def format_rows_in_process(db_name, fields, rows):
+    """ Format the values of the rows in a process of the pool of
+    ``IO.Importer.CSV``, the process is forked from the importer, the
+    registry is taken in its memory and the database is never used
+
+    :param db_name: name of the database of the registry
+    :param fields: list of tuple (name, type) of the fields to format
+    :param rows: list of dict of the strings of the rows
+    :rtype: list of tuple (error message or None, dict of the values)
+    """
+    Importer = RegistryManager.registries[db_name].IO.Importer
+    converters = [(name, Importer.get_str2value(ctype))
+                  for name, ctype in fields]
+    res = []
+    for row in rows:
+        try:
+            res.append((None, {name: str2value(row[name])
+                               for name, str2value in converters}))
+        except Exception as e:
+            res.append(('%r: %r' % (e.__class__.__name__, e), None))
+
+    return res
+
+
+class CSVLineReader:
+    """ Iterator of the decoded lines of a binary stream, which keeps the
+    position in bytes of the end of the last line read. The csv reader
+    does not read ahead, so after each row this position is the place
+    where the import can be resumed
+    """
+
+    def __init__(self, stream, encoding='utf-8'):
+        self.stream = stream
+        self.encoding = encoding
+        self.position = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.stream.readline()
+        if not line:
+            raise StopIteration
+
+        self.position += len(line)
+        return line.decode(self.encoding)
+
+    def seek(self, position):
+        """ Move the stream at the position, only if it is seekable
+
+        :param position: position in bytes in the stream
+        :rtype: bool, True if the stream has been moved
+        """
+        if not self.stream.seekable():
+            return False
+
+        self.stream.seek(position)
+        self.position = position
+        return True
+
+
 @register(IO.Importer)
 class CSV:
 
-    def __init__(self, importer):
+    def __init__(self, importer, stream=None, keep_entries=False,
+                 processes=None):
         self.importer = importer
+        self.stream = stream
+        self.keep_entries = keep_entries
+        self.processes = processes
         self.error_found = []
+        self.csvfile = None
+        self.lines = None
         self.reader = None
+        self.offset = 0
         self.created_entries = []
         self.updated_entries = []
+        self.nb_created_entries = 0
+        self.nb_updated_entries = 0
         self.header_pks = []
         self.header_external_id = None
         self.header_external_ids = {}
         self.header_fields = []
         self.fields_description = {}
+        self.mappings_to_set = []
+        self.converters = None
+        self.external_id_entries = {}
+
+    def get_checkpoint(self):
+        """ Return the number of rows read and the position in bytes of the
+        file, saved by ``commit``
+
+        :rtype: tuple (offset, file offset or None)
+        """
+        if self.lines is None:
+            return self.offset, None
 
-    def commit(self):
+        return self.offset, self.lines.position
+
+    def commit(self, checkpoint=None):
         if self.error_found:
             return False
 
-        self.importer.offset = self.reader.line_num - 1
+        if checkpoint is None:
+            checkpoint = self.get_checkpoint()
+
+        self.importer.offset, file_offset = checkpoint
+        if file_offset is not None:
+            self.importer.file_offset = file_offset
+
         self.importer.commit()
         return True
 
     def get_reader(self):
-        csvfile = StringIO()
-        csvfile.write(self.importer.file_to_import.decode('utf-8'))
-        csvfile.seek(0)
-        self.reader = DictReader(csvfile,
+        """ Create the reader on the stream given to the importer, else on
+        the file of the importer. The file is decoded incrementally by the
+        reader, only the rows of the current group are kept in memory. The
+        position of a binary stream is followed to save it at each commit
+        """
+        stream = self.stream
+        if stream is None:
+            stream = self.importer.open_file_to_import()
+
+        if isinstance(stream, TextIOBase):
+            self.csvfile = stream
+        else:
+            self.csvfile = self.lines = CSVLineReader(stream)
+
+        self.reader = DictReader(self.csvfile,
                                  delimiter=self.importer.csv_delimiter,
                                  quotechar=self.importer.csv_quotechar)
 
+    def close_reader(self):
+        """ Close the file opened by ``get_reader``, the stream given to the
+        importer is not closed
+        """
+        if self.csvfile is None:
+            return
+        elif self.stream is None:
+            self.lines.stream.close()
+
+        self.csvfile = self.lines = self.reader = None
+
+    def add_created_entry(self, entry):
+        self.nb_created_entries += 1
+        if self.keep_entries:
+            self.created_entries.append(entry)
+
+    def add_updated_entry(self, entry):
+        self.nb_updated_entries += 1
+        if self.keep_entries:
+            self.updated_entries.append(entry)
+
+    def seek_offset(self):
+        """ Move the binary stream at the position saved by the last commit
+        of the importer, the header must be already read
+
+        :rtype: bool, True if the stream has been moved
+        """
+        if not self.importer.offset or not self.importer.file_offset:
+            return False
+        elif self.lines is None:
+            return False
+        elif self.importer.file_offset <= self.lines.position:
+            return False
+
+        if not self.lines.seek(self.importer.file_offset):
+            return False
+
+        self.offset = self.importer.offset
+        return True
+
     def consume_offset(self):
+        """ Skip the rows already imported, by moving the stream at the
+        position of the last commit if it is known, else by reading them
+        again
+        """
+        self.reader.fieldnames  # read the header before moving the stream
+        if self.seek_offset():
+            return
+
         try:
             for offset in range(self.importer.offset):
                 next(self.reader)
+                self.offset += 1
         except StopIteration:
             pass
 
@@ -85,6 +263,7 @@ class CSV:
         try:
             for offset in range(self.importer.nb_grouped_lines):
                 res.append(next(self.reader))
+                self.offset += 1
         except StopIteration:
             pass
 
@@ -115,89 +294,345 @@ class CSV:
                 else:
                     self.header_fields.append(name)
 
+    def add_error(self, exception=None, msg=None):
+        if msg is None:
+            msg = '%r: %r' % (exception.__class__.__name__, exception)
+
+        self.error_found.append(msg)
+        if self.importer.csv_on_error == 'raise_now':
+            raise CSVImporterException(msg)
+
+    def create_entry(self, Model, values):
+        """ Add a new entry in the session, the entries of the group of rows
+        are flushed together by ``flush``
+
+        :param Model: model of the entry
+        :param values: dict of the values of the entry
+        :rtype: instance of the model
+        """
+        entry = Model(**values)
+        self.registry.add(entry)
+        self.add_created_entry(entry)
+        return entry
+
     def _parse_row_if_entry(self, row, entry, values, Model):
         if self.importer.csv_if_exist == 'overwrite':
             entry.update(**values)
-            self.updated_entries.append(entry)
+            self.add_updated_entry(entry)
         elif self.importer.csv_if_exist == 'create':
-            entry = Model.insert(**values)
-            self.created_entries.append(entry)
+            self.create_entry(Model, values)
         elif self.importer.csv_if_exist == 'raise':
             raise CSVImporterException(
                 "Row %r already an entry %r " % (
                     row, entry.to_primary_keys()))
 
+        return entry
+
     def _parse_row_if_not_entry(self, row, pks, values, Model):
-        Mapping = self.registry.IO.Mapping
         if self.importer.csv_if_does_not_exist == 'create':
             if pks:
                 values.update(**pks)
 
-            entry = Model.insert(**values)
-            self.created_entries.append(entry)
+            entry = self.create_entry(Model, values)
             if self.header_external_id:
-                Mapping.set(row[self.header_external_id], entry)
+                self.mappings_to_set.append(
+                    (row[self.header_external_id], entry))
+
+            return entry
 
         elif self.importer.csv_if_does_not_exist == 'raise':
             raise CSVImporterException(
                 "Create row are not allowed")
 
+        return None
+
     def _parse_row(self, row, entry, pks, values, Model):
         if entry:
-            self._parse_row_if_entry(row, entry, values, Model)
-        else:
-            self._parse_row_if_not_entry(row, pks, values, Model)
+            return self._parse_row_if_entry(row, entry, values, Model)
 
-    def parse_row(self, row):
+        return self._parse_row_if_not_entry(row, pks, values, Model)
+
+    def get_converters(self):
+        """ Return the functions which format the strings of each column
+        of the file, got once by import
+
+        :rtype: dict {header: function(value)}
+        """
+        res = {}
+        for field in self.header_fields + self.header_pks:
+            ctype = self.fields_description[field]['type']
+            res[field] = self.importer.get_str2value(ctype)
+
+        for external_field, field in self.header_external_ids.items():
+            ctype = self.fields_description[field]['type']
+            model = self.fields_description[field]['model']
+            res[external_field] = self.importer.get_str2value(
+                ctype, external_id=True, model=model,
+                mappings=self.external_id_entries)
+
+        return res
+
+    def str2value(self, row, field, formated_values=None):
+        if formated_values and field in formated_values:
+            return formated_values[field]
+
+        return self.converters[field](row[field])
+
+    def format_row(self, row, formated_values=None):
+        """ Return the values of the row formated for the columns, and the
+        key to find the existing entry: the external id or the tuple of the
+        primary keys. The external ids of the fields are formated by
+        ``format_external_ids``
+
+        :param row: dict of the strings of the row
+        :param formated_values: dict of the values already formated
+        :rtype: tuple (key, primary keys, values)
+        """
+        values = {field: self.str2value(row, field, formated_values)
+                  for field in self.header_fields}
+        key = pks = None
+        if self.header_external_id:
+            key = row[self.header_external_id]
+        elif self.header_pks:
+            pks = {field: self.str2value(row, field, formated_values)
+                   for field in self.header_pks}
+            key = tuple(pks[field] for field in self.header_pks)
+
+        return key, pks, values
+
+    def format_external_ids(self, row, values):
+        """ Add in the values the entries found by the external ids of the
+        row. If an external id is unknown and entries are waiting to be
+        flushed, they are flushed and the external id is searched again,
+        because the entry can be created by a previous row
+
+        :param row: dict of the strings of the row
+        :param values: dict of the formated values of the row
+        """
         try:
-            entry = pks = None
-            Model = self.registry.get(self.importer.model)
-            values = {}
-            for field in self.header_fields:
-                ctype = self.fields_description[field]['type']
-                values[field] = self.importer.str2value(row[field], ctype)
-
-            for external_field, field in self.header_external_ids.items():
-                ctype = self.fields_description[field]['type']
-                model = self.fields_description[field]['model']
-                values[field] = self.importer.str2value(
-                    row[external_field], ctype, external_id=True, model=model)
+            self._format_external_ids(row, values)
+        except FormaterException:
+            if not self.mappings_to_set:
+                raise
+
+            self.flush()
+            self._format_external_ids(row, values)
+
+    def _format_external_ids(self, row, values):
+        for external_field, field in self.header_external_ids.items():
+            values[field] = self.str2value(row, external_field)
+
+    def get_external_ids(self, rows):
+        """ Return the external ids of the fields of a group of rows
+
+        :param rows: list of dict of the strings of the rows
+        :rtype: dict {model: set of the external ids}
+        """
+        res = {}
+        for external_field, field in self.header_external_ids.items():
+            description = self.fields_description[field]
+            formater = self.importer.get_formater(description['type'])
+            keys = res.setdefault(description['model'], set())
+            for row in rows:
+                try:
+                    keys.update(formater.externalIdKeys(row[external_field]))
+                except Exception:
+                    # the error is reported by the format of the row
+                    pass
 
-            if self.header_external_id:
-                entry = self.importer.get_key_mapping(
-                    row[self.header_external_id])
-            elif self.header_pks:
-                pks = {}
-                for field in self.header_pks:
-                    ctype = self.fields_description[field]['type']
-                    pks[field] = self.importer.str2value(row[field], ctype)
+        return res
+
+    def load_external_id_entries(self, rows):
+        """ Find the entries of the external ids of the fields of a group
+        of rows, by one ``Model.IO.Mapping.multi_get`` by model, the
+        converters of the external ids take them in ``external_id_entries``
+
+        :param rows: list of dict of the strings of the rows
+        """
+        Mapping = self.registry.IO.Mapping
+        self.external_id_entries.clear()
+        for model, keys in self.get_external_ids(rows).items():
+            for key, entry in Mapping.multi_get(model, *keys).items():
+                self.external_id_entries[(model, key)] = entry
+
+    def get_entries(self, keys, Model):
+        """ Return the existing entries for the keys of a group of rows, by
+        one query on the mappings or on the primary keys
+
+        :param keys: list of the keys returned by ``format_row``
+        :param Model: model to import
+        :rtype: dict {key: entry}
+        """
+        keys = set(x for x in keys if x is not None)
+        if not keys:
+            return {}
+        elif self.header_external_id:
+            return self.importer.get_key_mappings(*keys)
+
+        pks = [dict(zip(self.header_pks, key)) for key in keys]
+        return {tuple(getattr(entry, pk) for pk in self.header_pks): entry
+                for entry in Model.from_multi_primary_keys(*pks)}
+
+    def flush(self):
+        """ Flush the entries of the group of rows, then save the mappings
+        of the external ids of the created entries
+        """
+        self.registry.flush()
+        if self.mappings_to_set:
+            Mapping = self.registry.IO.Mapping
+            Mapping.multi_insert(*[
+                dict(model=entry.__registry_name__, key=key,
+                     primary_key=entry.to_primary_keys())
+                for key, entry in self.mappings_to_set])
+            self.mappings_to_set = []
+
+    def format_rows(self, rows, formated_rows=None):
+        """ Return the rows formated by ``format_row``, the rows in error are
+        removed
+
+        :param rows: list of dict of the strings of the rows
+        :param formated_rows: list returned by ``format_rows_in_process``
+        :rtype: list of tuple (row, key, primary keys, values)
+        """
+        if formated_rows is None:
+            formated_rows = [(None, None)] * len(rows)
+
+        res = []
+        for row, (error, formated_values) in zip(rows, formated_rows):
+            if error:
+                self.add_error(msg=error)
+                continue
+
+            try:
+                res.append((row,) + self.format_row(row, formated_values))
+            except Exception as e:
+                self.add_error(e)
 
-                entry = Model.from_primary_keys(**pks)
+        return res
+
+    def parse_formated_rows(self, formated_rows, entries, Model):
+        """ Create or update the entries in the order of the rows, the
+        created entries are added in ``entries`` for the next rows
+
+        :param formated_rows: list returned by ``format_rows``
+        :param entries: dict returned by ``get_entries``
+        :param Model: model to import
+        """
+        for row, key, pks, values in formated_rows:
+            try:
+                self.format_external_ids(row, values)
+                entry = self._parse_row(row, entries.get(key), pks, values,
+                                        Model)
+                if key is not None and entry is not None:
+                    entries[key] = entry
+            except Exception as e:
+                self.add_error(e)
+
+    def parse_rows(self, rows, formated_rows=None):
+        """ Import a group of rows, the values of all the rows are formated,
+        the existing entries are found together, then the entries are created
+        or updated in the order of the rows and flushed together
+
+        :param rows: list of dict of the strings of the rows
+        :param formated_rows: list returned by ``format_rows_in_process``
+        """
+        Model = self.registry.get(self.importer.model)
+        if self.converters is None:
+            self.converters = self.get_converters()
 
-            self._parse_row(row, entry, pks, values, Model)
+        formated_rows = self.format_rows(rows, formated_rows)
+        try:
+            self.load_external_id_entries(rows)
+            entries = self.get_entries([x[1] for x in formated_rows], Model)
+            self.parse_formated_rows(formated_rows, entries, Model)
+            self.flush()
+        except CSVImporterException:
+            raise
         except Exception as e:
-            msg = '%r: %r' % (e.__class__.__name__, e)
-            self.error_found.append(msg)
-            if self.importer.csv_on_error == 'raise_now':
-                raise CSVImporterException(msg)
+            self.add_error(e)
+
+    def parse_row(self, row):
+        self.parse_rows([row])
+
+    def get_fields_to_format_in_process(self):
+        """ Return the fields formated by the processes, the fields linked
+        to another model need the database, they are formated by the
+        importer
+
+        :rtype: list of tuple (name, type)
+        """
+        return [(field, self.fields_description[field]['type'])
+                for field in self.header_fields + self.header_pks
+                if not self.fields_description[field]['model']]
+
+    def parse_groups(self):
+        while True:
+            rows = self.consume_nb_grouped_lines()
+            if not rows:
+                break
+
+            self.parse_rows(rows)
+            self.commit()
+
+    def can_use_processes(self):
+        """ Return True if the rows can be formated by a pool of processes,
+        more than one process is wanted and the processes can be forked
+
+        :rtype: bool
+        """
+        if not self.processes or self.processes < 2:
+            return False
+        elif 'fork' not in get_all_start_methods():
+            logger.warning("The processes can not be forked, the rows are "
+                           "formated by the importer")
+            return False
+
+        return True
+
+    def parse_groups_in_processes(self):
+        """ Format the groups of rows in a pool of ``processes`` processes,
+        the groups are written and committed in the order of the file by the
+        importer. Only ``2 * processes`` groups are read in advance
+        """
+        db_name = self.registry.db_name
+        fields = self.get_fields_to_format_in_process()
+        groups = deque()
+        # the processes must be forked, they take the registry in memory
+        with ProcessPoolExecutor(max_workers=self.processes,
+                                 mp_context=get_context('fork'),
+                                 initializer=init_process,
+                                 initargs=(db_name,)) as executor:
+            while True:
+                while len(groups) < 2 * self.processes:
+                    rows = self.consume_nb_grouped_lines()
+                    if not rows:
+                        break
+
+                    future = executor.submit(format_rows_in_process,
+                                             db_name, fields, rows)
+                    groups.append((rows, future, self.get_checkpoint()))
+
+                if not groups:
+                    break
+
+                rows, future, checkpoint = groups.popleft()
+                self.parse_rows(rows, future.result())
+                self.commit(checkpoint=checkpoint)
 
     def run(self):
         try:
             self.get_reader()
             self.get_header()
             self.consume_offset()
-            while True:
-                rows = self.consume_nb_grouped_lines()
-                if not rows:
-                    break
-
-                for row in rows:
-                    self.parse_row(row)
-
-                self.commit()
+            if self.can_use_processes():
+                self.parse_groups_in_processes()
+            else:
+                self.parse_groups()
         except Exception as e:
             msg = '%r: %r' % (e.__class__.__name__, e)
             self.error_found.append(msg)
+        finally:
+            self.close_reader()
 
         if self.error_found:
             if self.importer.csv_on_error == 'raise_at_the_end':
@@ -208,6 +643,8 @@ class CSV:
             'error': self.error_found,
             'created_entries': self.created_entries,
             'updated_entries': self.updated_entries,
+            'nb_created_entries': self.nb_created_entries,
+            'nb_updated_entries': self.nb_updated_entries,
         }
 
     @classmethod
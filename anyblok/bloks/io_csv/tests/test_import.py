@@ -7,9 +7,23 @@
 # obtain one at http://mozilla.org/MPL/2.0/.
 from anyblok.tests.testcase import BlokTestCase
 from ..exceptions import CSVImporterException
+from ..importer import format_rows_in_process, init_process
+from anyblok.registry import RegistryManager
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
 from os import urandom
 from csv import DictReader
-from io import StringIO
+from io import StringIO, BytesIO
+from tempfile import NamedTemporaryFile
+
+
+def query_in_process(db_name):
+    try:
+        RegistryManager.registries[db_name].System.Blok.query().count()
+    except CSVImporterException:
+        return True
+
+    return False
 
 
 class TestImportCSV(BlokTestCase):
@@ -23,9 +37,9 @@ class TestImportCSV(BlokTestCase):
             file_to_import = urandom(100000)
         return CSV.insert(file_to_import=file_to_import, **kwargs)
 
-    def create_csv_importer(self, **kwargs):
+    def create_csv_importer(self, keep_entries=True, **kwargs):
         CSV = self.registry.IO.Importer.CSV
-        return CSV(self.create_importer(**kwargs))
+        return CSV(self.create_importer(**kwargs), keep_entries=keep_entries)
 
     def get_file_to_import(self):
         return '''"A","B","C"\n"1","2","3"\n"4","5","6"'''.encode('utf-8')
@@ -82,6 +96,28 @@ class TestImportCSV(BlokTestCase):
         importer.consume_offset()
         self.assertNbLines(importer, 0)
 
+    def test_consume_offset_from_file_offset(self):
+        importer = self.create_csv_importer(
+            offset=1, file_offset=len('"A","B","C"\n"1","2","3"\n'),
+            file_to_import=self.get_file_to_import())
+        importer.get_reader()
+        importer.consume_offset()
+        self.assertEqual(importer.offset, 1)
+        rows = [row for row in importer.reader]
+        self.assertEqual(rows, [{'A': '4', 'B': '5', 'C': '6'}])
+
+    def test_commit_save_the_file_offset(self):
+        importer = self.create_csv_importer(
+            nb_grouped_lines=1, check_import=True,
+            file_to_import=self.get_file_to_import())
+        importer.get_reader()
+        importer.consume_offset()
+        importer.consume_nb_grouped_lines()
+        importer.commit()
+        self.assertEqual(importer.importer.offset, 1)
+        self.assertEqual(importer.importer.file_offset,
+                         len('"A","B","C"\n"1","2","3"\n'))
+
     def test_consume_nb_grouped_lines(self):
         importer = self.create_csv_importer(
             nb_grouped_lines=1,
@@ -445,6 +481,22 @@ class TestImportCSV(BlokTestCase):
         self.assertEqual(len(importer.error_found), 0)
         self.assertEqual(importer.updated_entries[0].model, 'Model.IO.Test')
 
+    def test_load_external_id_entries(self):
+        Model = self.registry.System.Model
+        model = Model.insert(name='Model.IO.Test', table='io_test')
+        self.registry.IO.Mapping.set('import_mapping', model)
+        Importer = self.registry.IO.Importer
+        importer = self.create_csv_importer(model='Model.IO.Exporter')
+        importer.header_external_ids = {'model/EXTERNAL_ID': 'model'}
+        importer.fields_description = Importer.fields_description(
+            fields=['model'])
+        importer.load_external_id_entries([
+            {'model/EXTERNAL_ID': 'import_mapping'},
+            {'model/EXTERNAL_ID': 'import_mapping'},
+            {'model/EXTERNAL_ID': 'unexisting_mapping'}])
+        self.assertEqual(importer.external_id_entries,
+                         {('Model.System.Model', 'import_mapping'): model})
+
     def test_parse_row_with_unexisting_mapping(self):
         Importer = self.registry.IO.Importer
         importer = self.create_csv_importer(model='Model.IO.Importer')
@@ -460,6 +512,46 @@ class TestImportCSV(BlokTestCase):
         self.assertEqual(len(importer.updated_entries), 0)
         self.assertEqual(len(importer.error_found), 1)
 
+    def test_parse_rows_with_the_same_mapping(self):
+        Exporter = self.registry.IO.Exporter
+        importer = self.create_csv_importer(model='Model.IO.Exporter')
+        importer.header_external_id = 'id/EXTERNAL_ID'
+        importer.header_fields = ['model', 'mode']
+        importer.fields_description = Exporter.fields_description(
+            fields=['id', 'model', 'mode'])
+        importer.parse_rows([{'id/EXTERNAL_ID': 'import_mapping',
+                              'model': 'Model.IO.Importer',
+                              'mode': 'Model.IO.Exporter.CSV'},
+                             {'id/EXTERNAL_ID': 'import_mapping',
+                              'model': 'Model.IO.Exporter',
+                              'mode': 'Model.IO.Exporter.CSV'}])
+        self.assertEqual(len(importer.created_entries), 1)
+        self.assertEqual(len(importer.updated_entries), 1)
+        self.assertEqual(len(importer.error_found), 0)
+        exporter = self.registry.IO.Mapping.get('Model.IO.Exporter',
+                                                'import_mapping')
+        self.assertIs(exporter, importer.created_entries[0])
+        self.assertEqual(exporter.model, 'Model.IO.Exporter')
+
+    def test_parse_rows_with_an_error(self):
+        Model = self.registry.System.Model
+        importer = self.create_csv_importer(model='Model.System.Model',
+                                            csv_on_error='ignore')
+        importer.header_pks = ['name']
+        importer.header_fields = ['table']
+        importer.fields_description = Model.fields_description(
+            fields=['name', 'table'])
+        Model.insert(name='Model.IO.Test', table='io_test')
+        importer.parse_rows([{'name': 'Model.IO.Test'},
+                             {'name': 'Model.IO.Test',
+                              'table': 'io_test_other_table'},
+                             {'name': 'Model.IO.Test2', 'table': 'io_test2'}])
+        self.assertEqual(len(importer.created_entries), 1)
+        self.assertEqual(len(importer.updated_entries), 1)
+        self.assertEqual(len(importer.error_found), 1)
+        self.assertEqual(importer.updated_entries[0].table,
+                         'io_test_other_table')
+
     def test_run(self):
         importer = self.create_csv_importer(
             model='Model.IO.Exporter',
@@ -484,3 +576,78 @@ class TestImportCSV(BlokTestCase):
         self.assertEqual(len(importer.created_entries), 0)
         self.assertEqual(len(importer.updated_entries), 0)
         self.assertEqual(len(importer.error_found), 1)
+
+    def test_format_rows_in_process(self):
+        res = format_rows_in_process(
+            self.registry.db_name, [('id', 'Integer'), ('mode', 'String')],
+            [{'id': '1', 'mode': 'Model.IO.Exporter.CSV'},
+             {'id': 'wrong id', 'mode': 'Model.IO.Exporter.CSV'}])
+        self.assertEqual(res[0], (None, {'id': 1,
+                                         'mode': 'Model.IO.Exporter.CSV'}))
+        self.assertIsNotNone(res[1][0])
+        self.assertIsNone(res[1][1])
+
+    def test_can_use_processes(self):
+        importer = self.create_importer()
+        CSV = self.registry.IO.Importer.CSV
+        self.assertFalse(CSV(importer).can_use_processes())
+        self.assertFalse(CSV(importer, processes=1).can_use_processes())
+
+    def test_run_in_processes(self):
+        importer = self.create_importer(
+            model='Model.IO.Exporter', nb_grouped_lines=1,
+            file_to_import=self.get_exporter_file_to_import())
+        res = importer.run(processes=2)
+        self.assertEqual(res['nb_created_entries'], 1)
+        self.assertEqual(res['nb_updated_entries'], 0)
+        self.assertEqual(res['error'], [])
+
+    def test_processes_do_not_use_the_database(self):
+        db_name = self.registry.db_name
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context('fork'),
+                                 initializer=init_process,
+                                 initargs=(db_name,)) as executor:
+            self.assertTrue(executor.submit(query_in_process, db_name).result())
+
+        self.assertTrue(self.registry.System.Blok.query().count())
+
+    def test_get_reader_from_binary_stream(self):
+        importer = self.create_importer()
+        CSV = self.registry.IO.Importer.CSV
+        importer = CSV(importer, stream=BytesIO(self.get_file_to_import()))
+        importer.get_reader()
+        self.assertNbLines(importer, 2)
+        importer.close_reader()
+        self.assertFalse(importer.stream.closed)
+
+    def test_get_reader_from_text_stream(self):
+        importer = self.create_importer()
+        CSV = self.registry.IO.Importer.CSV
+        stream = StringIO(self.get_file_to_import().decode('utf-8'))
+        importer = CSV(importer, stream=stream)
+        importer.get_reader()
+        self.assertNbLines(importer, 2)
+
+    def test_get_reader_from_file_path(self):
+        with NamedTemporaryFile(suffix='.csv') as fp:
+            fp.write(self.get_file_to_import())
+            fp.flush()
+            importer = self.create_csv_importer(file_path=fp.name)
+            importer.get_reader()
+            self.assertNbLines(importer, 2)
+            importer.close_reader()
+
+    def test_run_from_stream_without_keeping_the_entries(self):
+        importer = self.create_importer(model='Model.IO.Exporter')
+        stream = BytesIO(self.get_exporter_file_to_import())
+        res = importer.run(stream=stream)
+        self.assertEqual(res['created_entries'], [])
+        self.assertEqual(res['nb_created_entries'], 1)
+        self.assertEqual(res['nb_updated_entries'], 0)
+
+    def test_run_keeping_the_entries(self):
+        importer = self.create_importer(model='Model.IO.Exporter')
+        stream = BytesIO(self.get_exporter_file_to_import())
+        res = importer.run(stream=stream, keep_entries=True)
+        self.assertEqual(len(res['created_entries']), 1)
+        self.assertEqual(res['nb_created_entries'], 1)
@@ -37,6 +37,7 @@ class XML:
         self.updated_entries = []
         self.params = {}
         self.two_way_external_id = {}
+        self.converters = {}
 
     def commit(self):
         if self.error_found:
@@ -205,6 +206,17 @@ class XML:
 
         return None
 
+    def str2value(self, value, ctype, external_id=False, model=None):
+        """ Format the value, the function which formats the values of a
+        type of field is got once by import
+        """
+        key = (ctype, external_id, model)
+        if key not in self.converters:
+            self.converters[key] = self.importer.get_str2value(
+                ctype, external_id=external_id, model=model)
+
+        return self.converters[key](value)
+
     def import_field(self, field, ctype, model=None, on_error=on_error):
         model = field.attrib.get('model', model)
         param = field.attrib.get('param')
@@ -226,9 +238,8 @@ class XML:
                     res = self.two_way_external_id[(model, val)]
 
             if not res:
-                res = self.importer.str2value(val, ctype,
-                                              external_id=external_id,
-                                              model=model)
+                res = self.str2value(val, ctype, external_id=external_id,
+                                     model=model)
             if param:
                 self.params[(model, param)] = res
 
@@ -337,7 +348,9 @@ class XML:
                 self._raise('%r is not known' % record.tag, **records.attrib)
 
     def run(self):
-        records = etree.fromstring(self.importer.file_to_import)
+        with self.importer.open_file_to_import() as fp:
+            records = etree.parse(fp).getroot()
+
         if records.tag.lower() == 'records':
             self.import_records(records)
         else:
@@ -0,0 +1,535 @@
+# This file is a part of the AnyBlok project
+#
+#    Copyright (C) 2016 Jean-Sebastien SUZANNE <jssuzanne@anybox.fr>
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file,You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+import json
+import sys
+from collections import OrderedDict
+from threading import RLock
+from time import time
+from sqlalchemy import text, inspect
+from sqlalchemy.exc import NoInspectionAvailable
+from .config import Configuration
+from logging import getLogger
+logger = getLogger(__name__)
+
+
+class MethodCache:
+    """ Store the values of one method decorated by ``cache`` or
+    ``classmethod_cache``
+
+    The values are forgotten:
+
+    * in the order of the least recently used, if more than ``size`` values
+      are stored
+    * after ``ttl`` seconds, if the ttl is defined
+    * by the ``CacheManager`` if the memory budget of the registry is
+      exceeded
+    """
+
+    kwargs_mark = (object(),)
+
+    def __init__(self, manager, namespace, attr, size=128, ttl=None):
+        self.manager = manager
+        self.namespace = namespace
+        self.attr = attr
+        self.size = size
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def make_key(self, args, kwargs):
+        """ Return the key of the value in function of the arguments
+
+        :param args: positional arguments of the method
+        :param kwargs: named arguments of the method
+        :rtype: hashable key
+        """
+        if kwargs:
+            return args + self.kwargs_mark + tuple(sorted(kwargs.items()))
+
+        return args
+
+    def get(self, key):
+        """ Return the cached value for the key
+
+        :param key: key of the value
+        :rtype: tuple (Boolean, True if the value is found; value)
+        """
+        with self.manager.lock:
+            entry = self.data.get(key)
+            if entry is None:
+                self.misses += 1
+                return False, None
+
+            value, expire_at, memory = entry
+            if expire_at is not None and expire_at <= time():
+                self.pop(key)
+                self.expirations += 1
+                self.misses += 1
+                return False, None
+
+            self.data.move_to_end(key)
+            self.manager.touch(self, key)
+            self.hits += 1
+            return True, value
+
+    def set(self, key, value):
+        """ Save the value for the key
+
+        :param key: key of the value
+        :param value: value to cache
+        """
+        with self.manager.lock:
+            if key in self.data:
+                self.pop(key)
+
+            expire_at = None
+            if self.ttl is not None:
+                expire_at = time() + self.ttl
+
+            memory = self.manager.sizeof(value)
+            self.data[key] = (value, expire_at, memory)
+            self.manager.add(self, key, memory)
+            if self.size is not None:
+                while len(self.data) > self.size:
+                    self.evict(next(iter(self.data)))
+
+            self.manager.apply_memory_budget()
+
+    def pop(self, key):
+        """ Forget the value of the key
+
+        :param key: key of the value
+        """
+        with self.manager.lock:
+            value, expire_at, memory = self.data.pop(key)
+            self.manager.remove(self, key, memory)
+
+    def evict(self, key):
+        """ Forget the value of the key to free place in the cache
+
+        :param key: key of the value
+        """
+        self.pop(key)
+        self.evictions += 1
+
+    def clear(self):
+        """ Forget all the values """
+        with self.manager.lock:
+            for key in list(self.data.keys()):
+                self.pop(key)
+
+    def statistics(self):
+        """ Return the counters of the cache
+
+        :rtype: dict
+        """
+        return dict(hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, expirations=self.expirations,
+                    entries=len(self.data),
+                    memory=sum(x[2] for x in self.data.values()))
+
+
+class RecordMethodCache(MethodCache):
+    """ Store the values of one instance method decorated by
+    ``cache(by_record=True)``
+
+    The key does not contain the instance but the registry name and the
+    primary keys of the record, so the cache does not keep the instance
+    (and then its session) alive, and the values are shared by all the
+    instances of the same record.
+
+    The values of a record are forgotten when the record is updated or
+    deleted by ``SqlBase.update`` / ``SqlBase.delete``. At the commit, the
+    other registries are told by ``Model.System.Cache.invalidate_records``
+    to forget all the values of the model, and the values cached during a
+    transaction rolled back are forgotten.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(RecordMethodCache, self).__init__(*args, **kwargs)
+        self.records = {}
+
+    def make_key(self, args, kwargs):
+        """ Return the key of the value in function of the arguments
+
+        :param args: positional arguments of the method, the first one is
+            the instance
+        :param kwargs: named arguments of the method
+        :rtype: hashable key, None if the instance is not persisted
+        """
+        record = self.get_record(args[0])
+        if record is None:
+            return None
+
+        return (record,) + super(RecordMethodCache, self).make_key(
+            args[1:], kwargs)
+
+    @classmethod
+    def get_record(cls, instance):
+        """ Return the identity of the record
+
+        :param instance: instance of the SQL model
+        :rtype: tuple (registry name, primary keys), None if the instance
+            has not got identity yet
+        """
+        try:
+            identity = inspect(instance).identity
+        except NoInspectionAvailable:
+            return None
+
+        if identity is None:
+            return None
+
+        return (instance.__registry_name__, identity)
+
+    def set(self, key, value):
+        with self.manager.lock:
+            super(RecordMethodCache, self).set(key, value)
+            if key in self.data:
+                self.records.setdefault(key[0], set()).add(key)
+
+    def pop(self, key):
+        with self.manager.lock:
+            super(RecordMethodCache, self).pop(key)
+            keys = self.records.get(key[0])
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.records[key[0]]
+
+    def forget_record(self, record):
+        """ Forget all the values of the record
+
+        :param record: tuple (registry name, primary keys)
+        """
+        with self.manager.lock:
+            for key in list(self.records.get(record, ())):
+                self.pop(key)
+
+
+class CacheManager:
+    """ Manage all the cached methods of one registry
+
+    The manager is a plugin defined by the configuration::
+
+        --cache-manager-cls anyblok.cache:MyCacheManager
+
+    The memory budget (``--cache-memory-budget``, in bytes) is shared by all
+    the cached methods of the registry, the least recently used values of
+    all the cached methods are forgotten when the budget is exceeded. The
+    memory of a value is estimated by ``sys.getsizeof``.
+
+    The statistics are read from the registry::
+
+        registry.cache_manager.statistics()
+    """
+
+    method_cache_cls = MethodCache
+    record_method_cache_cls = RecordMethodCache
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.memory_budget = Configuration.get('cache_memory_budget')
+        self.default_ttl = Configuration.get('cache_default_ttl')
+        self.lock = RLock()
+        self.entries = OrderedDict()
+        self.memory = 0
+        self.method_caches = []
+        self.record_method_caches = []
+
+    def get_method_cache(self, namespace, attr, size=128, ttl=None,
+                         by_record=False):
+        """ Return a new store for one cached method
+
+        :param namespace: namespace of the model
+        :param attr: name of the cached method
+        :param size: max number of values stored, None for unlimited
+        :param ttl: time to live of the values in seconds, if None then the
+            default ttl is used
+        :param by_record: if True the values are stored by record
+        :rtype: ``MethodCache`` instance
+        """
+        if ttl is None:
+            ttl = self.default_ttl
+
+        if by_record:
+            method_cache = self.record_method_cache_cls(
+                self, namespace, attr, size=size, ttl=ttl)
+            self.record_method_caches.append(method_cache)
+        else:
+            method_cache = self.method_cache_cls(
+                self, namespace, attr, size=size, ttl=ttl)
+
+        self.method_caches.append(method_cache)
+        return method_cache
+
+    def invalidate_record(self, instance):
+        """ Forget the values cached by record for this instance
+
+        :param instance: instance of the SQL model
+        """
+        if not self.record_method_caches:
+            return
+
+        record = RecordMethodCache.get_record(instance)
+        if record is None:
+            return
+
+        for method_cache in self.record_method_caches:
+            method_cache.forget_record(record)
+
+        self.publish_record_invalidation(record[0])
+
+    def invalidate_models(self, *registry_names):
+        """ Forget the values cached by record for all the records of the
+        models, used when the records are updated or deleted by one SQL
+        statement
+
+        :param registry_names: registry names of the models
+        """
+        if not self.record_method_caches:
+            return
+
+        self.forget_models(*registry_names)
+        self.publish_record_invalidation(*registry_names)
+
+    def publish_record_invalidation(self, *registry_names):
+        """ Invalidate at the commit the methods cached by record of the
+        models in the other registries, with a precommit hook on
+        ``Model.System.Cache.invalidate_records``
+
+        :param registry_names: registry names of the models
+        """
+        namespaces = set(x.namespace for x in self.record_method_caches)
+        for registry_name in registry_names:
+            if registry_name in namespaces:
+                self.registry.precommit_hook(
+                    'Model.System.Cache', 'invalidate_records', registry_name)
+
+    def forget_models(self, *registry_names):
+        """ Forget the values cached by record for all the records of the
+        models, only in this registry
+
+        :param registry_names: registry names of the models
+        """
+        with self.lock:
+            for method_cache in self.record_method_caches:
+                for record in list(method_cache.records):
+                    if record[0] in registry_names:
+                        method_cache.forget_record(record)
+
+    def sizeof(self, value):
+        """ Return the estimated memory of the value
+
+        :param value: cached value
+        :rtype: int, number of bytes
+        """
+        return sys.getsizeof(value)
+
+    def add(self, method_cache, key, memory):
+        self.entries[(id(method_cache), key)] = method_cache
+        self.memory += memory
+
+    def touch(self, method_cache, key):
+        self.entries.move_to_end((id(method_cache), key))
+
+    def remove(self, method_cache, key, memory):
+        del self.entries[(id(method_cache), key)]
+        self.memory -= memory
+
+    def apply_memory_budget(self):
+        """ Forget the least recently used values of all the cached
+        methods while the memory budget is exceeded """
+        if self.memory_budget is None:
+            return
+
+        with self.lock:
+            while self.entries and self.memory > self.memory_budget:
+                (_, key), method_cache = next(iter(self.entries.items()))
+                method_cache.evict(key)
+
+    def clear(self):
+        """ Forget all the values of all the cached methods """
+        with self.lock:
+            for method_cache in self.method_caches:
+                method_cache.clear()
+
+    def statistics(self):
+        """ Return the counters by cached method and the total
+
+        :rtype: dict {(namespace, method): {counter: value}, None: total}
+        """
+        res = {None: dict(hits=0, misses=0, evictions=0, expirations=0,
+                          entries=0, memory=0)}
+        with self.lock:
+            for method_cache in self.method_caches:
+                stats = method_cache.statistics()
+                for key in ((method_cache.namespace, method_cache.attr), None):
+                    if key not in res:
+                        res[key] = dict.fromkeys(stats.keys(), 0)
+
+                    for counter, value in stats.items():
+                        res[key][counter] += value
+
+        return res
+
+
+class CacheInvalidationTransport:
+    """ Default transport of the cache invalidations
+
+    Nothing is pushed, the ``Model.System.Cache`` polls the ``system_cache``
+    table to find the invalidations done by the other processes.
+
+    A transport is a plugin defined by the configuration::
+
+        --cache-invalidation-transport-cls anyblok.cache:MyTransport
+
+    The transport pushes the ``(registry_name, method)`` events to all the
+    registries linked with the same database. The ``system_cache`` table is
+    kept as a durable fallback when the transport can not listen.
+    """
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.events = []
+
+    def start(self):
+        """ Start to listen the invalidations """
+
+    def stop(self):
+        """ Stop to listen the invalidations """
+
+    def is_listening(self):
+        """ Return True if the events are pushed by the transport
+
+        :rtype: Boolean
+        """
+        return False
+
+    def publish(self, registry_name, method):
+        """ Send the invalidation to all the registries
+
+        :param registry_name: namespace of the model
+        :param method: name of the cached method
+        """
+
+    def receive(self):
+        """ Return and forget the invalidations received
+
+        :rtype: list of ``(registry_name, method)``
+        """
+        events, self.events = self.events, []
+        return events
+
+
+class LocalCacheInvalidationTransport(CacheInvalidationTransport):
+    """ Push the invalidations to all the registries of the current process
+    linked with the same database
+
+    This transport does not need any database feature, it is used by the
+    unittest or by applications which only have one process.
+    """
+
+    subscribers = {}
+
+    def start(self):
+        subscribers = self.subscribers.setdefault(self.registry.db_name, [])
+        if self not in subscribers:
+            subscribers.append(self)
+
+    def stop(self):
+        subscribers = self.subscribers.get(self.registry.db_name, [])
+        if self in subscribers:
+            subscribers.remove(self)
+
+    def is_listening(self):
+        return self in self.subscribers.get(self.registry.db_name, [])
+
+    def publish(self, registry_name, method):
+        for subscriber in self.subscribers.get(self.registry.db_name, []):
+            subscriber.events.append((registry_name, method))
+
+
+class PostgreSQLCacheInvalidationTransport(CacheInvalidationTransport):
+    """ Push the invalidations with the PostgreSQL ``LISTEN`` / ``NOTIFY``
+
+    The notification is sent in the transaction of the session, so the other
+    registries receive it only after the commit. A dedicated connection in
+    autocommit mode listens the channel.
+
+    If the listening connection fails, then the transport stops to listen
+    and the ``Model.System.Cache`` comes back to poll the ``system_cache``
+    table.
+    """
+
+    channel = 'anyblok_cache_invalidation'
+
+    def __init__(self, registry):
+        super(PostgreSQLCacheInvalidationTransport, self).__init__(registry)
+        self.connection = None
+
+    def start(self):
+        if self.connection is not None:
+            return
+
+        engine = self.registry.engine
+        if engine.dialect.name != 'postgresql':
+            logger.warning("The cache invalidation can not be pushed with "
+                           "the %r dialect" % engine.dialect.name)
+            return
+
+        try:
+            connection = engine.connect().execution_options(
+                isolation_level='AUTOCOMMIT')
+            connection.execute('LISTEN %s' % self.channel)
+            self.connection = connection
+        except Exception:
+            logger.exception("Impossible to listen the cache invalidations")
+
+    def stop(self):
+        if self.connection is None:
+            return
+
+        try:
+            self.connection.execute('UNLISTEN %s' % self.channel)
+            self.connection.close()
+        except Exception:
+            logger.exception("Error during the stop of the listening of the "
+                             "cache invalidations")
+        finally:
+            self.connection = None
+
+    def is_listening(self):
+        return self.connection is not None
+
+    def publish(self, registry_name, method):
+        payload = json.dumps(dict(registry_name=registry_name, method=method))
+        self.registry.execute(text("SELECT pg_notify(:channel, :payload)"),
+                              dict(channel=self.channel, payload=payload))
+        # the notification is only received after the commit, the current
+        # registry must be invalidated now
+        self.events.append((registry_name, method))
+
+    def receive(self):
+        events = super(PostgreSQLCacheInvalidationTransport, self).receive()
+        if self.connection is None:
+            return events
+
+        try:
+            dbapi_connection = self.connection.connection.connection
+            dbapi_connection.poll()
+            while dbapi_connection.notifies:
+                notify = dbapi_connection.notifies.pop(0)
+                payload = json.loads(notify.payload)
+                events.append((payload['registry_name'], payload['method']))
+        except Exception:
+            logger.exception("Lost the listening of the cache invalidations, "
+                             "the system_cache table is used")
+            self.stop()
+
+        return events
@@ -6,7 +6,6 @@
 # v. 2.0. If a copy of the MPL was not distributed with this file,You can
 # obtain one at http://mozilla.org/MPL/2.0/.
 import sys
-from functools import lru_cache
 
 
 """Define the prefixe for the mapper attribute for the column"""
@@ -87,11 +86,26 @@ def apply_cache(attr, method, registry, namespace, base, properties):
         elif attr not in registry.caches[namespace]:
             registry.caches[namespace][attr] = []
 
-        @lru_cache(maxsize=method.size)
+        method_cache = registry.cache_manager.get_method_cache(
+            namespace, attr, size=method.size,
+            ttl=getattr(method, 'ttl', None),
+            by_record=getattr(method, 'by_record', False))
+
         def wrapper(*args, **kwargs):
-            return method(*args, **kwargs)
+            key = method_cache.make_key(args, kwargs)
+            if key is None:
+                return method(*args, **kwargs)
+
+            found, value = method_cache.get(key)
+            if not found:
+                value = method(*args, **kwargs)
+                method_cache.set(key, value)
+
+            return value
 
         wrapper.indentify = (namespace, attr)
+        wrapper.cache_clear = method_cache.clear
+        wrapper.cache_statistics = method_cache.statistics
         registry.caches[namespace][attr].append(wrapper)
         if method.is_cache_classmethod:
             return {attr: classmethod(wrapper)}
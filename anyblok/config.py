@@ -263,7 +263,8 @@ class Configuration:
     applications = {
         'default': {
             'description': "[options] -- other arguments",
-            'configuration_groups': ['config', 'database'],
+            'configuration_groups': ['config', 'database', 'cache',
+                                     'migration'],
         },
     }
 
@@ -541,7 +542,8 @@ class Configuration:
 
         description.update(kwargs)
         _configuration_groups = description.pop('configuration_groups',
-                                                ['config', 'database'])
+                                                ['config', 'database',
+                                                 'cache', 'migration'])
         configuration_groups = set(configuration_groups or []).union(
             _configuration_groups)
         configuration_groups.add('plugins')
@@ -701,6 +703,16 @@ def add_plugins(group):
                        type=AnyBlokPlugin,
                        default='anyblok.migration:Migration',
                        help="Migration class to use")
+    group.add_argument('--cache-invalidation-transport-cls',
+                       dest='CacheInvalidationTransport',
+                       type=AnyBlokPlugin,
+                       default='anyblok.cache:CacheInvalidationTransport',
+                       help="Transport class to push the cache invalidations "
+                            "to the other registries")
+    group.add_argument('--cache-manager-cls', dest='CacheManager',
+                       type=AnyBlokPlugin,
+                       default='anyblok.cache:CacheManager',
+                       help="Manager class of the cached methods")
     group.add_argument('--get-url-fnct', dest='get_url',
                        type=AnyBlokPlugin,
                        default='anyblok.config:get_url',
@@ -713,6 +725,11 @@ def add_configuration_file(parser):
                         help="Relative path of the config file")
     parser.add_argument('--without-auto-migration', dest='withoutautomigration',
                         action='store_true')
+    parser.add_argument('--registry-snapshot', dest='registry_snapshot',
+                        action='store_true',
+                        help="Load the registry without migration when the "
+                             "installed bloks and their code are the same "
+                             "as at the last migration")
 
 
 @Configuration.add('database', label="Database",
@@ -747,12 +764,55 @@ def add_database(group):
     group.add_argument('--db-echo-pool', action="store_true", default=False)
     group.add_argument('--db-max-overflow', type=int, default=10)
     group.add_argument('--db-pool-size', type=int, default=5)
+    group.add_argument('--db-in-chunk-size', type=int, default=1000,
+                       help="Maximum number of primary keys by IN clause, "
+                            "used by from_multi_primary_keys")
+    group.add_argument('--db-bulk-chunk-size', type=int, default=1000,
+                       help="Maximum number of entries by INSERT, used by "
+                            "multi_insert with bulk=True")
     group.add_argument('--default-encrypt-key',
                        default=os.environ.get('ANYBLOK_ENCRYPT_KEY'),
                        help=("Default ey definition to encrypt column with "
                              "encryp_key=True"))
 
 
+@Configuration.add('cache', label="Cache", must_be_loaded_by_unittest=True)
+def add_cache(group):
+    group.add_argument('--cache-memory-budget', type=int,
+                       help="Max memory (in bytes) used by all the cached "
+                            "methods of a registry, no limit by default")
+    group.add_argument('--cache-default-ttl', type=int,
+                       help="Time to live (in seconds) of the cached values, "
+                            "no expiration by default")
+
+
+@Configuration.add('migration', label="Migration",
+                   must_be_loaded_by_unittest=True)
+def add_migration(group):
+    group.add_argument('--incremental-migration',
+                       dest='incremental_migration', action='store_true',
+                       help="Compare with the database only the tables "
+                            "which changed since the last migration, or "
+                            "which belong to the bloks to install or to "
+                            "update")
+    group.add_argument('--online-migration', dest='online_migration',
+                       action='store_true',
+                       help="PostgreSQL only, apply the migration without "
+                            "long exclusive locks: the indexes are created "
+                            "concurrently, the default values and the NOT "
+                            "NULL constraints are applied after the commit")
+    group.add_argument('--migration-lock-timeout', type=int, default=5000,
+                       help="Online migration: lock timeout (in ms) of the "
+                            "DDL statements")
+    group.add_argument('--migration-lock-retry', type=int, default=5,
+                       help="Online migration: number of retries when the "
+                            "lock timeout is reached")
+    group.add_argument('--migration-batch-size', type=int, default=10000,
+                       help="Online migration: number of rows updated by "
+                            "statement to fill the default value of a new "
+                            "column")
+
+
 @Configuration.add('create_db', must_be_loaded_by_unittest=True)
 def add_create_database(group):
     group.add_argument(
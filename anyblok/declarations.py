@@ -129,31 +129,53 @@ class Declarations:
             return wrapper
 
 
-def cache(size=128):
+def cache(size=128, ttl=None, by_record=False):
+    """ Cache the result of the method
+
+    :param size: max number of cached results, None for unlimited
+    :param ttl: time to live of the cached results in seconds, if None the
+        ``cache_default_ttl`` configuration is used
+    :param by_record: if True, the results are cached by registry name and
+        primary keys of the record, not by instance. They are invalidated
+        when the record is updated or deleted
+    """
     autodoc = """
-    **Cached method** with size=%(size)s
-    """ % dict(size=size)
+    **Cached method** with size=%(size)s and ttl=%(ttl)s
+    """ % dict(size=size, ttl=ttl)
+    if by_record:
+        autodoc = """
+    **Cached method by record** with size=%(size)s and ttl=%(ttl)s
+    """ % dict(size=size, ttl=ttl)
 
     def wrapper(method):
         add_autodocs(method, autodoc)
         method.is_cache_method = True
         method.is_cache_classmethod = False
         method.size = size
+        method.ttl = ttl
+        method.by_record = by_record
         return method
 
     return wrapper
 
 
-def classmethod_cache(size=128):
+def classmethod_cache(size=128, ttl=None):
+    """ Cache the result of the classmethod
+
+    :param size: max number of cached results, None for unlimited
+    :param ttl: time to live of the cached results in seconds, if None the
+        ``cache_default_ttl`` configuration is used
+    """
     autodoc = """
-    **Cached classmethod** with size=%(size)s
-    """ % dict(size=size)
+    **Cached classmethod** with size=%(size)s and ttl=%(ttl)s
+    """ % dict(size=size, ttl=ttl)
 
     def wrapper(method):
         add_autodocs(method, autodoc)
         method.is_cache_method = True
         method.is_cache_classmethod = True
         method.size = size
+        method.ttl = ttl
         return method
 
     return wrapper
@@ -1,12 +1,15 @@
 # -*- coding: utf-8 -*-
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.exc import IntegrityError, OperationalError, ProgrammingError
 from alembic.migration import MigrationContext
 from alembic.autogenerate import compare_metadata
 from alembic.operations import Operations
 from sqlalchemy import schema
 from contextlib import contextmanager
-from sqlalchemy import func, select, update, join, alias, and_
+from sqlalchemy import (func, select, update, join, alias, and_, text,
+                        bindparam)
 from anyblok.config import Configuration
+from hashlib import sha1
+from time import sleep
 import re
 from logging import getLogger
 
@@ -484,19 +487,29 @@ class MigrationColumn:
         """ Add a new column
 
         The column is added in two phases, the last phase is only for the
-        the nullable, if nullable can not be applied, a warning is logged
+        the nullable, if nullable can not be applied, a warning is logged.
+        In online mode, the scalar default value and the nullable are
+        applied after the commit, see ``Migration.defer_default_value`` and
+        ``Migration.defer_not_null``
 
         :param column: sqlalchemy column
         :rtype: MigrationColumn instance
         """
+        migration = self.table.migration
         nullable = column.nullable
         if not nullable:
             column.nullable = True
 
-        self.table.migration.operation.impl.add_column(self.table.name, column)
-        self.apply_default_value(column)
+        migration.with_lock_timeout(migration.operation.impl.add_column,
+                                    self.table.name, column)
+        if migration.online and getattr(column.default, 'is_scalar', False):
+            migration.defer_default_value(self.table.name, column)
+        else:
+            self.apply_default_value(column)
 
-        if not nullable:
+        if not nullable and migration.online:
+            migration.defer_not_null(self.table.name, column.name)
+        elif not nullable:
             c = MigrationColumn(self.table, column.name)
             c.alter(existing_type=column.type,
                     existing_server_default=column.server_default,
@@ -518,7 +531,8 @@ class MigrationColumn:
         """ Alter an existing column
 
         Alter the column in two phases, because the nullable column has not
-        locked the migration
+        locked the migration. In online mode, the NOT NULL is applied after
+        the commit, see ``Migration.defer_not_null``
 
         .. warning::
             See Alembic alter_column, the existing_* param are used for some
@@ -549,19 +563,26 @@ class MigrationColumn:
             vals['new_column_name'] = kwargs['name']
             name = kwargs['name']
 
+        migration = self.table.migration
         if vals:
-            self.table.migration.operation.alter_column(
-                self.table.name, self.name, **vals)
+            migration.with_lock_timeout(migration.operation.alter_column,
+                                        self.table.name, self.name, **vals)
 
         if 'nullable' in kwargs:
             nullable = kwargs['nullable']
+            if not nullable and migration.online:
+                migration.defer_not_null(self.table.name, name)
+                return MigrationColumn(self.table, name)
+
             savepoint = '%s_not_null' % name
             try:
-                self.table.migration.savepoint(savepoint)
-                self.table.migration.operation.alter_column(
+                migration.savepoint(savepoint)
+                migration.with_lock_timeout(
+                    migration.operation.alter_column,
                     self.table.name, self.name, nullable=nullable, **vals)
             except IntegrityError as e:
-                self.table.migration.rollback_savepoint(savepoint)
+                migration.rollback_savepoint(savepoint)
+                migration.tables_not_applied.add(self.table.name)
                 logger.warn(str(e))
 
         return MigrationColumn(self.table, name)
@@ -657,6 +678,7 @@ class MigrationConstraintUnique:
                 self.name, self.table.name, columns_name)
         except IntegrityError as e:
             self.table.migration.rollback_savepoint(savepoint)
+            self.table.migration.tables_not_applied.add(self.table.name)
             logger.warn("Error during the add of new unique constraint %r on "
                         "table %r and columns %r : %r " % (self.name,
                                                            self.table.name,
@@ -758,7 +780,8 @@ class MigrationIndex:
         return None
 
     def add(self, *columns):
-        """ Add the constraint
+        """ Add the constraint, in online mode the index is created
+        concurrently after the commit, see ``Migration.defer_index``
 
         :param \*column: list of column name
         :rtype: MigrationIndex instance
@@ -768,10 +791,16 @@ class MigrationIndex:
             raise MigrationException(
                 "To add an index you must define one or more columns")
 
+        migration = self.table.migration
         index_name = self.format_name(*columns)
         columns_name = [x.name for x in columns]
-        self.table.migration.operation.create_index(
-            index_name, self.table.name, columns_name)
+        if migration.online:
+            migration.defer_index(index_name, self.table.name, columns_name)
+            self.name = index_name
+            return self
+
+        migration.with_lock_timeout(migration.operation.create_index,
+                                    index_name, self.table.name, columns_name)
 
         return MigrationIndex(self.table, *columns)
 
@@ -896,16 +925,22 @@ class Migration:
         c = t.column('My column name from t')
     """
 
+    signatures_key = 'anyblok.migration.table_signatures'
+
     def __init__(self, registry):
+        self.registry = registry
         self.withoutautomigration = registry.withoutautomigration
         self.conn = registry.session.connection()
         self.metadata = registry.declarativebase.metadata
+        self.tables_to_compare = None
+        self.tables_not_applied = set()
 
         opts = {
             'compare_type': True,
             'compare_server_default': True,
             'render_item': self.render_item,
             'compare_type': self.compare_type,
+            'include_symbol': self.include_symbol,
         }
         self.context = MigrationContext.configure(self.conn, opts=opts)
         self.operation = Operations(self.context)
@@ -915,6 +950,17 @@ class Migration:
         self.reinit_indexes = Configuration.get('reinit_indexes', False)
         self.reinit_constraints = Configuration.get(
             'reinit_constraints', False)
+        self.incremental = Configuration.get('incremental_migration', False)
+        self.online = (Configuration.get('online_migration', False) and
+                       self.conn.dialect.name == 'postgresql')
+        self.lock_timeout = Configuration.get('migration_lock_timeout', 5000)
+        self.lock_retry = Configuration.get('migration_lock_retry', 5)
+        self.batch_size = Configuration.get('migration_batch_size', 10000)
+        self.deferred_operations = []
+        if any((self.reinit_all, self.reinit_tables, self.reinit_columns,
+                self.reinit_indexes, self.reinit_constraints)):
+            # the tables which are not in the metadata must be compared
+            self.incremental = False
 
     def table(self, name=None):
         """ Get a table
@@ -927,15 +973,137 @@ class Migration:
         """ Upgrade the database automaticly """
         report = self.detect_changed()
         report.apply_change()
+        if self.incremental:
+            self.save_table_signatures()
 
     def detect_changed(self):
         """ Detect the difference between the metadata and the database
 
+        In incremental mode, only the tables given by
+        ``get_tables_to_compare`` are reflected and compared
+
         :rtype: MigrationReport instance
         """
-        diff = compare_metadata(self.context, self.metadata)
+        self.tables_to_compare = None
+        if self.incremental:
+            self.tables_to_compare = self.get_tables_to_compare()
+            logger.info('Compare the tables %r' % sorted(
+                self.tables_to_compare))
+
+        if self.tables_to_compare is not None and not self.tables_to_compare:
+            diff = []
+        else:
+            diff = compare_metadata(self.context, self.metadata)
+
         return MigrationReport(self, diff)
 
+    def include_symbol(self, tablename, schema):
+        """ Filter the tables compared by alembic """
+        if self.tables_to_compare is None:
+            return True
+
+        return tablename in self.tables_to_compare
+
+    @staticmethod
+    def get_table_signature(table):
+        """ Return the signature of the definition of the table in the
+        metadata, it changes when the columns, the constraints or the
+        indexes change
+
+        :param table: SQLAlchemy table
+        :rtype: str
+        """
+        definition = []
+        for column in table.columns:
+            server_default = column.server_default
+            if server_default is not None:
+                server_default = str(getattr(server_default, 'arg',
+                                             server_default))
+
+            definition.append((
+                column.name, repr(column.type), column.nullable,
+                column.primary_key, server_default,
+                sorted(fk.target_fullname for fk in column.foreign_keys)))
+
+        for constraint in table.constraints:
+            sqltext = getattr(constraint, 'sqltext', None)
+            definition.append((
+                constraint.__class__.__name__, str(constraint.name),
+                sorted(column.name for column in constraint.columns),
+                None if sqltext is None else str(sqltext)))
+
+        for index in table.indexes:
+            definition.append((
+                'Index', str(index.name), index.unique,
+                sorted(column.name for column in index.columns)))
+
+        definition.sort(key=repr)
+        return sha1(repr(definition).encode('utf-8')).hexdigest()
+
+    def get_table_signatures(self):
+        """ Return the signatures of all the tables of the metadata
+
+        :rtype: dict {table name: signature}
+        """
+        return {name: self.get_table_signature(table)
+                for name, table in self.metadata.tables.items()}
+
+    def get_saved_table_signatures(self):
+        """ Return the signatures saved by the last incremental migration
+
+        :rtype: dict {table name: signature}
+        """
+        Parameter = self.registry.System.Parameter
+        if Parameter.is_exist(self.signatures_key):
+            return Parameter.get(self.signatures_key)
+
+        return {}
+
+    def save_table_signatures(self):
+        """ Save the signatures of the tables, the database is the same
+        as the metadata. The tables whose changes are not applied (a
+        logged error, or an operation deferred after the commit) keep their
+        previous signature, they are compared again by the next migration
+        """
+        signatures = self.get_table_signatures()
+        saved_signatures = self.get_saved_table_signatures()
+        for name in self.tables_not_applied:
+            if name in saved_signatures:
+                signatures[name] = saved_signatures[name]
+            else:
+                signatures.pop(name, None)
+
+        self.registry.System.Parameter.set(self.signatures_key, signatures)
+
+    def get_tables_to_compare(self):
+        """ Return the tables which must be compared with the database:
+
+        * the tables whose the definition changed since the last incremental
+          migration
+        * the tables of the bloks to install or to update
+        * the tables with a foreign key to one of these tables
+
+        :rtype: set of the table names
+        """
+        saved_signatures = self.get_saved_table_signatures()
+        tables = set(
+            name for name, signature in self.get_table_signatures().items()
+            if saved_signatures.get(name) != signature)
+
+        query = """
+            SELECT name
+            FROM system_blok
+            WHERE state in ('toinstall', 'toupdate')"""
+        bloks = [x[0] for x in self.conn.execute(query).fetchall()]
+        tables |= self.registry.get_tables_of_bloks(*bloks)
+
+        for name, table in self.metadata.tables.items():
+            for fk in table.foreign_keys:
+                if fk.target_fullname.rsplit('.', 1)[0] in tables:
+                    tables.add(name)
+
+        return tables
+
     def savepoint(self, name=None):
         """ Add a savepoint
 
@@ -958,6 +1126,248 @@ class Migration:
         """
         self.conn._release_savepoint_impl(name, None)
 
+    @staticmethod
+    def is_lock_timeout(exception):
+        """ Return True if the exception comes from the lock timeout
+
+        :param exception: OperationalError instance
+        :rtype: Boolean
+        """
+        return getattr(exception.orig, 'pgcode', None) == '55P03'
+
+    def wait_before_retry(self, exception, attempt):
+        """ Raise the exception if it must not be retried, else wait
+        before the next attempt
+
+        :param exception: OperationalError instance
+        :param attempt: number of the failed attempt
+        :exception: OperationalError
+        """
+        if not self.is_lock_timeout(exception) or attempt >= self.lock_retry:
+            raise exception
+
+        logger.warning("Lock timeout reached (attempt %d/%d): %s" % (
+            attempt + 1, self.lock_retry + 1, exception))
+        sleep(attempt + 1)
+
+    def with_lock_timeout(self, fnct, *args, **kwargs):
+        """ Call the function which executes DDL statements. In online
+        mode, the statements wait for their lock at most the lock timeout,
+        the function is called again (``lock_retry`` times) when the timeout
+        is reached
+
+        :param fnct: function to call
+        :rtype: the result of the function
+        :exception: OperationalError
+        """
+        if not self.online:
+            return fnct(*args, **kwargs)
+
+        attempt = 0
+        while True:
+            savepoint = self.savepoint('lock_timeout_%d' % attempt)
+            try:
+                self.conn.execute(
+                    "SET LOCAL lock_timeout = %d" % self.lock_timeout)
+                res = fnct(*args, **kwargs)
+                self.conn.execute("SET LOCAL lock_timeout = DEFAULT")
+                self.release_savepoint(savepoint)
+                return res
+            except OperationalError as e:
+                self.rollback_savepoint(savepoint)
+                self.wait_before_retry(e, attempt)
+                attempt += 1
+
+    def defer(self, *statements, repeat=False, cleanup=None, index=None):
+        """ Add an operation to execute after the commit, outside of the
+        transaction
+
+        :param statements: SQLAlchemy text clauses, executed in this order
+        :param repeat: if True, each statement is executed while it updates
+            rows
+        :param cleanup: SQLAlchemy text clause executed if a statement
+            raises an IntegrityError, the next statements are not executed
+        :param index: name of the index built by the statements, an invalid
+            index with this name, left by a failed ``CREATE INDEX
+            CONCURRENTLY``, is dropped before each attempt
+        """
+        key = [str(x) for x in statements]
+        for operation in self.deferred_operations:
+            if [str(x) for x in operation[0]] == key:
+                # already deferred by a previous load of the registry
+                return
+
+        self.deferred_operations.append(
+            [list(statements), repeat, cleanup, index])
+
+    def quote(self, name):
+        return self.conn.dialect.identifier_preparer.quote(name)
+
+    def defer_index(self, name, table, columns):
+        """ Create the index concurrently after the commit, an invalid
+        index with the same name is dropped before
+
+        :param name: name of the index
+        :param table: name of the table
+        :param columns: list of the column names
+        """
+        self.tables_not_applied.add(table)
+        self.defer(text(
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS %s ON %s (%s)" % (
+                self.quote(name), self.quote(table),
+                ', '.join(self.quote(x) for x in columns))), index=name)
+
+    def defer_default_value(self, table, column):
+        """ Fill the scalar default value of the new column after the
+        commit, by batch of ``batch_size`` rows, each batch is committed
+
+        :param table: name of the table
+        :param column: SQLAlchemy column
+        """
+        self.tables_not_applied.add(table)
+        statement = text(
+            "UPDATE %(table)s SET %(column)s = :value WHERE ctid = ANY(ARRAY("
+            "SELECT ctid FROM %(table)s WHERE %(column)s IS NULL "
+            "LIMIT %(limit)d))" % dict(table=self.quote(table),
+                                       column=self.quote(column.name),
+                                       limit=self.batch_size))
+        statement = statement.bindparams(
+            bindparam('value', value=column.default.arg, type_=column.type))
+        self.defer(statement, repeat=True)
+
+    def defer_not_null(self, table, column):
+        """ Apply the NOT NULL after the commit: a ``NOT VALID`` check
+        constraint is added then validated without blocking the writes, so
+        the ``SET NOT NULL`` does not scan the table (PostgreSQL >= 12)
+
+        :param table: name of the table
+        :param column: name of the column
+        """
+        self.tables_not_applied.add(table)
+        constraint = self.quote(
+            ('anyblok_ck_%s__%s_not_null' % (table, column))[:63])
+        table = self.quote(table)
+        column = self.quote(column)
+        statements = (
+            "ALTER TABLE %s ADD CONSTRAINT %s CHECK (%s IS NOT NULL) "
+            "NOT VALID" % (table, constraint, column),
+            "ALTER TABLE %s VALIDATE CONSTRAINT %s" % (table, constraint),
+            "ALTER TABLE %s ALTER COLUMN %s SET NOT NULL" % (table, column),
+            "ALTER TABLE %s DROP CONSTRAINT %s" % (table, constraint),
+        )
+        self.defer(*[text(x) for x in statements], cleanup=text(
+            "ALTER TABLE %s DROP CONSTRAINT IF EXISTS %s" % (
+                table, constraint)))
+
+    def apply_deferred_operations(self, conn=None):
+        """ Execute the deferred operations, this method is called by the
+        commit of the registry. An operation is removed when it is applied,
+        if an exception is raised the operations not applied stay pending
+        and are applied by the next commit
+
+        :param conn: connection to use, by default a new connection in
+            autocommit mode
+        """
+        if not self.deferred_operations:
+            return
+
+        try:
+            if conn is not None:
+                return self._apply_deferred_operations(conn)
+
+            conn = self.registry.engine.connect().execution_options(
+                isolation_level='AUTOCOMMIT')
+            try:
+                conn.execute("SET lock_timeout = %d" % self.lock_timeout)
+                self._apply_deferred_operations(conn)
+            finally:
+                conn.close()
+        except (OperationalError, ProgrammingError) as e:
+            # the data are already committed, the commit must not fail
+            logger.error("Deferred migration not applied, %d operation(s) "
+                         "stay pending: %s" % (
+                             len(self.deferred_operations), str(e)))
+
+    def _apply_deferred_operations(self, conn):
+        while self.deferred_operations:
+            statements, repeat, cleanup, index = self.deferred_operations[0]
+            try:
+                if index is not None:
+                    self.drop_invalid_index(conn, index)
+
+                while statements:
+                    self.execute_deferred_statement(conn, statements[0],
+                                                    repeat)
+                    statements.pop(0)
+            except IntegrityError as e:
+                logger.warn("Deferred migration not applied: %s" % str(e))
+                if cleanup is not None:
+                    self.execute_deferred_statement(conn, cleanup)
+
+            self.deferred_operations.pop(0)
+
+    def drop_invalid_index(self, conn, name):
+        """ Drop the index if it is invalid, ``CREATE INDEX CONCURRENTLY``
+        leaves an invalid index when it fails, and ``IF NOT EXISTS`` would
+        skip it
+
+        :param conn: connection to use
+        :param name: name of the index
+        """
+        query = text("SELECT 1 FROM pg_index "
+                     "WHERE indexrelid = to_regclass(:name) "
+                     "AND NOT indisvalid").bindparams(name=self.quote(name))
+        if conn.execute(query).fetchall():
+            logger.warning("Drop the invalid index %r" % name)
+            self.execute_deferred_statement(conn, text(
+                "DROP INDEX CONCURRENTLY IF EXISTS %s" % self.quote(name)))
+
+    def execute_deferred_statement(self, conn, statement, repeat=False):
+        """ Execute the deferred statement, again while it updates rows if
+        ``repeat``, and again after a lock timeout (``lock_retry`` times)
+
+        :param conn: connection to use
+        :param statement: SQLAlchemy text clause
+        :param repeat: if True, the statement is executed while it updates
+            rows
+        :exception: OperationalError, IntegrityError
+        """
+        logger.info("Deferred migration: %s" % statement)
+        attempt = 0
+        while True:
+            try:
+                res = self.execute_in_savepoint(conn, statement)
+                attempt = 0
+            except OperationalError as e:
+                self.wait_before_retry(e, attempt)
+                attempt += 1
+                continue
+
+            if not repeat or not res.rowcount:
+                return
+
+    @staticmethod
+    def execute_in_savepoint(conn, statement):
+        """ Execute the statement, in a savepoint if the connection is in a
+        transaction, so an error does not abort the transaction
+
+        :param conn: connection to use
+        :param statement: SQLAlchemy text clause
+        :rtype: result of the statement
+        """
+        if not conn.in_transaction():
+            return conn.execute(statement)
+
+        savepoint = conn.begin_nested()
+        try:
+            res = conn.execute(statement)
+        except Exception:
+            savepoint.rollback()
+            raise
+
+        savepoint.commit()
+        return res
+
     def render_item(self, type_, obj, autogen_context):
         logger.debug("%r, %r, %r" % (type_, obj, autogen_context))
         return False
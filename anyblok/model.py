@@ -12,7 +12,8 @@ from anyblok.relationship import RelationShip
 from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.schema import DDLElement
 from sqlalchemy.sql import table
-from sqlalchemy.orm import Query, mapper, synonym
+from sqlalchemy.orm import (Query, mapper, synonym, ColumnProperty,
+                            RelationshipProperty)
 from sqlalchemy import inspection
 from sqlalchemy.ext.hybrid import hybrid_method
 from anyblok.common import TypeList, apply_cache
@@ -22,6 +23,7 @@ from .mapper import ModelAttribute
 from sqlalchemy import ForeignKeyConstraint
 from anyblok.common import anyblok_column_prefix
 from texttable import Texttable
+from types import MappingProxyType
 
 
 class ModelException(Exception):
@@ -54,6 +56,77 @@ def compile_drop_view(element, compiler, **kw):
     return "DROP VIEW IF EXISTS %s" % (element.name)
 
 
+class ModelMetadata:
+    """ Immutable information of an assembled SQL model
+
+    The information come from the SQLAlchemy mapper of the model, so they
+    are computed without any query and are valid until the next assembly
+    of the registry:
+
+    * registry_name: registry name of the model
+    * primary_keys: tuple of the name of the primary keys, in the order of
+      the identity of the mapper
+    * columns: mapping {name: SQLAlchemy column}
+    * relationships: mapping {name: registry name of the remote model},
+      with the one2many created by the Many2One of the other models
+    * field_types: mapping {name: type of the AnyBlok field}
+    """
+
+    __slots__ = ('registry_name', 'primary_keys', 'columns', 'relationships',
+                 'field_types')
+
+    def __init__(self, registry, model):
+        columns = {}
+        relationships = {}
+        field_types = {}
+        fsp = registry.loaded_namespaces_first_step[model.__registry_name__]
+        for name in model.loaded_columns:
+            field_types[name] = fsp[name].__class__.__name__
+            if name in model.loaded_fields:
+                continue
+
+            field_property = getattr(model, name).property
+            if isinstance(field_property, ColumnProperty):
+                columns[name] = field_property.columns[0]
+            elif isinstance(field_property, RelationshipProperty):
+                relationships[name] = (
+                    field_property.mapper.entity.__registry_name__)
+
+        set_ = super(ModelMetadata, self).__setattr__
+        set_('registry_name', model.__registry_name__)
+        primary_keys = []
+        mapper = inspection.inspect(model)
+        for relationship in mapper.relationships:
+            name = relationship.key
+            if name in model.loaded_columns:
+                continue
+
+            entity = relationship.mapper.entity
+            if hasattr(entity, '__registry_name__'):
+                relationships[name] = entity.__registry_name__
+
+        for column in mapper.primary_key:
+            name = mapper.get_property_by_column(column).key
+            if name.startswith(anyblok_column_prefix):
+                name = name[len(anyblok_column_prefix):]
+
+            primary_keys.append(name)
+
+        set_('primary_keys', tuple(primary_keys))
+        set_('columns', MappingProxyType(columns))
+        set_('relationships', MappingProxyType(relationships))
+        set_('field_types', MappingProxyType(field_types))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%r is immutable" % self)
+
+    def __delattr__(self, name):
+        raise AttributeError("%r is immutable" % self)
+
+    def __repr__(self):
+        return '<ModelMetadata %r>' % self.registry_name
+
+
 def has_sql_fields(bases):
     """ Tells whether the model as field or not
 
@@ -728,6 +801,7 @@ class Model:
         registry.loaded_views = {}
         registry.caches = {}
         registry.events = {}
+        registry.models_metadata = {}
 
         # get all the information to create a namespace
         for namespace in registry.loaded_registries['Model_names']:
@@ -755,9 +829,7 @@ class Model:
 
         Blok = registry.System.Blok
         if not registry.withoutautomigration:
-            Model = registry.System.Model
-            Model.update_list()
-            registry.update_blok_list()
+            registry.System.Model.sync_schema()
 
         bloks = Blok.list_by_state('touninstall')
         Blok.uninstall_all(*bloks)
@@ -6,8 +6,11 @@
 # This Source Code Form is subject to the terms of the Mozilla Public License,
 # v. 2.0. If a copy of the MPL was not distributed with this file,You can
 # obtain one at http://mozilla.org/MPL/2.0/.
-from os.path import join, exists
+from os import walk, stat
+from os.path import join, exists, relpath
 from logging import getLogger
+from hashlib import sha1
+from json import loads
 import nose
 
 from sqlalchemy import create_engine, event, MetaData
@@ -19,11 +22,13 @@ from sqlalchemy.schema import ForeignKeyConstraint
 from sqlalchemy_utils.functions import database_exists
 from .config import Configuration, get_url
 from .migration import Migration
+from .cache import CacheInvalidationTransport, CacheManager
 from .blok import BlokManager
 from .environment import EnvironmentManager
 from .authorization.query import QUERY_WITH_NO_RESULTS, PostFilteredQuery
 from anyblok.common import anyblok_column_prefix
 from .logging import log
+from .release import version
 logger = getLogger(__name__)
 
 
@@ -120,6 +125,39 @@ class RegistryManager:
         cls.registries[db_name] = registry
         return registry
 
+    @classmethod
+    def preload(cls, *db_names, **kwargs):
+        """ Load the registries in the master process of a pre-fork
+        server, then release their connections. The models are assembled
+        once and shared by the forked processes, which must call
+        ``after_fork``::
+
+            RegistryManager.preload(db_name)
+            if os.fork() == 0:
+                RegistryManager.after_fork()
+
+        :param db_names: names of the databases to load
+        :param kwargs: the parameters of ``get``
+        """
+        for db_name in db_names:
+            cls.get(db_name, **kwargs)
+
+        cls.before_fork()
+
+    @classmethod
+    def before_fork(cls):
+        """ Release the connections of all the registries before to fork
+        the process """
+        for registry in cls.registries.values():
+            registry.before_fork()
+
+    @classmethod
+    def after_fork(cls):
+        """ Recreate the engine and the session factory of all the
+        registries in the forked process """
+        for registry in cls.registries.values():
+            registry.after_fork()
+
     @classmethod
     def reload(cls):
         """ Reload the blok
@@ -399,6 +437,8 @@ class Registry:
         registry = Registry('My database')
     """
 
+    registry_snapshot_key = 'anyblok.registry.snapshot'
+
     def __init__(self, db_name, loadwithoutmigration=False, unittest=False,
                  **kwargs):
         self.db_name = db_name
@@ -407,6 +447,7 @@ class Registry:
         self.additional_setting = kwargs
         self.init_engine(db_name=db_name)
         self.init_bind()
+        self.init_cache_invalidation_transport()
         self.registry_base = type("RegistryBase", tuple(), {
             'registry': self,
             'Env': EnvironmentManager})
@@ -426,6 +467,14 @@ class Registry:
             self.bind = self.engine
             self.unittest_transaction = None
 
+    def init_cache_invalidation_transport(self):
+        """Initialize and start the transport which pushes the cache
+        invalidations to the other registries"""
+        Transport = Configuration.get('CacheInvalidationTransport',
+                                      CacheInvalidationTransport)
+        self.cache_invalidation_transport = Transport(self)
+        self.cache_invalidation_transport.start()
+
     def init_engine_options(self):
         """Define the options to initialize the engine"""
         return dict(
@@ -466,6 +515,9 @@ class Registry:
         EnvironmentManager.set('_precommit_hook', [])
         self._sqlalchemy_known_events = []
         self.expire_attributes = {}
+        self.snapshot_to_save = False
+        self.cache_manager = Configuration.get(
+            'CacheManager', CacheManager)(self)
 
     @classmethod
     def db_exists(cls, db_name=None):
@@ -529,6 +581,129 @@ class Registry:
 
         return []
 
+    @staticmethod
+    def get_blok_code_hash(blok):
+        """ Return the hash of the python files of the blok, from their
+        path, size and modification time, the files are not read
+
+        :param blok: blok name
+        :rtype: str
+        """
+        code_hash = sha1()
+        path = BlokManager.getPath(blok)
+        for root, dirs, files in walk(path):
+            dirs.sort()
+            for filename in sorted(files):
+                if not filename.endswith('.py'):
+                    continue
+
+                filepath = join(root, filename)
+                info = stat(filepath)
+                code_hash.update(('%s:%d:%d;' % (
+                    relpath(filepath, path), info.st_size,
+                    info.st_mtime_ns)).encode('utf-8'))
+
+        return code_hash.hexdigest()
+
+    def get_snapshot(self):
+        """ Return the fingerprint of the installed bloks, the fingerprint
+        changes when the version or the code of an installed blok changes
+
+        :rtype: str or None if no blok is installed
+        """
+        res = []
+        query = """
+            SELECT system_blok.name, system_blok.installed_version
+            FROM system_blok
+            WHERE system_blok.state = 'installed'
+            ORDER BY system_blok.order"""
+        try:
+            res = self.execute(query).fetchall()
+        except (ProgrammingError, OperationalError):
+            pass
+
+        if not res:
+            return None
+
+        snapshot = sha1(version.encode('utf-8'))
+        for blok, installed_version in res:
+            code_hash = ''
+            if blok in BlokManager.bloks:
+                code_hash = self.get_blok_code_hash(blok)
+
+            snapshot.update(('%s:%s:%s;' % (
+                blok, installed_version, code_hash)).encode('utf-8'))
+
+        return snapshot.hexdigest()
+
+    def get_saved_snapshot(self):
+        """ Return the fingerprint saved by the last load which has
+        synchronized the data base
+
+        :rtype: str or None
+        """
+        res = None
+        query = """
+            SELECT system_parameter.value
+            FROM system_parameter
+            WHERE system_parameter.key = '%s'""" % self.registry_snapshot_key
+        try:
+            res = self.execute(query).fetchone()
+        except (ProgrammingError, OperationalError):
+            pass
+
+        if res is None:
+            return None
+
+        value = res[0]
+        if isinstance(value, str):
+            value = loads(value)
+
+        return value.get('value')
+
+    def save_snapshot(self):
+        """ Save the fingerprint of the installed bloks """
+        snapshot = self.get_snapshot()
+        if snapshot is not None:
+            self.System.Parameter.set(self.registry_snapshot_key, snapshot)
+
+        self.snapshot_to_save = False
+
+    def check_snapshot(self, toinstall):
+        """ Compare the fingerprint of the installed bloks with the saved
+        fingerprint, only if the ``registry_snapshot`` option is set.
+
+        If they are the same, the data base is already synchronized with the
+        code, the registry is loaded without migration. Else the new
+        fingerprint will be saved at the end of the load with migration. The
+        fingerprint never loads with migration a registry asked without
+        migration
+
+        :param toinstall: list of the bloks to install
+        """
+        if not Configuration.get('registry_snapshot'):
+            return
+
+        snapshot = None
+        if not toinstall and not self.get_bloks_by_states('toupdate',
+                                                          'touninstall'):
+            snapshot = self.get_snapshot()
+
+        if snapshot is not None and snapshot == self.get_saved_snapshot():
+            if not self.loadwithoutmigration:
+                logger.info("The snapshot of the registry is up to date, "
+                            "load without migration")
+
+            self.loadwithoutmigration = True
+            self.snapshot_to_save = False
+        elif self.loadwithoutmigration:
+            logger.warning("The snapshot of the registry is outdated, but "
+                           "the registry is loaded without migration as "
+                           "asked")
+            self.snapshot_to_save = False
+        else:
+            self.snapshot_to_save = True
+
     def get_bloks_to_load(self):
         """ Return the bloks to load by the registry
 
@@ -661,6 +836,26 @@ class Registry:
             self.loaded_registries[key]['bases'] += old_bases
             self.loaded_registries[entry + '_names'].append(key)
 
+    def get_tables_of_bloks(self, *bloks):
+        """ Return the tables of the models declared or overloaded by the
+        bloks
+
+        :param bloks: names of the bloks
+        :rtype: set of the table names
+        """
+        tables = set()
+        for blok in bloks:
+            if blok not in RegistryManager.loaded_bloks:
+                continue
+
+            entry = RegistryManager.loaded_bloks[blok].get('Model', {})
+            for registry_name in entry.get('registry_names', []):
+                model = self.loaded_namespaces.get(registry_name)
+                if model is not None and hasattr(model, '__table__'):
+                    tables.add(model.__table__.name)
+
+        return tables
+
     def load_core(self, blok, core):
         """ load one core type for one blok
 
@@ -921,6 +1116,8 @@ class Registry:
                 logger.warning("Impossible to use loadwithoumigration")
                 self.loadwithoutmigration = False
 
+            self.check_snapshot(toinstall)
+
             self.load_bloks(toload, False, toload)
             if toinstall and not self.loadwithoutmigration:
                 blok2install = toinstall[0]
@@ -959,6 +1156,9 @@ class Registry:
             else:
                 self.System.Blok.load_all()
 
+        if self.snapshot_to_save:
+            self.save_snapshot()
+
         self.loadwithoutmigration = False
 
     def run_test(registry, blok2install):
@@ -1002,12 +1202,24 @@ class Registry:
         # data in the session.connection, and risk of bad lock on the
         # tables
         if self.loadwithoutmigration:
+            self.listen_sqlalchemy_known_event()
             return
 
         if not self.withoutautomigration:
             self.declarativebase.metadata.create_all(self.connection())
 
-        self.migration = Configuration.get('Migration', Migration)(self)
+        migration = Configuration.get('Migration', Migration)(self)
+        if getattr(self, 'migration', None) is not None:
+            # the deferred operations are applied by the commit, they must
+            # not be lost when the registry is reloaded before it
+            for statements, repeat, cleanup, index in (
+                    self.migration.deferred_operations):
+                migration.defer(*statements, repeat=repeat, cleanup=cleanup,
+                                index=index)
+
+            migration.tables_not_applied |= self.migration.tables_not_applied
+
+        self.migration = migration
         query = """
             SELECT name, installed_version
             FROM system_blok
@@ -1075,6 +1287,12 @@ class Registry:
 
     def rollback(self, *args, **kwargs):
         self.session.rollback(*args, **kwargs)
+        # the values cached by record after a change of the model can come
+        # from the changes rolled back
+        self.cache_manager.forget_models(*[
+            hook[2][0]
+            for hook in EnvironmentManager.get('_precommit_hook', [])
+            if hook[:2] == ('Model.System.Cache', 'invalidate_records')])
         EnvironmentManager.set('_precommit_hook', [])
 
     def close_session(self):
@@ -1099,10 +1317,35 @@ class Registry:
     def close(self):
         """Release the session, connection and engine"""
         self.close_session()
+        self.cache_invalidation_transport.stop()
         self.engine.dispose()
         if self.db_name in RegistryManager.registries:
             del RegistryManager.registries[self.db_name]
 
+    def before_fork(self):
+        """ Release the session, the connections of the engine and the
+        connection of the cache invalidation transport, no connection must
+        be shared with the forked processes
+
+        .. warning::
+
+            The current transaction is rolled back
+        """
+        self.close_session()
+        self.cache_invalidation_transport.stop()
+        self.engine.dispose()
+
+    def after_fork(self):
+        """ Recreate the engine, the bind, the session factory and the
+        cache invalidation transport in the forked process, the models
+        are not assembled again
+        """
+        self.init_engine(db_name=self.db_name)
+        self.init_bind()
+        self.Session = None
+        self.create_session_factory()
+        self.init_cache_invalidation_transport()
+
     def __getattr__(self, attribute):
         # TODO safe the call of session for reload
         if self.Session:
@@ -1158,6 +1401,9 @@ class Registry:
         """ Overload the commit method of the SqlAlchemy session """
         self.apply_precommit_hook()
         self.session_commit(*args, **kwargs)
+        migration = getattr(self, 'migration', None)
+        if migration is not None:
+            migration.apply_deferred_operations()
 
     def flush(self):
         if not self.session._flushing:
@@ -23,13 +23,15 @@ Configuration.applications.update({
     'createdb': {
         'prog': 'AnyBlok create database, version %r' % version,
         'description': "Create a database and install bloks to populate it",
-        'configuration_groups': ['config', 'database', 'unittest'],
+        'configuration_groups': ['config', 'database', 'cache',
+                                 'migration', 'unittest'],
     },
     'updatedb': {
         'prog': 'AnyBlok update database, version %r' % version,
         'description': ("Update a database: install, upgrade or uninstall the "
                         "bloks "),
-        'configuration_groups': ['config', 'database', 'unittest'],
+        'configuration_groups': ['config', 'database', 'cache',
+                                 'migration', 'unittest'],
     },
     'nose': {
         'prog': 'AnyBlok nose, version %r' % version,
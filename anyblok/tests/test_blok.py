@@ -9,6 +9,7 @@
 from anyblok.blok import BlokManager, Blok, BlokManagerException
 from anyblok.tests.testcase import TestCase, DBTestCase
 from anyblok.registry import RegistryException, RegistryConflictingException
+from sqlalchemy import text
 
 
 class TestBlokManager(TestCase):
@@ -206,6 +207,21 @@ class TestBlokRequired(DBTestCase):
         self.assertEqual(testblok2.version, '1.0.0')
         self.assertEqual(testblok2.installed_version, '1.0.0')
 
+    def test_install_online_keep_the_deferred_operations(self):
+        registry = self.init_registry(None)
+        with self.Configuration(online_migration=True):
+            registry.migration.defer(text("SELECT 1"))
+            # test-blok1 and test-blok2 are installed, the registry is
+            # reloaded between the installations
+            registry.upgrade(install=('test-blok2',))
+
+        migration = registry.migration
+        self.assertTrue(migration.online)
+        self.assertEqual([[str(x) for x in operation[0]]
+                          for operation in migration.deferred_operations],
+                         [['SELECT 1']])
+        migration.deferred_operations = []
+
     def test_uninstall(self):
         registry = self.init_registry(None)
         registry.upgrade(install=('test-blok2',))
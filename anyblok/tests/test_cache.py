@@ -7,10 +7,11 @@
 # v. 2.0. If a copy of the MPL was not distributed with this file,You can
 # obtain one at http://mozilla.org/MPL/2.0/.
 from random import random
-from anyblok.tests.testcase import DBTestCase
+from anyblok.tests.testcase import DBTestCase, TestCase
+from anyblok.cache import LocalCacheInvalidationTransport, CacheManager
 from anyblok.declarations import Declarations, cache, classmethod_cache
 from anyblok.bloks.anyblok_core.exceptions import CacheException
-from anyblok.column import Integer
+from anyblok.column import Integer, String
 register = Declarations.register
 Model = Declarations.Model
 Mixin = Declarations.Mixin
@@ -78,6 +79,191 @@ class TestCache(DBTestCase):
         cache = caches[0]
         self.assertEqual(cache.indentify, ('Model.Test', 'method_cached'))
 
+    def test_invalidation_keep_only_the_latest(self):
+        registry = self.init_registry(self.add_model_with_method_cached)
+        Cache = registry.System.Cache
+        nb_invalidation = Cache.query().count()
+        Cache.invalidate('Model.Test', 'method_cached')
+        Cache.invalidate('Model.Test', 'method_cached')
+        self.assertEqual(Cache.query().count(), nb_invalidation + 1)
+        self.assertEqual(Cache.query().filter_by(
+            registry_name='Model.Test').one().id, Cache.get_last_id())
+
+    def test_get_invalidation_after_coalescing(self):
+        registry = self.init_registry(self.add_model_with_method_cached)
+        Cache = registry.System.Cache
+        Cache.insert(registry_name="Model.Test", method="method_cached")
+        Cache.invalidate('Model.Test', 'method_cached')
+        caches = Cache.get_invalidation()
+        self.assertEqual(len(caches), 1)
+        self.assertEqual(Cache.last_cache_id, Cache.get_last_id())
+
+    def test_compact(self):
+        registry = self.init_registry(self.add_model_with_method_cached)
+        Cache = registry.System.Cache
+        Cache.compact()
+        nb_invalidation = Cache.query().count()
+        Cache.insert(registry_name="Model.Test", method="method_cached")
+        Cache.insert(registry_name="Model.Test", method="method_cached")
+        self.assertEqual(Cache.query().count(), nb_invalidation + 2)
+        Cache.compact()
+        self.assertEqual(Cache.query().count(), nb_invalidation + 1)
+
+
+class TestCacheInvalidationTransport(DBTestCase):
+
+    def add_model_with_method_cached(self):
+
+        @register(Model)
+        class Test:
+
+            x = 0
+
+            @cache()
+            def method_cached(self):
+                self.x += 1
+                return self.x
+
+    def init_registry_with_transport(self):
+        with TestCase.Configuration(
+            CacheInvalidationTransport=LocalCacheInvalidationTransport
+        ):
+            return self.init_registry(self.add_model_with_method_cached)
+
+    def test_transport_is_listening(self):
+        registry = self.init_registry_with_transport()
+        transport = registry.cache_invalidation_transport
+        self.assertTrue(isinstance(transport, LocalCacheInvalidationTransport))
+        self.assertTrue(transport.is_listening())
+
+    def test_get_invalidation_without_polling(self):
+        registry = self.init_registry_with_transport()
+        Cache = registry.System.Cache
+        Cache.insert(registry_name="Model.Test", method="method_cached")
+        self.assertEqual(Cache.get_invalidation(), [])
+
+    def test_get_pushed_invalidation(self):
+        registry = self.init_registry_with_transport()
+        Cache = registry.System.Cache
+        other = LocalCacheInvalidationTransport(registry)
+        other.publish('Model.Test', 'method_cached')
+        caches = Cache.get_invalidation()
+        self.assertEqual(len(caches), 1)
+        self.assertEqual(caches[0].indentify, ('Model.Test', 'method_cached'))
+        self.assertEqual(Cache.get_invalidation(), [])
+
+    def test_invalidate_with_transport(self):
+        registry = self.init_registry_with_transport()
+        Cache = registry.System.Cache
+        m = registry.Test()
+        self.assertEqual(m.method_cached(), 1)
+        self.assertEqual(m.method_cached(), 1)
+        nb_invalidation = Cache.query().count()
+        Cache.invalidate('Model.Test', 'method_cached')
+        self.assertEqual(Cache.query().count(), nb_invalidation + 1)
+        self.assertEqual(m.method_cached(), 2)
+
+    def test_fallback_on_polling_if_transport_stopped(self):
+        registry = self.init_registry_with_transport()
+        Cache = registry.System.Cache
+        registry.cache_invalidation_transport.stop()
+        Cache.insert(registry_name="Model.Test", method="method_cached")
+        caches = Cache.get_invalidation()
+        self.assertEqual(len(caches), 1)
+        self.assertEqual(caches[0].indentify, ('Model.Test', 'method_cached'))
+
+
+class TestCacheManager(TestCase):
+
+    def test_get_and_set(self):
+        manager = CacheManager(None)
+        method_cache = manager.get_method_cache('Model.Test', 'method')
+        self.assertEqual(method_cache.get((1,)), (False, None))
+        method_cache.set((1,), 'value')
+        self.assertEqual(method_cache.get((1,)), (True, 'value'))
+        stats = manager.statistics()
+        self.assertEqual(stats[('Model.Test', 'method')]['hits'], 1)
+        self.assertEqual(stats[('Model.Test', 'method')]['misses'], 1)
+        self.assertEqual(stats[None]['entries'], 1)
+
+    def test_make_key_with_kwargs(self):
+        manager = CacheManager(None)
+        method_cache = manager.get_method_cache('Model.Test', 'method')
+        self.assertEqual(method_cache.make_key((1,), dict(a=1, b=2)),
+                         method_cache.make_key((1,), dict(b=2, a=1)))
+        self.assertNotEqual(method_cache.make_key((1,), {}),
+                            method_cache.make_key((1,), dict(a=1)))
+
+    def test_size(self):
+        manager = CacheManager(None)
+        method_cache = manager.get_method_cache('Model.Test', 'method',
+                                                size=1)
+        method_cache.set((1,), 'value 1')
+        method_cache.set((2,), 'value 2')
+        self.assertEqual(method_cache.get((1,)), (False, None))
+        self.assertEqual(method_cache.get((2,)), (True, 'value 2'))
+        self.assertEqual(method_cache.evictions, 1)
+
+    def test_ttl(self):
+        manager = CacheManager(None)
+        method_cache = manager.get_method_cache('Model.Test', 'method',
+                                                ttl=0)
+        method_cache.set((1,), 'value')
+        self.assertEqual(method_cache.get((1,)), (False, None))
+        self.assertEqual(method_cache.expirations, 1)
+        self.assertEqual(manager.memory, 0)
+
+    def test_default_ttl(self):
+        with TestCase.Configuration(cache_default_ttl=10):
+            manager = CacheManager(None)
+
+        method_cache = manager.get_method_cache('Model.Test', 'method')
+        self.assertEqual(method_cache.ttl, 10)
+
+    def test_memory_budget(self):
+        manager = CacheManager(None)
+        manager.memory_budget = manager.sizeof('value 1')
+        method_cache = manager.get_method_cache('Model.Test', 'method')
+        method_cache2 = manager.get_method_cache('Model.Test2', 'method')
+        method_cache.set((1,), 'value 1')
+        method_cache2.set((1,), 'value 2')
+        self.assertEqual(method_cache.get((1,)), (False, None))
+        self.assertEqual(method_cache2.get((1,)), (True, 'value 2'))
+        self.assertEqual(method_cache.evictions, 1)
+        self.assertEqual(manager.memory, manager.sizeof('value 2'))
+
+    def test_clear(self):
+        manager = CacheManager(None)
+        method_cache = manager.get_method_cache('Model.Test', 'method')
+        method_cache.set((1,), 'value')
+        manager.clear()
+        self.assertEqual(method_cache.get((1,)), (False, None))
+        self.assertEqual(manager.memory, 0)
+        self.assertEqual(manager.entries, {})
+
+
+class TestCacheTTL(DBTestCase):
+
+    def add_model_with_method_cached(self):
+
+        @register(Model)
+        class Test:
+
+            x = 0
+
+            @classmethod_cache(ttl=0)
+            def method_cached(cls):
+                cls.x += 1
+                return cls.x
+
+    def test_ttl(self):
+        registry = self.init_registry(self.add_model_with_method_cached)
+        self.assertEqual(registry.Test.method_cached(), 1)
+        self.assertEqual(registry.Test.method_cached(), 2)
+        stats = registry.cache_manager.statistics()
+        self.assertEqual(stats[('Model.Test', 'method_cached')]['expirations'],
+                         1)
+
 
 class TestSimpleCache(DBTestCase):
 
@@ -963,3 +1149,95 @@ class TestSQLModelCache(DBTestCase):
         Cache = registry.System.Cache
         Cache.invalidate('Model.Test', 'get_id2')
         self.assertEqual(t.get_id2(), 2)
+
+
+class TestRecordCache(DBTestCase):
+
+    def add_in_registry(self):
+
+        @register(Model)
+        class Test:
+
+            id = Integer(primary_key=True)
+            name = String()
+
+            @cache(by_record=True)
+            def get_name(self, suffix=''):
+                self.registry.nb_call += 1
+                return self.name + suffix
+
+    def init_registry_with_record_cache(self):
+        registry = self.init_registry(self.add_in_registry)
+        registry.nb_call = 0
+        return registry
+
+    def test_cache_by_record(self):
+        registry = self.init_registry_with_record_cache()
+        t = registry.Test.insert(name='test')
+        self.assertEqual(t.get_name(), 'test')
+        self.assertEqual(t.get_name(), 'test')
+        self.assertEqual(registry.nb_call, 1)
+        self.assertEqual(t.get_name(suffix='1'), 'test1')
+        self.assertEqual(registry.nb_call, 2)
+
+    def test_cache_by_record_shared_between_instances(self):
+        registry = self.init_registry_with_record_cache()
+        t = registry.Test.insert(name='test')
+        self.assertEqual(t.get_name(), 'test')
+        registry.expunge(t)
+        t2 = registry.Test.query().get(t.id)
+        self.assertIsNot(t, t2)
+        self.assertEqual(t2.get_name(), 'test')
+        self.assertEqual(registry.nb_call, 1)
+
+    def test_cache_by_record_not_shared_between_records(self):
+        registry = self.init_registry_with_record_cache()
+        t = registry.Test.insert(name='test')
+        t2 = registry.Test.insert(name='test2')
+        self.assertEqual(t.get_name(), 'test')
+        self.assertEqual(t2.get_name(), 'test2')
+        self.assertEqual(registry.nb_call, 2)
+
+    def test_cache_by_record_invalidated_by_update(self):
+        registry = self.init_registry_with_record_cache()
+        t = registry.Test.insert(name='test')
+        self.assertEqual(t.get_name(), 'test')
+        t.update(name='other')
+        self.assertEqual(t.get_name(), 'other')
+        self.assertEqual(registry.nb_call, 2)
+
+    def test_cache_by_record_invalidated_by_delete(self):
+        registry = self.init_registry_with_record_cache()
+        t = registry.Test.insert(name='test')
+        self.assertEqual(t.get_name(), 'test')
+        t.delete()
+        stats = registry.cache_manager.statistics()
+        self.assertEqual(stats[('Model.Test', 'get_name')]['entries'], 0)
+
+    def test_cache_by_record_invalidation_published_at_commit(self):
+        registry = self.init_registry_with_record_cache()
+        t = registry.Test.insert(name='test')
+        self.assertEqual(t.get_name(), 'test')
+        t.update(name='other')
+        Cache = registry.System.Cache
+        last_id = Cache.get_last_id()
+        registry.apply_precommit_hook()
+        query = Cache.query().filter(Cache.id > last_id)
+        self.assertEqual([(x.registry_name, x.method) for x in query.all()],
+                         [('Model.Test', 'get_name')])
+
+    def test_cache_by_record_forgotten_by_rollback(self):
+        registry = self.init_registry_with_record_cache()
+        t = registry.Test.insert(name='test')
+        t.update(name='other')
+        self.assertEqual(t.get_name(), 'other')
+        registry.rollback()
+        stats = registry.cache_manager.statistics()
+        self.assertEqual(stats[('Model.Test', 'get_name')]['entries'], 0)
+
+    def test_cache_by_record_without_identity(self):
+        registry = self.init_registry_with_record_cache()
+        t = registry.Test(name='test')
+        self.assertEqual(t.get_name(), 'test')
+        self.assertEqual(t.get_name(), 'test')
+        self.assertEqual(registry.nb_call, 2)
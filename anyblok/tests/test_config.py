@@ -11,6 +11,7 @@ from anyblok.config import (Configuration,
                             add_configuration_file,
                             add_plugins,
                             add_database,
+                            add_cache,
                             add_install_bloks,
                             add_uninstall_bloks,
                             add_update_bloks,
@@ -536,6 +537,7 @@ class TestConfigurationOption(TestCase):
             'add_configuration_file': add_configuration_file,
             'add_plugins': add_plugins,
             'add_database': add_database,
+            'add_cache': add_cache,
             'add_install_bloks': add_install_bloks,
             'add_uninstall_bloks': add_uninstall_bloks,
             'add_update_bloks': add_update_bloks,
@@ -554,6 +556,9 @@ class TestConfigurationOption(TestCase):
     def test_add_database(self):
         self.function['add_database'](self.group)
 
+    def test_add_cache(self):
+        self.function['add_cache'](self.group)
+
     def test_add_install_bloks(self):
         self.function['add_install_bloks'](self.parser)
 
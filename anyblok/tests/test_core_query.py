@@ -5,7 +5,10 @@
 # This Source Code Form is subject to the terms of the Mozilla Public License,
 # v. 2.0. If a copy of the MPL was not distributed with this file,You can
 # obtain one at http://mozilla.org/MPL/2.0/.
-from anyblok.tests.testcase import DBTestCase
+from anyblok.tests.testcase import DBTestCase, capture_statements
+from anyblok.bloks.anyblok_core.exceptions import QueryException
+from array import array
+from decimal import Decimal as D
 
 
 class TestCoreQuery(DBTestCase):
@@ -25,3 +28,280 @@ class TestCoreQuery(DBTestCase):
 
         registry = self.init_registry(inherit)
         self.assertEqual(registry.System.Blok.query().foo(), True)
+
+
+class TestQueryWriteAll(DBTestCase):
+
+    def declare_models(self):
+        from anyblok import Declarations
+        from anyblok.column import Integer, String
+        from anyblok.relationship import Many2One, Many2Many
+        Model = Declarations.Model
+
+        @Declarations.register(Model)
+        class Parent:
+            id = Integer(primary_key=True)
+
+        @Declarations.register(Model)
+        class Child:
+            id = Integer(primary_key=True)
+            name = String()
+            parent = Many2One(model=Model.Parent, one2many='children')
+
+        @Declarations.register(Model)
+        class Tag:
+            id = Integer(primary_key=True)
+            children = Many2Many(model=Model.Child, many2many='tags')
+
+    def init_registry_with_children(self):
+        registry = self.init_registry(self.declare_models)
+        p1 = registry.Parent.insert()
+        p2 = registry.Parent.insert()
+        registry.Child.multi_insert(
+            *[{'name': str(x), 'parent': p1} for x in range(3)])
+        return registry, p1, p2
+
+    def test_update_all(self):
+        registry, p1, p2 = self.init_registry_with_children()
+        Child = registry.Child
+        child = Child.query().filter_by(name='0').one()
+        query = Child.query().filter(Child.name.in_(['0', '1']))
+        self.assertEqual(query.update_all(name='foo'), 2)
+        self.assertEqual(child.name, 'foo')
+        self.assertEqual(Child.query().filter_by(name='foo').count(), 2)
+
+    def test_update_all_expire_backrefs(self):
+        registry, p1, p2 = self.init_registry_with_children()
+        Child = registry.Child
+        self.assertEqual(len(p1.children), 3)
+        self.assertEqual(len(p2.children), 0)
+        Child.query().filter_by(name='0').update_all(parent_id=p2.id)
+        self.assertEqual(len(p1.children), 2)
+        self.assertEqual(len(p2.children), 1)
+        self.assertIs(p2.children[0].parent, p2)
+
+    def test_update_all_without_values(self):
+        registry, p1, p2 = self.init_registry_with_children()
+        self.assertEqual(registry.Child.query().update_all(), 0)
+
+    def test_update_all_with_relationship(self):
+        registry, p1, p2 = self.init_registry_with_children()
+        with self.assertRaises(QueryException):
+            registry.Child.query().update_all(parent=p2)
+
+    def test_update_all_on_columns(self):
+        registry, p1, p2 = self.init_registry_with_children()
+        with self.assertRaises(QueryException):
+            registry.Child.query('name').update_all(name='foo')
+
+    def test_get_affected_instances_with_order_by(self):
+        registry, p1, p2 = self.init_registry_with_children()
+        Child = registry.Child
+        query = Child.query().order_by(Child.name.desc())
+        self.assertEqual(len(query.get_affected_instances(Child)), 3)
+
+    def test_delete_all_with_many2many(self):
+        registry, p1, p2 = self.init_registry_with_children()
+        Child = registry.Child
+        tag = registry.Tag.insert()
+        tag.children.extend(Child.query().all())
+        registry.flush()
+        self.assertEqual(Child.query().filter_by(name='0').delete_all(), 1)
+        registry.expire(tag, ['children'])
+        self.assertEqual(len(tag.children), 2)
+
+    def test_delete_all(self):
+        registry, p1, p2 = self.init_registry_with_children()
+        Child = registry.Child
+        self.assertEqual(len(p1.children), 3)
+        child = Child.query().filter_by(name='0').one()
+        self.assertEqual(Child.query().filter_by(name='0').delete_all(), 1)
+        self.assertNotIn(child, registry.session)
+        self.assertEqual(len(p1.children), 2)
+        self.assertEqual(Child.query().count(), 2)
+
+
+class TestQueryIterBatches(DBTestCase):
+
+    def declare_model(self):
+        from anyblok import Declarations
+        from anyblok.column import Integer, String
+        Model = Declarations.Model
+
+        @Declarations.register(Model)
+        class Test:
+            id = Integer(primary_key=True)
+            name = String()
+
+    def init_registry_with_entries(self):
+        registry = self.init_registry(self.declare_model)
+        registry.Test.multi_insert(*[{'name': str(x)} for x in range(5)])
+        registry.expunge_all()
+        return registry
+
+    def test_iter_batches(self):
+        registry = self.init_registry_with_entries()
+        query = registry.Test.query().order_by(registry.Test.id)
+        batches = [batch.name for batch in query.iter_batches(2)]
+        self.assertEqual(batches, [['0', '1'], ['2', '3'], ['4']])
+
+    def test_iter_batches_release_the_instances(self):
+        registry = self.init_registry_with_entries()
+        query = registry.Test.query().order_by(registry.Test.id)
+        batches = query.iter_batches(2)
+        first = next(batches)
+        self.assertTrue(all(x in registry.session for x in first))
+        first[0].name = 'foo'
+        next(batches)
+        self.assertIn(first[0], registry.session)
+        self.assertNotIn(first[1], registry.session)
+
+    def test_dictiter(self):
+        registry = self.init_registry_with_entries()
+        query = registry.Test.query().order_by(registry.Test.id)
+        self.assertEqual(list(query.dictiter(size=2)), query.dictall())
+
+    def test_dictiter_on_some_column(self):
+        registry = self.init_registry_with_entries()
+        query = registry.Test.query('name').order_by(registry.Test.id)
+        self.assertEqual(list(query.dictiter(size=2)),
+                         [{'name': str(x)} for x in range(5)])
+
+
+class TestQueryColumns(DBTestCase):
+
+    def declare_model(self):
+        from anyblok import Declarations
+        from anyblok.column import Integer, String, Float, Boolean, Decimal
+        Model = Declarations.Model
+
+        @Declarations.register(Model)
+        class Test:
+            id = Integer(primary_key=True)
+            name = String()
+            amount = Float()
+            number = Integer()
+            active = Boolean()
+            price = Decimal()
+
+    def init_registry_with_entries(self):
+        registry = self.init_registry(self.declare_model)
+        registry.Test.multi_insert(*[
+            {'name': str(x), 'amount': x / 2, 'number': x,
+             'active': bool(x % 2), 'price': D('0.1') * x}
+            for x in range(5)])
+        return registry
+
+    def test_columns(self):
+        registry = self.init_registry_with_entries()
+        query = registry.Test.query().order_by(registry.Test.id)
+        res = query.columns('name', 'amount', 'number', 'active', size=2)
+        self.assertEqual(list(res.keys()),
+                         ['name', 'amount', 'number', 'active'])
+        self.assertEqual(res['name'], ['0', '1', '2', '3', '4'])
+        self.assertEqual(res['amount'], array('d', [0, 0.5, 1, 1.5, 2]))
+        self.assertEqual(res['number'], array('q', [0, 1, 2, 3, 4]))
+        self.assertEqual(res['active'], array('b', [0, 1, 0, 1, 0]))
+
+    def test_columns_with_decimal(self):
+        registry = self.init_registry_with_entries()
+        query = registry.Test.query().order_by(registry.Test.id)
+        res = query.columns('price')
+        self.assertIsInstance(res['price'], list)
+        self.assertEqual(res['price'], [D('0.1') * x for x in range(5)])
+        self.assertEqual(sum(res['price']), D('1.0'))
+
+    def test_columns_with_null_values(self):
+        registry = self.init_registry_with_entries()
+        registry.Test.insert(name='5')
+        query = registry.Test.query().order_by(registry.Test.id)
+        res = query.columns('number', size=2)
+        self.assertEqual(res['number'], [0, 1, 2, 3, 4, None])
+
+    def test_columns_without_fields(self):
+        registry = self.init_registry_with_entries()
+        with self.assertRaises(QueryException):
+            registry.Test.query().columns()
+
+    def test_columns_as_numpy(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("NumPy is not installed")
+
+        registry = self.init_registry_with_entries()
+        query = registry.Test.query().order_by(registry.Test.id)
+        res = query.columns('number', 'name', as_numpy=True)
+        self.assertEqual(res['number'].dtype, numpy.dtype('q'))
+        self.assertEqual(res['number'].sum(), 10)
+        self.assertEqual(list(res['name']), ['0', '1', '2', '3', '4'])
+
+
+class TestQueryDictAllWithFields(DBTestCase):
+
+    def declare_models(self):
+        from anyblok import Declarations
+        from anyblok.column import Integer, String
+        from anyblok.relationship import Many2One
+        Model = Declarations.Model
+
+        @Declarations.register(Model)
+        class Parent:
+            id = Integer(primary_key=True)
+            name = String()
+
+        @Declarations.register(Model)
+        class Child:
+            id = Integer(primary_key=True)
+            name = String()
+            parent = Many2One(model=Model.Parent, one2many='children')
+
+    def init_registry_with_children(self):
+        registry = self.init_registry(self.declare_models)
+        for x in range(3):
+            parent = registry.Parent.insert(name='p%d' % x)
+            registry.Child.multi_insert(
+                {'name': 'a%d' % x, 'parent': parent},
+                {'name': 'b%d' % x, 'parent': parent})
+
+        registry.expunge_all()
+        return registry
+
+    def test_dictall_with_fields(self):
+        registry = self.init_registry_with_children()
+        Parent = registry.Parent
+        query = Parent.query().order_by(Parent.id)
+        with capture_statements(registry) as statements:
+            res = query.dictall(
+                'name', ('children', ('name', ('parent', ('name',)))))
+
+        self.assertEqual(len(statements), 2)
+        self.assertEqual(res, [
+            {'name': 'p%d' % x,
+             'children': [{'name': 'a%d' % x, 'parent': {'name': 'p%d' % x}},
+                          {'name': 'b%d' % x, 'parent': {'name': 'p%d' % x}}]}
+            for x in range(3)])
+
+    def test_dictiter_with_fields(self):
+        registry = self.init_registry_with_children()
+        Parent = registry.Parent
+        query = Parent.query().order_by(Parent.id)
+        fields = ('name', ('children', ('name', ('parent', ('name',)))))
+        self.assertEqual(list(query.dictiter(*fields, size=2)),
+                         query.dictall(*fields))
+
+    def test_dictall_with_many2one(self):
+        registry = self.init_registry_with_children()
+        Child = registry.Child
+        query = Child.query().filter_by(name='a0')
+        self.assertEqual(query.dictall('name', ('parent', ('name',))),
+                         [{'name': 'a0', 'parent': {'name': 'p0'}}])
+
+    def test_get_relationship_loader(self):
+        registry = self.init_registry_with_children()
+        self.assertEqual(
+            registry.Child.get_relationship_loader('parent', False),
+            'joinedload')
+        self.assertIn(
+            registry.Parent.get_relationship_loader('children', True),
+            ('selectinload', 'subqueryload'))
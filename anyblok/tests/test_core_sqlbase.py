@@ -5,11 +5,13 @@
 # This Source Code Form is subject to the terms of the Mozilla Public License,
 # v. 2.0. If a copy of the MPL was not distributed with this file,You can
 # obtain one at http://mozilla.org/MPL/2.0/.
-from anyblok.tests.testcase import DBTestCase
+from anyblok.tests.testcase import (
+    DBTestCase, TestCase, capture_statements)
 from anyblok.column import Integer, String, Selection
 from anyblok.relationship import Many2One, One2One, Many2Many, One2Many
 from anyblok.declarations import Declarations
 from anyblok.bloks.anyblok_core.exceptions import SqlBaseException
+from anyblok.field import FieldException
 
 
 Model = Declarations.Model
@@ -43,6 +45,50 @@ class TestCoreSQLBase(DBTestCase):
                     registry.Test.id2 == x).count(),
                 1)
 
+    def declare_model_for_bulk(self):
+
+        @register(Model)
+        class Test:
+            id = Integer(primary_key=True)
+            id2 = Integer(default=10)
+            select = Selection(selections=[('key', 'value')])
+
+    def test_multi_insert_bulk(self):
+        registry = self.init_registry(self.declare_model_for_bulk)
+        with TestCase.Configuration(db_bulk_chunk_size=2):
+            tests = registry.Test.multi_insert(
+                {'id2': 1}, {'id2': 2, 'select': 'key'}, {'id2': 3},
+                {'select': 'key'}, bulk=True)
+
+        self.assertEqual(registry.Test.query().count(), 4)
+        self.assertEqual(tests.id2, [1, 2, 3, 10])
+        self.assertEqual(tests.select, [None, None, 'key', 'key'])
+
+    def test_multi_insert_bulk_return_primary_keys(self):
+        registry = self.init_registry(self.declare_model_for_bulk)
+        pks = registry.Test.multi_insert({'id2': 1}, {'id2': 2}, bulk=True,
+                                         return_instances=False)
+        self.assertEqual(len(pks), 2)
+        self.assertEqual(
+            registry.Test.from_multi_primary_keys(*pks).id2, [1, 2])
+
+    def test_multi_insert_bulk_with_primary_keys(self):
+        registry = self.init_registry(self.declare_model_for_bulk)
+        pks = registry.Test.multi_insert(
+            {'id': 100, 'id2': 1}, {'id2': 2}, {'id2': 3}, bulk=True,
+            return_instances=False)
+        self.assertEqual(pks, [{'id': 100}, {'id': 1}, {'id': 2}])
+
+    def test_multi_insert_bulk_with_wrong_selection(self):
+        registry = self.init_registry(self.declare_model_for_bulk)
+        with self.assertRaises(FieldException):
+            registry.Test.multi_insert({'select': 'wrong key'}, bulk=True)
+
+    def test_multi_insert_bulk_with_unknown_column(self):
+        registry = self.init_registry(self.declare_model_for_bulk)
+        with self.assertRaises(SqlBaseException):
+            registry.Test.multi_insert({'id3': 1}, bulk=True)
+
     def test_delete(self):
         registry = self.init_registry(self.declare_model)
         nb_value = 3
@@ -108,6 +154,30 @@ class TestCoreSQLBase(DBTestCase):
         registry = self.init_registry(self.declare_model)
         self.assertEqual(registry.Test.get_primary_keys(), ['id'])
 
+    def test_get_metadata(self):
+        registry = self.init_registry(self.add_in_registry_m2o)
+        metadata = registry.Test2.get_metadata()
+        self.assertIs(registry.Test2.get_metadata(), metadata)
+        self.assertEqual(metadata.registry_name, 'Model.Test2')
+        self.assertEqual(metadata.primary_keys, ('id',))
+        self.assertEqual(metadata.relationships, {'test': 'Model.Test'})
+        self.assertEqual(registry.Test.get_metadata().relationships,
+                         {'test2': 'Model.Test2'})
+        self.assertEqual(metadata.field_types['test'], 'Many2One')
+        self.assertEqual(metadata.field_types['name'], 'String')
+        self.assertIn('test_id', metadata.columns)
+        with self.assertRaises(AttributeError):
+            metadata.primary_keys = ('name',)
+
+        with self.assertRaises(TypeError):
+            metadata.columns['other'] = None
+
+    def test_get_metadata_after_reload(self):
+        registry = self.init_registry(self.declare_model)
+        metadata = registry.Test.get_metadata()
+        registry.reload()
+        self.assertIsNot(registry.Test.get_metadata(), metadata)
+
     def test_to_and_from_primary_keys(self):
         registry = self.init_registry(self.declare_model)
         nb_value = 3
@@ -116,6 +186,68 @@ class TestCoreSQLBase(DBTestCase):
         self.assertEqual(t.to_primary_keys(), {'id': t.id})
         self.assertEqual(registry.Test.from_primary_keys(id=t.id), t)
 
+    def test_from_primary_keys_in_identity_map(self):
+        registry = self.init_registry(self.declare_model)
+        t = registry.Test.insert(id2=1)
+        self.assertIs(registry.Test.from_primary_keys(id=t.id), t)
+        self.assertIsNone(registry.Test.from_primary_keys(id=t.id + 1))
+
+    def test_from_primary_keys_with_other_keys(self):
+        registry = self.init_registry(self.declare_model)
+        t = registry.Test.insert(id2=1)
+        self.assertIs(registry.Test.from_primary_keys(id=t.id, id2=1), t)
+        self.assertIsNone(registry.Test.from_primary_keys(id=t.id, id2=2))
+
+    def test_from_primary_keys_without_primary_keys(self):
+        registry = self.init_registry(self.declare_model)
+        with self.assertRaises(SqlBaseException):
+            registry.Test.from_primary_keys(id2=1)
+
+    def test_from_multi_primary_keys(self):
+        registry = self.init_registry(self.declare_model)
+        registry.Test.multi_insert(*[{'id2': x} for x in range(5)])
+        registry.expire_all()
+        ids = registry.Test.query('id').order_by(registry.Test.id.desc())
+        ids = [x.id for x in ids.all()]
+        with TestCase.Configuration(db_in_chunk_size=2):
+            tests = registry.Test.from_multi_primary_keys(
+                *[{'id': x} for x in ids + [ids[0], max(ids) + 1]])
+
+        self.assertEqual(tests.id, ids)
+
+    def test_from_multi_primary_keys_in_identity_map(self):
+        registry = self.init_registry(self.declare_model)
+        t1 = registry.Test.insert(id2=1)
+        t2 = registry.Test.insert(id2=2)
+        registry.expire(t2)
+        tests = registry.Test.from_multi_primary_keys(
+            {'id': t2.id}, {'id': t1.id})
+        self.assertEqual(tests, [t2, t1])
+
+    def test_from_multi_primary_keys_without_primary_keys(self):
+        registry = self.init_registry(self.declare_model)
+        self.assertEqual(registry.Test.from_multi_primary_keys(), [])
+
+    def declare_model_with_composite_primary_keys(self):
+
+        @register(Model)
+        class Test:
+            id = Integer(primary_key=True)
+            code = String(primary_key=True)
+
+    def test_from_multi_primary_keys_with_composite_primary_keys(self):
+        registry = self.init_registry(
+            self.declare_model_with_composite_primary_keys)
+        registry.Test.multi_insert(*[{'id': x, 'code': str(x)}
+                                     for x in range(5)])
+        registry.expire_all()
+        with TestCase.Configuration(db_in_chunk_size=2):
+            tests = registry.Test.from_multi_primary_keys(
+                *[{'id': x, 'code': str(x)} for x in (3, 1, 0, 4)] +
+                [{'id': 2, 'code': '3'}])
+
+        self.assertEqual(tests.id, [3, 1, 0, 4])
+
     def add_in_registry_m2o(self):
 
         @register(Model)
@@ -244,6 +376,73 @@ class TestCoreSQLBase(DBTestCase):
         self.assertEqual(t1.to_dict('name', ('test2', ('name',))),
                          {'name': 't1', 'test2': [{'name': 't2'}]})
 
+    def test_to_dict_with_list(self):
+        registry = self.init_registry(self.add_in_registry_m2o)
+        t1 = registry.Test.insert(name='t1')
+        registry.Test2.insert(name='t2', test=t1)
+        self.assertEqual(t1.to_dict('name', ['test2', ['name']]),
+                         {'name': 't1', 'test2': [{'name': 't2'}]})
+
+    def add_in_registry_m2o_with_to_dict(self):
+
+        @register(Model)
+        class Test:
+            id = Integer(primary_key=True)
+            name = String()
+
+        @register(Model)
+        class Test2:
+            id = Integer(primary_key=True)
+            name = String()
+            test = Many2One(model=Model.Test, one2many="test2")
+
+            def to_dict(self, *fields):
+                res = super(Test2, self).to_dict(*fields)
+                res['overloaded'] = True
+                return res
+
+    def test_to_dict_with_overloaded_related_to_dict(self):
+        registry = self.init_registry(self.add_in_registry_m2o_with_to_dict)
+        t1 = registry.Test.insert(name='t1')
+        t2 = registry.Test2.insert(name='t2', test=t1)
+        self.assertEqual(t1.to_dict('name', ('test2', ('name',))),
+                         {'name': 't1',
+                          'test2': [{'name': 't2', 'overloaded': True}]})
+        self.assertEqual(registry.Test2.query().all().to_dict('name'),
+                         [{'name': 't2', 'overloaded': True}])
+        self.assertEqual(t2.to_dict('name', ('test', ('name',))),
+                         {'name': 't2', 'test': {'name': 't1'},
+                          'overloaded': True})
+
+    def test_compile_to_dict_is_cached(self):
+        registry = self.init_registry(self.add_in_registry_m2o)
+        plan = registry.Test.compile_to_dict('name', ('test2', ('name',)))
+        self.assertIs(
+            registry.Test.compile_to_dict('name', ('test2', ('name',))),
+            plan)
+        self.assertEqual(
+            plan, (('name', None, None, None, None),
+                   ('test2', 'Model.Test2',
+                    (('name', None, None, None, None),), True, ('name',))))
+
+    def test_records_to_dict(self):
+        registry = self.init_registry(self.add_in_registry_m2o)
+        for x in range(3):
+            t1 = registry.Test.insert(name='t%d' % x)
+            registry.Test2.multi_insert({'name': 'a%d' % x, 'test': t1},
+                                        {'name': 'b%d' % x, 'test': t1})
+
+        registry.expire_all()
+        tests = registry.Test.query().order_by(registry.Test.id).all()
+        with capture_statements(registry) as statements:
+            res = tests.to_dict('name', ('test2', ('name',)))
+
+        self.assertEqual(len(statements), 2)
+        self.assertEqual(res, [
+            {'name': 't%d' % x,
+             'test2': [{'name': 'a%d' % x}, {'name': 'b%d' % x}]}
+            for x in range(3)])
+
     def test_to_dict_m2o_with_all_columns(self):
         registry = self.init_registry(self.add_in_registry_m2o)
         t1 = registry.Test.insert(name='t1')
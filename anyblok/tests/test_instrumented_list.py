@@ -5,8 +5,8 @@
 # This Source Code Form is subject to the terms of the Mozilla Public License,
 # v. 2.0. If a copy of the MPL was not distributed with this file,You can
 # obtain one at http://mozilla.org/MPL/2.0/.
-from anyblok.tests.testcase import DBTestCase
-from anyblok.column import Integer
+from anyblok.tests.testcase import DBTestCase, capture_statements
+from anyblok.column import Integer, String
 from anyblok.relationship import Many2Many, One2Many, Many2One
 
 
@@ -140,6 +140,97 @@ class TestInstrumentedList(DBTestCase):
         t = registry.Test.insert()
         self.assertEqual(registry.Test.query().all().foo(), [t.id])
 
+    def declare_model_with_method(self):
+
+        from anyblok import Declarations
+        Model = Declarations.Model
+
+        @Declarations.register(Model)
+        class Test:
+            id = Integer(primary_key=True)
+            name = String()
+
+            def foo(self, suffix=''):
+                return self.name + suffix
+
+    def test_pluck(self):
+        registry = self.init_registry(self.declare_model_with_method)
+        registry.Test.multi_insert({'name': 't1'}, {'name': 't2'})
+        tests = registry.Test.query().order_by(registry.Test.id).all()
+        self.assertEqual(tests.pluck('name'), ['t1', 't2'])
+
+    def test_call(self):
+        registry = self.init_registry(self.declare_model_with_method)
+        registry.Test.multi_insert({'name': 't1'}, {'name': 't2'})
+        tests = registry.Test.query().order_by(registry.Test.id).all()
+        self.assertEqual(tests.call('foo', suffix='!'), ['t1!', 't2!'])
+        self.assertEqual(tests.foo('?'), ['t1?', 't2?'])
+
+    def test_is_method(self):
+        registry = self.init_registry(self.declare_model_with_method)
+        registry.Test.insert(name='t1')
+        tests = registry.Test.query().all()
+        self.assertTrue(tests.is_method('foo'))
+        self.assertTrue(tests.is_method('insert'))
+        self.assertFalse(tests.is_method('name'))
+
+    def test_pluck_load_the_expired_column_by_one_query(self):
+        registry = self.init_registry(self.declare_model_with_method)
+        registry.Test.multi_insert(*[{'name': 't%d' % x} for x in range(5)])
+        tests = registry.Test.query().order_by(registry.Test.id).all()
+        registry.expire_all()
+        with capture_statements(registry) as statements:
+            names = tests.name
+
+        self.assertEqual(names, ['t%d' % x for x in range(5)])
+        self.assertEqual(len(statements), 1)
+
+    def declare_model_with_many2one(self):
+
+        from anyblok import Declarations
+        Model = Declarations.Model
+
+        @Declarations.register(Model)
+        class Partner:
+            id = Integer(primary_key=True)
+            name = String()
+
+        @Declarations.register(Model)
+        class Test:
+            id = Integer(primary_key=True)
+            partner = Many2One(model=Model.Partner, one2many='tests')
+
+    def test_pluck_many2one_by_one_query(self):
+        registry = self.init_registry(self.declare_model_with_many2one)
+        for x in range(5):
+            partner = registry.Partner.insert(name='p%d' % x)
+            registry.Test.insert(partner=partner)
+
+        registry.expunge_all()
+        tests = registry.Test.query().order_by(registry.Test.id).all()
+        with capture_statements(registry) as statements:
+            partners = tests.pluck('partner')
+
+        self.assertEqual(len(statements), 1)
+        self.assertEqual([x.name for x in partners],
+                         ['p%d' % x for x in range(5)])
+
+    def test_pluck_one2many_by_one_level(self):
+        registry = self.init_registry(self.declare_model_with_many2one)
+        for x in range(5):
+            partner = registry.Partner.insert(name='p%d' % x)
+            registry.Test.multi_insert({'partner': partner},
+                                       {'partner': partner})
+
+        registry.expunge_all()
+        partners = registry.Partner.query().all()
+        with capture_statements(registry) as statements:
+            tests = partners.pluck('tests')
+
+        # the partners, then their tests by a select IN
+        self.assertEqual(len(statements), 2)
+        self.assertEqual([len(x) for x in tests], [2] * 5)
+
     def test_inherit(self):
 
         def inherit():
@@ -15,9 +15,9 @@ from anyblok.column import Integer as Int, String as Str
 from anyblok.migration import MigrationException
 from anyblok.relationship import Many2Many
 from contextlib import contextmanager
-from sqlalchemy import Column, Integer, TEXT
+from sqlalchemy import Column, Integer, TEXT, text
 from anyblok import Declarations
-from sqlalchemy.exc import InternalError, IntegrityError
+from sqlalchemy.exc import InternalError, IntegrityError, OperationalError
 from unittest import skipIf
 import alembic
 from copy import deepcopy
@@ -231,6 +231,125 @@ class TestMigration(TestCase):
         # the column doesn't change of nullable to not lock the migration
         self.assertTrue(c.nullable())
 
+    def test_online_add_not_null_column_with_default_value(self):
+        self.fill_test_table()
+        migration = self.registry.migration
+        migration.online = True
+        t = migration.table('test')
+        c = t.column().add(Column('new_column', Integer, nullable=False,
+                                  default=100))
+        self.assertTrue(c.nullable())
+        res = [x for x in self.registry.execute(
+            "select count(*) from test where new_column is null")][0][0]
+        self.assertEqual(res, 10)
+        self.assertEqual(len(migration.deferred_operations), 2)
+        (statements, repeat, cleanup,
+         index) = migration.deferred_operations[0]
+        self.assertTrue(repeat)
+        self.assertIn('UPDATE', str(statements[0]))
+        (statements, repeat, cleanup,
+         index) = migration.deferred_operations[1]
+        self.assertEqual(len(statements), 4)
+        self.assertIn('DROP CONSTRAINT IF EXISTS', str(cleanup))
+        migration.deferred_operations = []
+
+    def test_online_alter_column_nullable(self):
+        migration = self.registry.migration
+        migration.online = True
+        c = migration.table('test').column('other').alter(nullable=False)
+        self.assertTrue(c.nullable())
+        self.assertIn('NOT VALID',
+                      str(migration.deferred_operations[0][0][0]))
+        migration.deferred_operations = []
+
+    def count_not_null_constraints(self):
+        return [x for x in self.registry.execute(
+            "select count(*) from pg_constraint "
+            "where conname like 'anyblok_ck_test__other%'")][0][0]
+
+    def test_apply_deferred_not_null(self):
+        self.fill_test_table()
+        migration = self.registry.migration
+        migration.defer_not_null('test', 'other')
+        migration.apply_deferred_operations(conn=migration.conn)
+        self.assertEqual(migration.deferred_operations, [])
+        self.assertFalse(migration.table('test').column('other').nullable())
+        self.assertEqual(self.count_not_null_constraints(), 0)
+
+    def test_apply_deferred_not_null_with_null_values(self):
+        self.fill_test_table()
+        self.registry.Test.insert()
+        migration = self.registry.migration
+        migration.defer_not_null('test', 'other')
+        migration.defer(text("UPDATE test SET other = 'filled' "
+                             "WHERE other IS NULL"))
+        migration.apply_deferred_operations(conn=migration.conn)
+        self.assertEqual(migration.deferred_operations, [])
+        self.assertTrue(migration.table('test').column('other').nullable())
+        self.assertEqual(self.count_not_null_constraints(), 0)
+        res = [x for x in self.registry.execute(
+            "select count(*) from test where other is null")][0][0]
+        self.assertEqual(res, 0)
+
+    def test_defer_the_same_operation_once(self):
+        migration = self.registry.migration
+        migration.defer_not_null('test', 'other')
+        migration.defer_not_null('test', 'other')
+        self.assertEqual(len(migration.deferred_operations), 1)
+        migration.deferred_operations = []
+
+    def test_online_index(self):
+        migration = self.registry.migration
+        migration.online = True
+        t = migration.table('test')
+        t.index().add(t.column('integer'))
+        self.assertIn('CREATE INDEX CONCURRENTLY',
+                      str(migration.deferred_operations[0][0][0]))
+        self.assertEqual(migration.deferred_operations[0][3],
+                         'idx_integer_on_test')
+        migration.deferred_operations = []
+        with self.assertRaises(MigrationException):
+            t.index(t.column('integer'))
+
+    def test_drop_invalid_index_keep_the_valid_index(self):
+        migration = self.registry.migration
+        t = migration.table('test')
+        t.index().add(t.column('integer'))
+        migration.drop_invalid_index(migration.conn,
+                                     'idx_integer_on_test')
+        t.index(t.column('integer'))
+
+    def test_apply_deferred_operations_keep_the_failed_operation(self):
+        migration = self.registry.migration
+        migration.defer(text("ALTER TABLE unknown_table ADD COLUMN other "
+                             "INTEGER"))
+        migration.apply_deferred_operations(conn=migration.conn)
+        self.assertEqual(len(migration.deferred_operations), 1)
+        migration.deferred_operations = []
+
+    def test_online_with_lock_timeout_retry(self):
+        migration = self.registry.migration
+        migration.online = True
+        migration.lock_retry = 1
+        calls = []
+
+        class LockNotAvailable(Exception):
+            pgcode = '55P03'
+
+        def fnct():
+            calls.append(1)
+            if len(calls) == 1:
+                raise OperationalError('statement', {}, LockNotAvailable())
+
+            return 'done'
+
+        self.assertEqual(migration.with_lock_timeout(fnct), 'done')
+        self.assertEqual(len(calls), 2)
+        del calls[:]
+        migration.lock_retry = 0
+        with self.assertRaises(OperationalError):
+            migration.with_lock_timeout(fnct)
+
     def test_alter_column_default(self):
         t = self.registry.migration.table('test')
         c = t.column('other').alter(server_default='test')
@@ -294,6 +413,58 @@ class TestMigration(TestCase):
         report = self.registry.migration.detect_changed()
         self.assertFalse(report.log_has("Add test.other"))
 
+    def test_get_table_signature(self):
+        migration = self.registry.migration
+        table = self.registry.Test.__table__
+        self.assertEqual(migration.get_table_signature(table),
+                         migration.get_table_signature(table))
+        self.assertNotEqual(
+            migration.get_table_signature(table),
+            migration.get_table_signature(self.registry.TestUnique.__table__))
+
+    def test_incremental_detect_changed(self):
+        migration = self.registry.migration
+        migration.incremental = True
+        migration.save_table_signatures()
+        self.assertNotIn('test', migration.get_tables_to_compare())
+        with self.cnx() as conn:
+            conn.execute("DROP TABLE test")
+            conn.execute(
+                """CREATE TABLE test(integer INT PRIMARY KEY NOT NULL);""")
+        report = migration.detect_changed()
+        self.assertFalse(report.log_has("Add test.other"))
+        migration.incremental = False
+        report = migration.detect_changed()
+        self.assertTrue(report.log_has("Add test.other"))
+
+    def test_incremental_detect_changed_with_new_signature(self):
+        migration = self.registry.migration
+        migration.incremental = True
+        migration.save_table_signatures()
+        signatures = migration.get_saved_table_signatures()
+        signatures['test'] = 'old signature'
+        self.registry.System.Parameter.set(migration.signatures_key,
+                                           signatures)
+        self.assertIn('test', migration.get_tables_to_compare())
+        with self.cnx() as conn:
+            conn.execute("DROP TABLE test")
+            conn.execute(
+                """CREATE TABLE test(integer INT PRIMARY KEY NOT NULL);""")
+        report = migration.detect_changed()
+        self.assertTrue(report.log_has("Add test.other"))
+
+    def test_incremental_save_signatures_without_tables_not_applied(self):
+        migration = self.registry.migration
+        migration.incremental = True
+        migration.online = True
+        migration.table('test').column('other').alter(nullable=False)
+        migration.save_table_signatures()
+        self.assertIn('test', migration.get_tables_to_compare())
+        self.assertIn('testunique', migration.get_saved_table_signatures())
+        self.assertNotIn('test', migration.get_saved_table_signatures())
+        migration.deferred_operations = []
+        migration.tables_not_applied = set()
+
     def test_detect_table_removed(self):
         with self.cnx() as conn:
             conn.execute(
@@ -58,6 +58,72 @@ class TestRegistry(DBTestCase):
         bloks = registry.get_bloks_to_load()
         self.assertIn('anyblok-core', bloks)
 
+    def test_get_blok_code_hash(self):
+        registry = self.init_registry(None)
+        code_hash = registry.get_blok_code_hash('anyblok-core')
+        self.assertEqual(code_hash,
+                         registry.get_blok_code_hash('anyblok-core'))
+        self.assertNotEqual(code_hash,
+                            registry.get_blok_code_hash('anyblok-io'))
+
+    def test_get_snapshot(self):
+        registry = self.init_registry(None)
+        snapshot = registry.get_snapshot()
+        self.assertEqual(snapshot, registry.get_snapshot())
+        Blok = registry.System.Blok
+        Blok.query().filter(Blok.name == 'anyblok-core').update(
+            {'installed_version': '0.0.0'})
+        self.assertNotEqual(snapshot, registry.get_snapshot())
+
+    def test_check_snapshot(self):
+        registry = self.init_registry(None)
+        self.assertIsNone(registry.get_saved_snapshot())
+        with TestCase.Configuration(registry_snapshot=True):
+            registry.check_snapshot([])
+            self.assertFalse(registry.loadwithoutmigration)
+            self.assertTrue(registry.snapshot_to_save)
+            registry.save_snapshot()
+            self.assertEqual(registry.get_saved_snapshot(),
+                             registry.get_snapshot())
+            registry.check_snapshot([])
+            self.assertTrue(registry.loadwithoutmigration)
+            self.assertFalse(registry.snapshot_to_save)
+            registry.check_snapshot(['anyblok-io'])
+            self.assertTrue(registry.loadwithoutmigration)
+            self.assertFalse(registry.snapshot_to_save)
+            registry.loadwithoutmigration = False
+            registry.check_snapshot(['anyblok-io'])
+            self.assertFalse(registry.loadwithoutmigration)
+            self.assertTrue(registry.snapshot_to_save)
+
+    def test_check_snapshot_without_option(self):
+        registry = self.init_registry(None)
+        registry.save_snapshot()
+        registry.check_snapshot([])
+        self.assertFalse(registry.loadwithoutmigration)
+        self.assertFalse(registry.snapshot_to_save)
+
+    def test_reload_with_registry_snapshot(self):
+        registry = self.init_registry(None)
+        with TestCase.Configuration(registry_snapshot=True):
+            registry.reload()
+            self.assertEqual(registry.get_saved_snapshot(),
+                             registry.get_snapshot())
+            registry.reload()
+
+        self.assertFalse(registry.loadwithoutmigration)
+        self.assertIn('anyblok-core', registry.ordered_loaded_bloks)
+
+    def test_before_and_after_fork(self):
+        registry = self.init_registry(None)
+        engine = registry.engine
+        System = registry.System
+        RegistryManager.before_fork()
+        RegistryManager.after_fork()
+        self.assertIsNot(registry.engine, engine)
+        self.assertIs(registry.System, System)
+        self.assertTrue(registry.System.Blok.query().count())
+
     def test_load_entry(self):
         registry = self.init_registry(None)
         registry.loaded_registries['entry_names'] = []
@@ -49,6 +49,33 @@ def drop_database(url):
         cnx.close()
 
 
+@contextmanager
+def capture_statements(registry):
+    """Capture the SQL statements executed by the connection of the registry
+    in the contextmanager
+    ::
+
+        with capture_statements(registry) as statements:
+            registry.System.Blok.query().all()
+
+        self.assertEqual(len(statements), 1)
+
+    :param registry: registry which executes the statements
+    :rtype: list of the executed statements
+    """
+    statements = []
+
+    def capture(conn, cursor, statement, *args, **kwargs):
+        statements.append(statement)
+
+    connection = registry.connection()
+    event.listen(connection, 'before_cursor_execute', capture)
+    try:
+        yield statements
+    finally:
+        event.remove(connection, 'before_cursor_execute', capture)
+
+
 class TestCase(unittest.TestCase):
     """Common helpers, not meant to be used directly."""
 
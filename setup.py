@@ -111,5 +111,5 @@ setup(
         ],
         'anyblok.init': [],
     },
-    extras_require={},
+    extras_require={'numpy': ['numpy']},
 )